@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Benchmark of every route, run in process through the Flask test client
+In fake mode (the default) the routes run against FakeSession (gpg_fake_cassandra.py) with a fixed latency per
+statement, so changes to User and Cassandra can be measured without a cluster and the results are reproducible.  In
+cassandra mode they run against the cluster in contact_points (use a local test cluster, users are created and
+deleted).  In memory mode they run against the memory storage backend (gpg_storage.py), no CQL is run.  Each route
+reports its throughput, p50, p99 and mean latency and the CQL statements run per request, as json that can be compared
+with the results of another commit:
+usage: python -m app.gpg_benchmark --output before.json
+       python -m app.gpg_benchmark --compare before.json --max-regression 0.2
+run from the top level directory, exits with 1 if a route regressed compared with --compare (2 if the runs used
+different settings)
+"""
+
+__author__ = "GGibson"
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from timeit import default_timer
+import uuid
+
+from gpg_stats import return_percentile
+
+# the views log every request at DEBUG by default, which would be most of what is measured
+os.environ.setdefault('log_level', 'WARNING')
+
+logger = logging.getLogger(__name__)
+
+FAKE = 'fake'
+CASSANDRA = 'cassandra'
+MEMORY = 'memory'
+MODES = (FAKE, CASSANDRA, MEMORY)
+LOOKUP_KEYS = 10
+BULK_USERS = 10
+SEED_CHUNK_SIZE = 500
+# runs are only compared if these are the same
+COMPARED_SETTINGS = ('mode', 'latency', 'requests', 'threads', 'users', 'cache')
+
+
+def return_user_json(name):
+    return {'name': name, 'description': 'benchmark user', 'owner': 'benchmark', 'owner_email': 'bench@my.com',
+            'notes': 'created by gpg_benchmark', 'is_domain': False, 'domain': 'bench.my.com'}
+
+
+class Scenario(object):
+    """a route and the request to send for each iteration"""
+
+    def __init__(self, name, method, return_request):
+        """
+        :param name: name in the results, e.g. get_user
+        :param method: HTTP method
+        :param return_request: function(index) returning (path, json body or None)
+        """
+        self.name = name
+        self.method = method
+        self.return_request = return_request
+
+    def run(self, client, index):
+        """:return: status code of the response"""
+        path, body = self.return_request(index)
+        if body is None:
+            response = client.open(path, method=self.method)
+        else:
+            response = client.open(path, method=self.method, data=json.dumps(body), content_type='application/json')
+        # read the whole body, streamed responses (export) do their work as they are read
+        response.get_data()
+        return response.status_code
+
+
+def return_scenarios(prefix, seeded_names):
+    """
+    :param prefix: prefix of the user names created by this run
+    :param seeded_names: names of the users created before the benchmark
+    :return: list of Scenario, in the order they run (created users are updated then deleted)
+    """
+    def seeded(index):
+        return seeded_names[index % len(seeded_names)]
+
+    def created(index):
+        return '{0}-created-{1}'.format(prefix, index)
+
+    def lookup(index):
+        return '/users/lookup', {'names': [seeded(index + i) for i in range(LOOKUP_KEYS)]}
+
+    def bulk(index):
+        return '/users/bulk', [return_user_json('{0}-bulk-{1}-{2}'.format(prefix, index, i))
+                               for i in range(BULK_USERS)]
+
+    return [Scenario('index', 'GET', lambda index: ('/', None)),
+            Scenario('get_users', 'GET', lambda index: ('/users', None)),
+            Scenario('get_users_page', 'GET', lambda index: ('/users?limit=100', None)),
+            Scenario('export_users', 'GET', lambda index: ('/users/export', None)),
+            Scenario('lookup_users', 'POST', lookup),
+            Scenario('bulk_create_users', 'POST', bulk),
+            Scenario('cache_stats', 'GET', lambda index: ('/cache/stats', None)),
+            Scenario('metrics', 'GET', lambda index: ('/metrics', None)),
+            Scenario('create_user', 'POST', lambda index: ('/user', return_user_json(created(index)))),
+            Scenario('get_user', 'GET', lambda index: ('/user/' + seeded(index), None)),
+            Scenario('update_user', 'PUT', lambda index: ('/user/' + created(index),
+                                                          {'description': 'updated {0}'.format(index)})),
+            Scenario('delete_user', 'DELETE', lambda index: ('/user/' + created(index), None))]
+
+
+class Benchmark(object):
+    """runs the scenarios in fake, cassandra or memory mode and returns the results"""
+
+    def __init__(self, mode=FAKE, latency=0.0005, requests=200, warmup=10, threads=1, users=1000, cache='lru'):
+        """
+        :param mode: fake, cassandra or memory
+        :param latency: seconds per statement in fake mode
+        :param requests: measured requests per route
+        :param warmup: requests per route before the measured ones
+        :param threads: requests in flight at a time
+        :param users: users created before the benchmark
+        :param cache: user cache backend, lru or none
+        """
+        if mode not in MODES:
+            raise ValueError('unknown benchmark mode: "{0}", expected one of {1}'.format(mode, ', '.join(MODES)))
+        self.mode = mode
+        self.latency = latency
+        self.requests = requests
+        self.warmup = warmup
+        self.threads = threads
+        self.users = users
+        self.cache = cache
+        self.prefix = 'bench-{0}'.format(uuid.uuid4().hex[:8])
+        self.session = None
+
+    def run(self):
+        """
+        :return: {'meta': {...}, 'routes': {name: {'requests', 'errors', 'throughput', 'mean_ms', 'p50_ms', 'p99_ms',
+                 'max_ms', 'statements_per_request'}}}
+        :rtype: dict
+        """
+        # imported here so the log level and contact points are set before the app is set up
+        from app import app
+        import gpg_cache
+        from gpg_fake_cassandra import FakeSession, install, uninstall
+        import gpg_storage
+
+        if self.mode == FAKE:
+            self.session = FakeSession(latency=self.latency)
+            install(self.session)
+        gpg_cache.user_cache.set_backend(gpg_cache.NullCache() if self.cache == 'none' else gpg_cache.LRUCache())
+        repository = gpg_storage.set_repository(gpg_storage.InMemoryUserRepository() if self.mode == MEMORY
+                                                else gpg_storage.CassandraUserRepository())
+        try:
+            client = app.test_client()
+            seeded_names = self._seed_users(client)
+            routes = {}
+            for scenario in return_scenarios(self.prefix, seeded_names):
+                routes[scenario.name] = self._run_scenario(app, scenario)
+                logger.info('benchmark route: %s, results: %s', scenario.name, routes[scenario.name])
+            if self.mode == CASSANDRA:
+                self._delete_users(client, seeded_names)
+        finally:
+            gpg_storage.set_repository(repository)
+            if self.mode == FAKE:
+                uninstall()
+        return {'meta': self._return_meta(), 'routes': routes}
+
+    def _seed_users(self, client):
+        names = ['{0}-seed-{1}'.format(self.prefix, i) for i in range(self.users)]
+        for start in range(0, len(names), SEED_CHUNK_SIZE):
+            response = client.post('/users/bulk', content_type='application/json',
+                                   data=json.dumps([return_user_json(name)
+                                                    for name in names[start:start + SEED_CHUNK_SIZE]]))
+            if response.status_code != 200:
+                raise RuntimeError('cannot create the benchmark users, status: {0}'.format(response.status_code))
+        return names
+
+    def _delete_users(self, client, names):
+        for i in range(BULK_USERS * (self.warmup + self.requests)):
+            names.append('{0}-bulk-{1}-{2}'.format(self.prefix, i // BULK_USERS, i % BULK_USERS))
+        for name in names:
+            client.delete('/user/' + name)
+
+    def _count_statements(self):
+        """:return: statements run so far, statements run concurrently count once in cassandra mode"""
+        if self.session is not None:
+            return len(self.session.executed)
+        import gpg_metrics
+        return gpg_metrics.cassandra_statement_duration.total_count()
+
+    def _run_scenario(self, app, scenario):
+        self._run_requests(app, scenario, range(self.warmup))
+        statements = self._count_statements()
+        start = default_timer()
+        results = self._run_requests(app, scenario, range(self.warmup, self.warmup + self.requests))
+        elapsed = default_timer() - start
+        statements = self._count_statements() - statements
+        durations = sorted(duration for status, duration in results)
+        return {'requests': len(results),
+                'errors': sum(1 for status, duration in results if status >= 400),
+                'throughput': round(len(results) / elapsed, 1) if elapsed else None,
+                'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else None,
+                'p50_ms': round(return_percentile(durations, 0.5) * 1000, 3) if durations else None,
+                'p99_ms': round(return_percentile(durations, 0.99) * 1000, 3) if durations else None,
+                'max_ms': round(durations[-1] * 1000, 3) if durations else None,
+                'statements_per_request': round(float(statements) / len(results), 2) if results else None}
+
+    def _run_requests(self, app, scenario, indexes):
+        """:return: list of (status code, seconds), one per index"""
+        def run(index_slice):
+            client = app.test_client()
+            results = []
+            for index in index_slice:
+                start = default_timer()
+                status = scenario.run(client, index)
+                results.append((status, default_timer() - start))
+            return results
+
+        indexes = list(indexes)
+        if self.threads <= 1:
+            return run(indexes)
+        with ThreadPoolExecutor(self.threads) as executor:
+            slices = executor.map(run, [indexes[i::self.threads] for i in range(self.threads)])
+            return [result for results in slices for result in results]
+
+    def _return_meta(self):
+        meta = {'mode': self.mode, 'requests': self.requests, 'warmup': self.warmup, 'threads': self.threads,
+                'users': self.users, 'cache': self.cache, 'python': platform.python_version(),
+                'time': datetime.datetime.utcnow().isoformat() + 'Z', 'commit': return_git_commit()}
+        if self.mode == FAKE:
+            meta['latency'] = self.latency
+        return meta
+
+
+def return_git_commit():
+    """:return: the commit of the working tree, None outside a git checkout"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline, results, max_regression=0.2):
+    """
+    Compares the routes in both results: a route regressed if its p50 or p99 latency grew, or its throughput fell, by
+    more than max_regression, or if it runs more statements per request (with one thread the statement counts do not
+    vary between runs, with more the user cache fills in a different order)
+    :param baseline: results of an earlier run
+    :param results: results of this run
+    :param max_regression: fraction, e.g. 0.2 for 20%
+    :return: list of regression messages, empty if no route regressed
+    :rtype: list
+    :raise ValueError if the runs used different settings
+    """
+    for key in COMPARED_SETTINGS:
+        if baseline.get('meta', {}).get(key) != results['meta'].get(key):
+            raise ValueError('cannot compare runs with different {0}: {1} and {2}'.format(
+                key, baseline.get('meta', {}).get(key), results['meta'].get(key)))
+    exact_statements = results['meta']['threads'] == 1
+    regressions = []
+    for name, route in sorted(results['routes'].items()):
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if before.get(key) and route.get(key) and route[key] > before[key] * (1 + max_regression):
+                regressions.append('{0}: {1} {2} -> {3}'.format(name, key, before[key], route[key]))
+        if before.get('throughput') and route.get('throughput') and \
+                route['throughput'] < before['throughput'] * (1 - max_regression):
+            regressions.append('{0}: throughput {1} -> {2}'.format(name, before['throughput'], route['throughput']))
+        if exact_statements and before.get('statements_per_request') is not None and \
+                route['statements_per_request'] > before['statements_per_request']:
+            regressions.append('{0}: statements_per_request {1} -> {2}'.format(
+                name, before['statements_per_request'], route['statements_per_request']))
+    return regressions
+
+
+def return_table(results):
+    """:return: the results as a text table"""
+    columns = ('requests', 'errors', 'throughput', 'mean_ms', 'p50_ms', 'p99_ms', 'statements_per_request')
+    lines = ['{0:<20}'.format('route') + ''.join('{0:>{1}}'.format(column, len(column) + 2) for column in columns)]
+    for name, route in sorted(results['routes'].items()):
+        lines.append('{0:<20}'.format(name) + ''.join('{0:>{1}}'.format(route[column], len(column) + 2)
+                                                      for column in columns))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='benchmark every route of the app through the Flask test client')
+    parser.add_argument('--mode', choices=MODES, default=FAKE,
+                        help='run against an in process fake session (default), a Cassandra cluster or the memory '
+                             'storage backend')
+    parser.add_argument('--contact-points', default=os.environ.get('contact_points'),
+                        help='cassandra mode, comma separated contact points, defaults to the contact_points env var')
+    parser.add_argument('--latency', type=float, default=0.0005, help='fake mode, seconds per statement')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='requests per route before the measured ones')
+    parser.add_argument('--threads', type=int, default=1, help='requests in flight at a time')
+    parser.add_argument('--users', type=int, default=1000, help='users created before the benchmark')
+    parser.add_argument('--cache', choices=('lru', 'none'), default='lru', help='user cache backend')
+    parser.add_argument('--output', help='file to write the json results to, defaults to stdout')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='fraction a latency or throughput can get worse by before it is a regression')
+    options = parser.parse_args(args)
+    if options.mode == CASSANDRA:
+        if not options.contact_points:
+            parser.error('no contact points provided, use --contact-points or set contact_points')
+        os.environ['contact_points'] = options.contact_points
+    else:
+        # the fake session ignores the contact points, Cassandra() requires them
+        os.environ.setdefault('contact_points', '127.0.0.1')
+
+    results = Benchmark(options.mode, options.latency, options.requests, options.warmup, options.threads,
+                        options.users, options.cache).run()
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    sys.stderr.write(return_table(results) + '\n')
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            try:
+                regressions = compare_results(json.load(baseline_file), results, options.max_regression)
+            except ValueError as e:
+                sys.stderr.write('{0}\n'.format(e))
+                return 2
+        for regression in regressions:
+            sys.stderr.write('regression: {0}\n'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Bulk loading of users, shared by the POST /users/bulk endpoint and the gpg_load_users.py command line loader
+Records are read and validated one at a time and written a chunk at a time with bounded concurrency, the same way
+User.create_user does it: claim the name (IF NOT EXISTS), then insert the row (IF NOT EXISTS).  Storage backends
+other than Cassandra (see gpg_storage.py) create the validated records one at a time with create_users
+"""
+
+__author__ = "GGibson"
+
+import json
+import logging
+
+from gpg_cache import user_cache
+from gpg_cassandra import Cassandra, User, UserExceptions, UserExistsError
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ('user_id', 'name', 'description', 'owner', 'owner_email', 'notes', 'is_domain', 'domain')
+# the type of each field and its name in errors, the driver cannot bind a value of another type to the column
+FIELD_TYPES = dict([(field, (basestring, 'a string')) for field in USER_FIELDS if field != 'is_domain'] +
+                   [('is_domain', (bool, 'a boolean'))])
+
+CREATED = 'created'
+EXISTS = 'exists'
+INVALID = 'invalid'
+ERROR = 'error'
+
+
+class BulkRecordError(UserExceptions):
+    pass
+
+
+def iter_ndjson(lines):
+    """
+    Parses newline delimited json one line at a time, blank lines are skipped
+    :param lines: iterable of lines (a file or stream)
+    :return: the parsed records, or a BulkRecordError for a line that cannot be parsed
+    :rtype: generator
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield BulkRecordError('line {0}: {1}'.format(line_number, e))
+
+
+def iter_json_array(data):
+    """
+    Parses a json array of records
+    :param data: json document
+    :rtype: list
+    :raise BulkRecordError if the document is not a json array
+    """
+    try:
+        records = json.loads(data)
+    except ValueError as e:
+        raise BulkRecordError('cannot parse json document: {0}'.format(e))
+    if not isinstance(records, list):
+        raise BulkRecordError('json document is not an array of users')
+    return records
+
+
+def load_users(records, concurrency=100, chunk_size=1000):
+    """
+    Creates users from records, chunk_size records at a time with at most concurrency writes in flight
+    :param records: iterable of user dictionaries (or exceptions for records that failed to parse)
+    :param concurrency: maximum number of writes in flight
+    :param chunk_size: number of records read and written together
+    :return: one result per record, in order: {'index', 'name', 'user_id', 'status'[, 'error']}
+    :rtype: generator of dictionary
+    """
+    logger.debug('entering load users, concurrency: %d, chunk size: %d', concurrency, chunk_size)
+    chunk = []
+    for index, record in enumerate(records):
+        chunk.append((index, record))
+        if len(chunk) >= chunk_size:
+            for result in _load_chunk(chunk, concurrency):
+                yield result
+            chunk = []
+    if chunk:
+        for result in _load_chunk(chunk, concurrency):
+            yield result
+
+
+def _load_chunk(chunk, concurrency):
+    """
+    Validates and writes a chunk of (index, record)
+    :rtype: list of dictionary
+    """
+    results = []
+    users = []
+    for index, record in chunk:
+        result = {'index': index, 'name': record.get('name') if isinstance(record, dict) else None,
+                  'user_id': None, 'status': None}
+        results.append(result)
+        try:
+            user = _return_user(record)
+        except UserExceptions as e:
+            _set_status(result, INVALID, e)
+            continue
+        result['user_id'] = str(user.user_id)
+        users.append((result, user))
+
+    cassandra = Cassandra.return_default()
+    claims = cassandra.run_cassandra_cql_concurrent(
+        User.CLAIM_USER_NAME_COMMAND, [user._return_claim_user_name_command()[1] for result, user in users],
+        concurrency)
+    claimed = []
+    for (result, user), (success, claim) in zip(users, claims):
+        if not success:
+            _set_status(result, ERROR, claim)
+        elif not claim.was_applied:
+            _set_status(result, EXISTS, 'a user already exists that matches the name: {0}'.format(user.name))
+        else:
+            claimed.append((result, user))
+
+    inserts = cassandra.run_cassandra_cql_concurrent(
+        User.CREATE_USER_COMMAND, [user._return_create_user_command()[1] for result, user in claimed], concurrency)
+    release = []
+    for (result, user), (success, insert) in zip(claimed, inserts):
+        if not success:
+            _set_status(result, ERROR, insert)
+            release.append(user)
+        elif not insert.was_applied:
+            _set_status(result, EXISTS, 'a user already exists that matches the id: {0}'.format(user.user_id))
+            release.append(user)
+        else:
+            result['status'] = CREATED
+            user_cache.invalidate(user.name, user.user_id)
+    if release:
+        cassandra.run_cassandra_cql_concurrent(
+            User.RELEASE_USER_NAME_COMMAND, [user._return_release_user_name_command()[1] for user in release],
+            concurrency)
+    logger.debug('loaded chunk of %d records, created: %d', len(chunk),
+                 sum(1 for result in results if result['status'] == CREATED))
+    return results
+
+
+def create_users(records, create):
+    """
+    Creates users from records one at a time
+    :param records: iterable of user dictionaries (or exceptions for records that failed to parse)
+    :param create: function(record) that creates the user and returns its record, see gpg_storage.UserRepository
+    :return: one result per record, in order, the same as load_users
+    :rtype: generator of dictionary
+    """
+    for index, record in enumerate(records):
+        result = {'index': index, 'name': record.get('name') if isinstance(record, dict) else None,
+                  'user_id': None, 'status': None}
+        try:
+            validate_record(record)
+            result['user_id'] = create(record)['user_id']
+            result['status'] = CREATED
+        except UserExistsError as e:
+            _set_status(result, EXISTS, e)
+        except UserExceptions as e:
+            _set_status(result, INVALID, e)
+        except Exception as e:
+            _set_status(result, ERROR, e)
+        yield result
+
+
+def return_field_type_error(values):
+    """
+    :param values: dictionary of record fields, the fields that are not user fields are not checked
+    :return: the error for the first field that is set to a value of the wrong type, None if there is none
+    :rtype: str
+    """
+    for field in USER_FIELDS:
+        value = values.get(field)
+        field_type, type_name = FIELD_TYPES[field]
+        if value is not None and not isinstance(value, field_type):
+            return 'user {0} must be {1}: {2}'.format(field, type_name, json.dumps(value))
+    return None
+
+
+def validate_record(record):
+    """
+    Verifies a record is a json object with only user fields, each of the type of its column, and a name without spaces
+    :raise BulkRecordError if it is not
+    """
+    if isinstance(record, Exception):
+        raise BulkRecordError(str(record))
+    if not isinstance(record, dict):
+        raise BulkRecordError('user record is not a json object: {0}'.format(record))
+    unknown_fields = set(record) - set(USER_FIELDS)
+    if unknown_fields:
+        raise BulkRecordError('unknown user fields: {0}'.format(', '.join(sorted(unknown_fields))))
+    # checked before the values are used, a name that is a number or a list is an invalid record, not an error
+    type_error = return_field_type_error(record)
+    if type_error:
+        raise BulkRecordError(type_error)
+    name = record.get('name')
+    if name and ' ' in name:
+        raise BulkRecordError('user name cannot have a space in it: {0}'.format(name))
+
+
+def _return_user(record):
+    """
+    Validates a record and returns the User to create, with the defaults set
+    :rtype: User
+    :raise UserExceptions if the record is not a valid user
+    """
+    validate_record(record)
+    user = User(**record)
+    user._set_value_defaults()
+    return user
+
+
+def _set_status(result, status, error):
+    result['status'] = status
+    result['error'] = str(error)
+    logger.warning('failed to load user record: %d, status: %s, error: %s', result['index'], status, error)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Read through cache for user name to id resolution and user details
+The default backend is an in process LRU with a TTL and a size bound.  Another backend (for example a shared cache
+used by every app instance) can be plugged in by implementing CacheBackend and either calling
+user_cache.set_backend() or naming the class in the user_cache_backend environment variable
+Invalidations are also published on the cache invalidation bus (see gpg_invalidation) when one is configured, so the
+other app instances drop their copies too
+environment variables:
+    user_cache_backend - lru, none, or a dotted path to a CacheBackend class.  The default is lru when an
+                         invalidation bus is configured and none otherwise: without a bus a worker keeps serving the
+                         entries another worker (gunicorn starts several) has changed until they expire
+    user_cache_size - maximum number of entries in the lru backend, default 10000
+    user_cache_ttl - seconds an lru entry is used for, default 30
+    cache_invalidation_bus - see gpg_invalidation
+"""
+
+__author__ = "GGibson"
+
+from collections import OrderedDict
+import importlib
+import logging
+import os
+import threading
+import time
+
+from gpg_invalidation import return_bus_from_environment
+from gpg_record import UserRecord
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(object):
+    """interface for user cache backends"""
+
+    def get(self, key):
+        """
+        Returns the cached value for the key
+        :return: the value or None if the key is not cached
+        """
+        raise NotImplementedError('get must be implemented on the child class')
+
+    def set(self, key, value):
+        """caches the value for the key"""
+        raise NotImplementedError('set must be implemented on the child class')
+
+    def delete(self, key):
+        """removes the key from the cache if it is cached"""
+        raise NotImplementedError('delete must be implemented on the child class')
+
+    def clear(self):
+        """removes every key from the cache"""
+        raise NotImplementedError('clear must be implemented on the child class')
+
+    def stats(self):
+        """
+        Returns the cache counters
+        :rtype: dictionary
+        """
+        return {}
+
+
+class NullCache(CacheBackend):
+    """a backend that caches nothing, every get is a miss"""
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'none', 'size': 0, 'hits': 0, 'misses': self.misses, 'evictions': 0, 'expirations': 0}
+
+
+class LRUCache(CacheBackend):
+    """
+    In process least recently used cache, entries are dropped when they are older than ttl seconds or when the
+    cache holds max_size entries and a new key is added
+    """
+
+    def __init__(self, max_size=10000, ttl=30, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= self.clock():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # re-insert to mark the key as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'backend': 'lru', 'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+class UserCache(object):
+    """
+    Caches user name -> id and id -> user record (see gpg_cassandra.User.return_record_from_row).  A record with
+    every user field is held as a gpg_record.UserRecord, a fraction of the memory of the dictionary, other records as
+    a copy.  Records are handed out as new dictionaries
+    """
+    NAME_PREFIX = 'name:'
+    ID_PREFIX = 'id:'
+
+    def __init__(self, backend=None, bus=None):
+        self.backend = backend or NullCache()
+        self.bus = None
+        if bus:
+            self.set_bus(bus)
+
+    def set_backend(self, backend):
+        """replaces the cache backend"""
+        logger.info('setting user cache backend: %s', backend)
+        self.backend = backend
+
+    def set_bus(self, bus):
+        """
+        publishes invalidations on the bus and applies the invalidations other instances publish
+        :param bus: InvalidationBus or None to stop using a bus
+        """
+        logger.info('setting user cache invalidation bus: %s', bus)
+        if self.bus:
+            self.bus.close()
+        self.bus = bus
+        if bus:
+            bus.subscribe(self._invalidate_local)
+
+    def get_user_id(self, name):
+        """:return: the cached id for the user name or None"""
+        if self.bus:
+            # make sure this process is receiving invalidations before serving from the cache (e.g. after a fork)
+            self.bus.start()
+        return self.backend.get(UserCache.NAME_PREFIX + name)
+
+    def set_user_id(self, name, user_id):
+        self.backend.set(UserCache.NAME_PREFIX + name, user_id)
+
+    def get_record(self, user_id):
+        """:return: a copy of the cached record for the user id or None"""
+        if self.bus:
+            self.bus.start()
+        record = self.backend.get(UserCache.ID_PREFIX + str(user_id))
+        if record is None:
+            return None
+        return record.return_dict() if isinstance(record, UserRecord) else dict(record)
+
+    def set_record(self, user_id, record):
+        if len(record) == len(UserRecord.FIELDS) and all(field in record for field in UserRecord.FIELDS):
+            record = UserRecord.from_dict(record)
+        else:
+            record = dict(record)
+        self.backend.set(UserCache.ID_PREFIX + str(user_id), record)
+
+    def invalidate(self, name=None, user_id=None):
+        """
+        removes the cached id for the name and the cached record for the user id from this cache, and publishes the
+        invalidation to the other instances
+        """
+        self._invalidate_local(name, user_id)
+        if self.bus:
+            self.bus.publish(name, user_id)
+
+    def _invalidate_local(self, name=None, user_id=None):
+        logger.debug('invalidating user cache, name: "%s", id: %s', name, user_id)
+        if name:
+            self.backend.delete(UserCache.NAME_PREFIX + name)
+        if user_id:
+            self.backend.delete(UserCache.ID_PREFIX + str(user_id))
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def return_backend_from_environment(bus=None):
+    """
+    Creates the cache backend named by the user_cache_backend environment variable
+    :param bus: the invalidation bus, the default backend is lru with one and none without
+    :rtype: CacheBackend
+    """
+    backend_name = os.environ.get('user_cache_backend', 'lru' if bus else 'none')
+    if backend_name == 'lru':
+        return LRUCache(int(os.environ.get('user_cache_size', 10000)), float(os.environ.get('user_cache_ttl', 30)))
+    if backend_name == 'none':
+        return NullCache()
+    module_name, class_name = backend_name.rsplit('.', 1)
+    logger.info('loading user cache backend: %s', backend_name)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+_bus = return_bus_from_environment()
+user_cache = UserCache(return_backend_from_environment(_bus), _bus)
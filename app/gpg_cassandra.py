@@ -7,13 +7,34 @@ Contains the environment classes
 __author__ = "GGibson"
 
 
+import base64
+import binascii
 import logging
 import os
+import threading
+from timeit import default_timer
 import uuid
-
-from gpg_cassandra_utility import get_connection
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from cassandra import InvalidRequest, OperationTimedOut, Timeout
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.protocol import ProtocolException
+from cassandra.query import SimpleStatement
+
+from gpg_cache import user_cache
+from gpg_cassandra_utility import get_prepared_statement, get_session, split_token_ranges
+from gpg_metrics import cassandra_statement_duration, cassandra_statement_errors, return_statement_type
+from gpg_record import Record, UserRecord
+from gpg_setup_logger import LogSampler
+import gpg_tracing
 
 logger = logging.getLogger(__name__)
+# per row and per statement debug logs are sampled so they stay cheap on large reads and busy workers
+row_log_sampler = LogSampler(logger, every=int(os.environ.get('log_row_sample_every', 1000)))
+statement_log_sampler = LogSampler(logger, max_per_second=float(os.environ.get('log_statement_max_per_second', 100)))
 
 
 class UserExceptions(Exception):
@@ -32,13 +53,44 @@ class UserIdError(UserExceptions):
     pass
 
 
+class UserExistsError(UserIdError):
+    pass
+
+
 class CassandraConnectionError(UserExceptions):
     pass
 
 
-class User(object):
+class PageTokenError(UserExceptions):
+    pass
+
+
+class User(Record):
+    """
+    A user of users_tbl, with the fields of gpg_record.UserRecord.  Slotted like the other records but mutable, the
+    commands fill in and change the user as they run
+    """
+    FIELDS = UserRecord.FIELDS
+    MUTABLE = True
     KEYSPACE = 'users'
     USERS_TABLE = '{0}.users_tbl'.format(KEYSPACE)
+    # name -> id lookup table (partition key is name), replaces the secondary index on users_tbl.name
+    USERS_BY_NAME_TABLE = '{0}.users_by_name'.format(KEYSPACE)
+    UPDATABLE_COLUMNS = ('description', 'owner', 'owner_email', 'notes', 'is_domain', 'domain')
+
+    # CQL commands are prepared once per session (see gpg_cassandra_utility.PreparedStatementRegistry)
+    CREATE_USER_COMMAND = "INSERT INTO {0} (id, name, description, owner, owner_email, notes, is_domain, domain) " \
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?) IF NOT EXISTS;".format(USERS_TABLE)
+    DELETE_USER_COMMAND = "DELETE FROM {0} WHERE id=?;".format(USERS_TABLE)
+    CLAIM_USER_NAME_COMMAND = "INSERT INTO {0} (name, id) VALUES (?, ?) IF NOT EXISTS;".format(USERS_BY_NAME_TABLE)
+    RELEASE_USER_NAME_COMMAND = "DELETE FROM {0} WHERE name=? IF id=?;".format(USERS_BY_NAME_TABLE)
+    USER_ID_BY_NAME_COMMAND = "SELECT id FROM {0} WHERE name=?;".format(USERS_BY_NAME_TABLE)
+    USER_NAME_BY_ID_COMMAND = "SELECT name FROM {0} WHERE id=?;".format(USERS_TABLE)
+    USER_DETAILS_COMMAND = "SELECT * FROM {0} WHERE id=?;".format(USERS_TABLE)
+    USERS_COMMAND = "SELECT id, name FROM {0};".format(USERS_TABLE)
+    USERS_TOKEN_RANGE_COMMAND = "SELECT * FROM {0} WHERE token(id) > ? AND token(id) <= ?;".format(USERS_TABLE)
+    # update commands by the tuple of columns being set, so each column set is only built (and prepared) once
+    _update_user_commands = {}
 
     def __init__(self, user_id=None, name=None, description=None, owner=None, owner_email=None, notes=None,
                  is_domain=None, domain=None):
@@ -61,64 +113,141 @@ class User(object):
         self.notes = notes
         self.is_domain = is_domain
         self.domain = domain
-        self.cassandra = Cassandra()
+
+    @property
+    def cassandra(self):
+        """the Cassandra every user shares, see Cassandra.return_default"""
+        return Cassandra.return_default()
 
     def return_user_id(self):
         """interface to return user id"""
         return self.user_id
 
-    def return_user_id_by_name(self):
+    def return_user_id_by_name(self, cached=True):
         """
-        return the user id from the user name.  This will limit to the first user with the user name found
+        return the user id from the user name, from the user cache or a single partition read of the users_by_name
+        lookup table
+        :param cached: False to skip the cache and read the lookup table, for writes: without an invalidation bus the
+                       cached id can be stale, another worker may have deleted or recreated the user
         :return: id of the user
         :rtype: uuid
         """
-        logger.debug('entering return user id from user name: "%s"', self.name)
-        self.user_id = None
-        for user in self.cassandra.run_cassandra_cql_command(self._return_user_id_by_name_command()):
-            self.user_id = user.id
-            break
+        logger.debug('entering return user id from user name: "%s", cached: %s', self.name, cached)
+        with gpg_tracing.span('name_lookup'):
+            self.user_id = user_cache.get_user_id(self.name) if cached else None
+            if not self.user_id:
+                for user in self.cassandra.run_cassandra_cql_command(*self._return_user_id_by_name_command()):
+                    self.user_id = user.id
+                    user_cache.set_user_id(self.name, self.user_id)
+                    break
         logger.debug('returning user id: "%s" for user name: "%s"', self.user_id, self.name)
         return self.user_id
 
     def create_user(self):
         """
-        creates a user
+        creates a user.  The name is claimed in users_by_name and the row is written to users_tbl with lightweight
+        transactions (IF NOT EXISTS), so the checks and the writes are one step and safe against concurrent creates
+        from other app instances.  On success the object holds the values that were written
+        :raise UserExistsError if a user with the same name or id already exists
         """
         logger.debug('entering create user: "%s"', self.name)
-        self._verify_user_id_and_name_not_exist()
-        self.cassandra.run_cassandra_cql_command(self._return_create_user_command())
-        self._set_user_id()
+        self._set_value_defaults()
+        if not self.cassandra.run_cassandra_cql_command(*self._return_claim_user_name_command()).was_applied:
+            message = 'Failed, a user already exists that matches the name: {0}'.format(self.name)
+            logger.error(message)
+            raise UserExistsError(message)
+        try:
+            applied = self.cassandra.run_cassandra_cql_command(*self._return_create_user_command()).was_applied
+        except (OperationTimedOut, Timeout):
+            # the insert may still have been applied, so the name stays claimed for it
+            raise
+        except Exception:
+            # the insert failed (e.g. a value the driver cannot bind), the name would otherwise resolve to no row
+            logger.exception('failed to insert user: "%s", releasing the user name', self.name)
+            self._release_user_name_after_error()
+            raise
+        if not applied:
+            self.cassandra.run_cassandra_cql_command(*self._return_release_user_name_command())
+            message = 'Failed, a user already exists that matches the id: {0}'.format(self.user_id)
+            logger.error(message)
+            raise UserExistsError(message)
+        user_cache.invalidate(self.name, self.user_id)
         logger.debug('successfully created user: "%s"', self.name)
 
+    def _release_user_name_after_error(self):
+        """releases the name claimed by create_user, a failure is logged so the insert error is the one raised"""
+        try:
+            self.cassandra.run_cassandra_cql_command(*self._return_release_user_name_command())
+        except Exception:
+            logger.exception('failed to release user name: "%s"', self.name)
+
     def update_user(self):
         """
         update a user based on id.  If the id value isn't set, it will lookup based on name
+        :raise UserIdError if the user does not exist
         """
         logger.debug('entering update user: "%s"', self.name)
-        self._set_user_id()
-        self.cassandra.run_cassandra_cql_command(self._return_update_user_command())
+        self._set_user_id(cached=False)
+        # IF EXISTS, a plain UPDATE is an upsert and would write a row without a name for a user deleted meanwhile
+        if not self.cassandra.run_cassandra_cql_command(*self._return_update_user_command()).was_applied:
+            user_cache.invalidate(self.name, self.user_id)
+            message = 'failed to find the user id: {0}'.format(self.user_id)
+            logger.error(message)
+            raise UserIdError(message)
+        user_cache.invalidate(user_id=self.user_id)
         logger.debug('successfully updated user: "%s"', self.name)
 
+    def is_update_complete(self):
+        """
+        returns True if an update sets every updatable column, the object then holds the full record after
+        update_user and there is no need to read it back with get_user_details
+        :rtype: bool
+        """
+        return len(self._return_update_columns()) == len(User.UPDATABLE_COLUMNS)
+
     def get_user_details(self):
         """
-        get user details based on id.  If the id value isn't set, it will lookup based on name
+        get user details based on id, from the user cache or a single read.  If the id value isn't set, it will
+        lookup based on name
         """
         logger.debug('entering get user detail: "%s"', self.name)
         self._set_user_id()
-        self.cassandra.run_cassandra_cql_command(self._return_user_details_command())
-
-        for user in self.cassandra.run_cassandra_cql_command(self._return_user_details_command()):
-            self.name = user.name
-            self.description = user.description
-            self.owner = user.owner
-            self.owner_email = user.owner_email
-            self.notes = user.notes
-            self.is_domain = user.is_domain
-            self.domain = user.domain
-            break
+        record = User.get_user_record(self.user_id, self.cassandra)
+        if record is not None:
+            self._set_from_record(record)
         logger.debug('successfully updated user: %s', self)
 
+    @staticmethod
+    def get_user_record(user_id, cassandra=None):
+        """
+        Returns the record for a user id, from the user cache or a single read
+        :param user_id: uuid
+        :param cassandra: Cassandra to read with, None for the default
+        :return: the user record (see return_record_from_row), None if the id is not found
+        :rtype: dictionary
+        """
+        record = user_cache.get_record(user_id)
+        if record is None:
+            cassandra = cassandra or Cassandra.return_default()
+            for user in cassandra.run_cassandra_cql_command(User.USER_DETAILS_COMMAND, (user_id,)):
+                record = User.return_record_from_row(user)
+                user_cache.set_record(user_id, record)
+                break
+        return record
+
+    def _set_from_record(self, record):
+        """
+        sets the user values (except the id) from a user record
+        :param record: dictionary, see return_record_from_row
+        """
+        self.name = record['name']
+        self.description = record['description']
+        self.owner = record['owner']
+        self.owner_email = record['owner_email']
+        self.notes = record['notes']
+        self.is_domain = record['is_domain']
+        self.domain = record['domain']
+
     @staticmethod
     def get_all_users():
         """
@@ -128,24 +257,209 @@ class User(object):
         """
         logger.debug('entering return all users and ids')
         users = {}
-        for user in Cassandra().run_cassandra_cql_command(User._return_users_command()):
-            logger.debug('adding user: "%s", id: "%s"', user.id, user.name)
+        for user in Cassandra.return_default().run_cassandra_cql_command(*User._return_users_command()):
+            if row_log_sampler.sample():
+                logger.debug('adding user: "%s", id: "%s"', user.name, user.id)
             users[user.name] = str(user.id)
         logger.debug('returning: %d users', len(users))
         return users
 
+    @staticmethod
+    def get_users_page(limit, page_token=None):
+        """
+        Returns one page of users and their ids, paged by the server (fetch size and paging state) so only the
+        requested page is read
+        :param limit: maximum number of users to return
+        :param page_token: opaque token returned with the previous page, None for the first page
+        :return dictionary of users and ids, token for the next page or None if this is the last page
+        :rtype: (dictionary, string), dictionary key: name, value: id
+        :raise PageTokenError if the page token cannot be decoded or Cassandra rejects its paging state
+        """
+        logger.debug('entering return users page, limit: %d, page token: "%s"', limit, page_token)
+        paging_state = None
+        if page_token:
+            try:
+                paging_state = base64.urlsafe_b64decode(str(page_token))
+            except (TypeError, ValueError, binascii.Error):
+                message = 'invalid page token: "{0}"'.format(page_token)
+                logger.error(message)
+                raise PageTokenError(message)
+        try:
+            result = Cassandra.return_default().run_cassandra_cql_command(*User._return_users_command(),
+                                                                           fetch_size=limit, paging_state=paging_state)
+        except (InvalidRequest, ProtocolException) as e:
+            if paging_state is None:
+                raise
+            # the token decoded but does not hold a paging state Cassandra can resume from
+            message = 'invalid page token: "{0}": {1}'.format(page_token, e)
+            logger.error(message)
+            raise PageTokenError(message)
+        users = dict((user.name, str(user.id)) for user in result.current_rows)
+        next_page_token = base64.urlsafe_b64encode(result.paging_state) if result.paging_state else None
+        logger.debug('returning: %d users, next page token: "%s"', len(users), next_page_token)
+        return users, next_page_token
+
+    @staticmethod
+    def iter_all_users(fetch_size=1000):
+        """
+        Yields every user name and id, the driver fetches the next page of fetch_size rows as the previous page is
+        consumed so only one page is held in memory
+        :param fetch_size: number of rows per page
+        :rtype: generator of (name, id)
+        """
+        logger.debug('entering iterate all users, fetch size: %d', fetch_size)
+        cassandra = Cassandra.return_default()
+        for user in cassandra.run_cassandra_cql_command(*User._return_users_command(), fetch_size=fetch_size):
+            yield user.name, str(user.id)
+
+    @staticmethod
+    def export_users(range_count=64, workers=8, fetch_size=1000, queue_size=1000):
+        """
+        Yields every user record by scanning users_tbl one token range at a time, with up to workers ranges
+        scanned in parallel.  Memory is bounded: the scanning threads block once queue_size records are waiting
+        to be consumed, and stop if the generator is closed before it is exhausted
+        :param range_count: number of token ranges to split the table into
+        :param workers: number of ranges scanned at the same time
+        :param fetch_size: rows per page within a range
+        :param queue_size: maximum number of records buffered between the scans and the consumer
+        :rtype: generator of dictionary, see return_record_from_row
+        """
+        logger.debug('entering export users, ranges: %d, workers: %d, fetch size: %d', range_count, workers,
+                     fetch_size)
+        token_ranges = queue.Queue()
+        for token_range in split_token_ranges(range_count):
+            token_ranges.put(token_range)
+        records = queue.Queue(queue_size)
+        stop = threading.Event()
+        finished = object()
+        cassandra = Cassandra.return_default()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def scan():
+            try:
+                while not stop.is_set():
+                    try:
+                        start, end = token_ranges.get_nowait()
+                    except queue.Empty:
+                        break
+                    logger.debug('scanning users token range: (%d, %d]', start, end)
+                    for row in cassandra.run_cassandra_cql_command(User.USERS_TOKEN_RANGE_COMMAND, (start, end),
+                                                                   fetch_size=fetch_size):
+                        if not put(User.return_record_from_row(row)):
+                            return
+            except Exception as e:
+                logger.exception('failed scanning users token range')
+                put(e)
+            finally:
+                put(finished)
+
+        threads = [threading.Thread(target=scan, name='export-users-{0}'.format(i)) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        running = len(threads)
+        count = 0
+        try:
+            while running:
+                item = records.get()
+                if item is finished:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    count += 1
+                    yield item
+        finally:
+            stop.set()
+            logger.debug('completed export users, exported: %d users', count)
+
+    @staticmethod
+    def get_user_ids_by_names(names, concurrency=100):
+        """
+        Resolves many user names to ids with concurrent single partition reads of users_by_name
+        :param names: list of user names
+        :param concurrency: maximum number of reads in flight
+        :return: dictionary of name to id, None for names that are not found
+        :rtype: dictionary
+        """
+        logger.debug('entering return user ids for %d names', len(names))
+        user_ids = dict((name, user_cache.get_user_id(name)) for name in names)
+        to_read = [name for name in names if not user_ids[name]]
+        results = Cassandra.return_default().run_cassandra_cql_concurrent(User.USER_ID_BY_NAME_COMMAND,
+                                                                          [(name,) for name in to_read], concurrency)
+        for name, (success, result) in zip(to_read, results):
+            if not success:
+                raise result
+            if result:
+                user_ids[name] = result[0].id
+                user_cache.set_user_id(name, result[0].id)
+        logger.debug('found %d of %d user ids', sum(1 for user_id in user_ids.values() if user_id), len(names))
+        return user_ids
+
+    @staticmethod
+    def get_user_records_by_ids(user_ids, concurrency=100):
+        """
+        Reads many user records with concurrent single partition reads of users_tbl
+        :param user_ids: list of uuid
+        :param concurrency: maximum number of reads in flight
+        :return: dictionary of id to record (see return_record_from_row), None for ids that are not found
+        :rtype: dictionary
+        """
+        logger.debug('entering return user records for %d ids', len(user_ids))
+        records = dict((user_id, user_cache.get_record(user_id)) for user_id in user_ids)
+        to_read = [user_id for user_id in user_ids if records[user_id] is None]
+        results = Cassandra.return_default().run_cassandra_cql_concurrent(User.USER_DETAILS_COMMAND,
+                                                                          [(user_id,) for user_id in to_read],
+                                                                          concurrency)
+        for user_id, (success, result) in zip(to_read, results):
+            if not success:
+                raise result
+            if result:
+                records[user_id] = User.return_record_from_row(result[0])
+                user_cache.set_record(user_id, records[user_id])
+        logger.debug('found %d of %d user records', sum(1 for record in records.values() if record), len(user_ids))
+        return records
+
+    @staticmethod
+    def return_record_from_row(row):
+        """
+        Returns the record for a users_tbl row, with the same keys as the user detail json
+        :param row: users_tbl row
+        :rtype: dictionary
+        """
+        return {'user_id': str(row.id), 'name': row.name, 'description': row.description, 'owner': row.owner,
+                'owner_email': row.owner_email, 'notes': row.notes, 'is_domain': row.is_domain,
+                'domain': row.domain}
+
     def delete_user(self):
         """
         delete a user based on id.  If the id value isn't set, it will lookup based on name
         """
         logger.debug('entering delete user: "%s"', self.name)
-        self._set_user_id()
-        self.cassandra.run_cassandra_cql_command(self._return_delete_user_command())
+        self._set_user_id(cached=False)
+        self._set_user_name()
+        # the name row is claimed with a lightweight transaction (IF NOT EXISTS) so it is released with one too (IF
+        # id=?), a plain delete on the partition would be ordered with the Paxos writes by timestamp and could lose or
+        # bring back a concurrent create of the name.  A conditional write cannot share a logged batch with the
+        # users_tbl partition, so this is create in reverse: the row goes first and, if releasing the name fails, the
+        # name still resolves to the id and deleting by name again finishes the delete
+        self.cassandra.run_cassandra_cql_command(*self._return_delete_user_command())
+        self.cassandra.run_cassandra_cql_command(*self._return_release_user_name_command())
+        user_cache.invalidate(self.name, self.user_id)
         logger.debug('successfully deleted user: "%s"', self.name)
 
-    def _set_user_id(self):
+    def _set_user_id(self, cached=True):
         """
         if user_id is not set lookup by name
+        :param cached: False to skip the user cache, see return_user_id_by_name
         :raise UserIdError if user_id and name are not defined
         """
         logger.debug('entering set user id')
@@ -156,150 +470,131 @@ class User(object):
             message = 'cannot set user id when both user id and name are not defined'
             logger.error(message)
             raise UserIdError(message)
-        self.return_user_id_by_name()
+        self.return_user_id_by_name(cached)
         if not self.user_id:
             message = 'failed to find the user id for user: "{0}"'.format(self.name)
             logger.error(message)
             raise UserIdError(message)
         logger.debug('set user id: %s from user name: "%s"', self.user_id, self.name)
 
-    def _verify_user_id_and_name_not_exist(self):
+    def _set_user_name(self):
         """
-        verifies the user id and user name do not already exist in the database
-        :raise UserIdError if user_id and name are not defined OR the user already exists (id and/or name
+        if name is not set lookup by user_id, the name is needed to keep the users_by_name table in sync
+        :raise UserIdError if the user id is not found
         """
-        logger.debug('entering verify user id and name do not exist in the database')
-        if not self.name and not self.user_id:
-            message = 'cannot check user when both user id and name are not defined'
+        logger.debug('entering set user name')
+        if self.name:
+            logger.debug('user name: "%s" is already set', self.name)
+            return
+        for user in self.cassandra.run_cassandra_cql_command(*self._return_user_name_by_id_command()):
+            self.name = user.name
+            break
+        if not self.name:
+            message = 'failed to find the user name for user id: {0}'.format(self.user_id)
             logger.error(message)
             raise UserIdError(message)
-        if self.name:
-            for user in self.cassandra.run_cassandra_cql_command(self._return_verify_user_name_not_exist_command()):
-                message = 'Failed, a user already exists that matches the name: {0}'.format(self.name)
-                logger.error(message)
-                raise UserIdError(message)
-        if self.user_id:
-            for user in self.cassandra.run_cassandra_cql_command(self._return_verify_user_id_not_exist_command()):
-                message = 'Failed, a user already exists that matches the id: {0}'.format(self.user_id)
-                logger.error(message)
-                raise UserIdError(message)
-        logger.debug('completed verifying user id and name do not exist in the database')
+        logger.debug('set user name: "%s" from user id: %s', self.name, self.user_id)
 
     def _return_create_user_command(self):
         """
-        returns the CQL command to create a user
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to create a user
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
         self._set_value_defaults()
-        command = "INSERT INTO {0} (id, name, description, owner, owner_email, notes, is_domain, domain) " \
-                  "VALUES ({1}, '{2}', '{3}', '{4}', '{5}', '{6}', {7}, '{8}');".format(User.USERS_TABLE,
-                                                                                        self.user_id, self.name,
-                                                                                        self.description, self.owner,
-                                                                                        self.owner_email, self.notes,
-                                                                                        self.is_domain, self.domain)
-        print(command)
-        logger.debug('create user CQL command: "%s"', command)
-        return command
+        command = User.CREATE_USER_COMMAND
+        parameters = (self.user_id, self.name, self.description, self.owner, self.owner_email, self.notes,
+                      self.is_domain, self.domain)
+        logger.debug('create user CQL command: "%s", parameters: %s', command, parameters)
+        return command, parameters
 
     def _return_update_user_command(self):
         """
-        returns the CQL command to update a user.  All fields can be changed except id and name
-        :return: cql create command
-        :rtype: string
-        """
-        columns_to_update = []
-        if self.description:
-            columns_to_update.append("description='{0}'".format(self.description))
-        if self.owner:
-            columns_to_update.append("owner='{0}'".format(self.owner))
-        if self.owner_email:
-            columns_to_update.append("owner_email='{0}'".format(self.owner_email))
-        if self.notes:
-            columns_to_update.append("notes='{0}'".format(self.notes))
-        if self.is_domain:
-            columns_to_update.append("is_domain={0}".format(self.is_domain))
-        if self.domain:
-            columns_to_update.append("domain='{0}'".format(self.domain))
-
+        returns the CQL command and parameters to update a user.  All fields can be changed except id and name
+        :return: cql update command, parameters
+        :rtype: (string, tuple)
+        """
+        columns_to_update = self._return_update_columns()
         if not columns_to_update:
             raise UpdateUserError('No columns to update')
 
-        command = "UPDATE {0} SET {1} WHERE id={2};".format(User.USERS_TABLE, ', '.join(columns_to_update),
-                                                            self.user_id)
-        print('---------')
-        print(command)
-        logger.debug('update user CQL command: "%s"', command)
-        return command
+        command = User._update_user_commands.get(columns_to_update)
+        if command is None:
+            command = "UPDATE {0} SET {1} WHERE id=? IF EXISTS;".format(
+                User.USERS_TABLE, ', '.join('{0}=?'.format(column) for column in columns_to_update))
+            User._update_user_commands[columns_to_update] = command
+        parameters = tuple(getattr(self, column) for column in columns_to_update) + (self.user_id,)
+        logger.debug('update user CQL command: "%s", parameters: %s', command, parameters)
+        return command, parameters
 
-    def _return_delete_user_command(self):
+    def _return_claim_user_name_command(self):
         """
-        returns the CQL command to delete a user
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to add the user to the name lookup table if the name is not taken
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
-        command = "DELETE FROM {0} WHERE id={1};".format(User.USERS_TABLE, self.user_id)
-        logger.debug('delete user CQL command: "%s"', command)
-        return command
+        command = User.CLAIM_USER_NAME_COMMAND
+        logger.debug('claim user name CQL command: "%s", name: "%s", id: %s', command, self.name, self.user_id)
+        return command, (self.name, self.user_id)
 
-    def _return_user_id_by_name_command(self):
+    def _return_release_user_name_command(self):
         """
-        returns the CQL command to select a user name by user_id
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to remove the user name from the lookup table if it is still mapped
+        to this user id
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
-        command = "SELECT id FROM {0} WHERE name='{1}';".format(User.USERS_TABLE, self.name)
-        logger.debug('user by name CQL command: "%s"', command)
-        return command
+        command = User.RELEASE_USER_NAME_COMMAND
+        logger.debug('release user name CQL command: "%s", name: "%s", id: %s', command, self.name, self.user_id)
+        return command, (self.name, self.user_id)
 
-    def _return_user_details_command(self):
+    def _return_user_name_by_id_command(self):
         """
-        returns the CQL command to select user data
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to select a user name by user_id
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
-        command = "SELECT * FROM {0} WHERE id={1}".format(User.USERS_TABLE, self.user_id)
-        logger.debug('select all users CQL command: "%s"', command)
-        return command
+        command = User.USER_NAME_BY_ID_COMMAND
+        logger.debug('user name by id CQL command: "%s", id: %s', command, self.user_id)
+        return command, (self.user_id,)
 
-    @staticmethod
-    def _return_users_command():
+    def _return_update_columns(self):
         """
-        returns the CQL command to select all user data
-        :return: cql command
-        :rtype: string
+        returns the columns an update will set, the updatable columns that have a value
+        :rtype: tuple
         """
-        command = "SELECT id, name FROM {0}".format(User.USERS_TABLE)
-        logger.debug('select user details CQL command: "%s"', command)
-        return command
+        return tuple(column for column in User.UPDATABLE_COLUMNS if getattr(self, column))
 
-    def _return_verify_user_name_not_exist_command(self):
+    def _return_delete_user_command(self):
         """
-        returns the CQL command to verify user name does not exist
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to delete a user
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
-        if not self.name:
-            logger.debug('user name not defined, return None')
-            return None
-        command = "SELECT id FROM {0} WHERE name = '{1}'".format(User.USERS_TABLE, self.name)
-        print(command)
-        logger.debug('verify user name does not exist CQL command: "%s"', command)
-        return command
+        command = User.DELETE_USER_COMMAND
+        logger.debug('delete user CQL command: "%s", id: %s', command, self.user_id)
+        return command, (self.user_id,)
 
-    def _return_verify_user_id_not_exist_command(self):
+    def _return_user_id_by_name_command(self):
         """
-        returns the CQL command to verify user id does not exist
-        :return: cql command
-        :rtype: string
+        returns the CQL command and parameters to select a user id by user name
+        :return: cql command, parameters
+        :rtype: (string, tuple)
         """
-        if not self.user_id:
-            logger.debug('user id not defined, return None')
-            return None
-        command = "SELECT id FROM {0} WHERE id = {1}".format(User.USERS_TABLE, self.user_id)
-        print(command)
-        logger.debug('verify user id does not exist CQL command: "%s"', command)
-        return command
+        command = User.USER_ID_BY_NAME_COMMAND
+        logger.debug('user by name CQL command: "%s", name: "%s"', command, self.name)
+        return command, (self.name,)
+
+    @staticmethod
+    def _return_users_command():
+        """
+        returns the CQL command and parameters to select all user ids and names
+        :return: cql command, parameters
+        :rtype: (string, tuple)
+        """
+        command = User.USERS_COMMAND
+        logger.debug('select all users CQL command: "%s"', command)
+        return command, ()
 
     def _set_value_defaults(self):
         """
@@ -331,13 +626,15 @@ class User(object):
                                                            self.owner_email, self.notes, self.is_domain, self.domain)
 
     def return_json(self):
-        json_dict = self.__dict__
-        del json_dict['cassandra']
+        json_dict = self.return_dict()
         json_dict['user_id'] = str(json_dict['user_id'])
         return json_dict
 
 
 class Cassandra(object):
+    # Cassandra by contact points string of the environment, see return_default
+    _defaults = {}
+
     def __init__(self, contact_points=None, port=9042, keyspace='users'):
         if not contact_points:
             try:
@@ -360,18 +657,114 @@ class Cassandra(object):
         self.port = port
         self.keyspace = keyspace
 
-    def run_cassandra_cql_command(self, command):
+    @classmethod
+    def return_default(cls):
+        """
+        Returns the Cassandra for the contact points in the environment.  It is built once per contact points string
+        and shared, rather than built with the contact points parsed again for every user and request, so it is never
+        changed
+        :return: the Cassandra for the environment
+        :rtype: Cassandra
+        :raise: CassandraConnectionError: if no contact points have been provided
         """
-        Runs a Cassandra CQL command
+        contact_points_string = os.environ.get('contact_points')
+        cassandra = cls._defaults.get(contact_points_string)
+        if cassandra is None:
+            cassandra = cls._defaults[contact_points_string] = cls()
+        return cassandra
+
+    def run_cassandra_cql_command(self, command, parameters=None, fetch_size=None, paging_state=None):
+        """
+        Runs a Cassandra CQL command.  If parameters are provided (an empty tuple for a command without bind
+        markers) the command is run as a cached prepared statement, otherwise as a simple statement
         :param: command: command to run
+        :param: parameters: values to bind to the ? markers in the command
+        :param: fetch_size: number of rows per page, None for the driver default
+        :param: paging_state: paging state of the previous page to resume from
         :return: result set from the cql command
         :rtype: Cassandra ResultSet
         """
-        return_result = None
-        with get_connection(contact_points=self.contact_points, keyspace=self.keyspace, port=self.port) \
-                as (cluster, session):
+        if statement_log_sampler.sample():
             logger.debug('running Cassandra cql command: "%s", keyspace: "%s", port: "%s", contact points: "%s"',
                          command, self.keyspace, self.port, self.contact_points)
-            return_result = session.execute(command)
-            logger.debug('successfully ran Cassandra cql command: "%s"', command)
-        return return_result
\ No newline at end of file
+        # the latency is to the first page, later pages are read as the result set is iterated
+        statement_type = return_statement_type(command)
+        execute_options = gpg_tracing.return_execute_options()
+        start = default_timer()
+        try:
+            with gpg_tracing.span('cql', statement_type):
+                session = get_session(contact_points=self.contact_points, keyspace=self.keyspace, port=self.port)
+                if parameters is None:
+                    statement = SimpleStatement(command, fetch_size=fetch_size) if fetch_size else command
+                    return_result = session.execute(statement, paging_state=paging_state, **execute_options)
+                else:
+                    statement = get_prepared_statement(command, contact_points=self.contact_points,
+                                                       keyspace=self.keyspace, port=self.port)
+                    if fetch_size:
+                        statement = statement.bind(parameters)
+                        statement.fetch_size = fetch_size
+                        return_result = session.execute(statement, paging_state=paging_state, **execute_options)
+                    else:
+                        return_result = session.execute(statement, parameters, paging_state=paging_state,
+                                                        **execute_options)
+        except Exception as e:
+            cassandra_statement_errors.inc((statement_type, type(e).__name__))
+            raise
+        finally:
+            cassandra_statement_duration.observe((statement_type,), default_timer() - start)
+        gpg_tracing.record_trace_ids(return_result)
+        return return_result
+
+    def run_cassandra_cql_async(self, command, parameters=()):
+        """
+        Starts a Cassandra CQL command as a prepared statement without waiting for the result
+        :param: command: command to run
+        :param: parameters: values to bind to the ? markers in the command
+        :return: future for the result set, see gpg_cassandra_async
+        :rtype: Cassandra ResponseFuture
+        """
+        session = get_session(contact_points=self.contact_points, keyspace=self.keyspace, port=self.port)
+        statement = get_prepared_statement(command, contact_points=self.contact_points, keyspace=self.keyspace,
+                                           port=self.port)
+        if statement_log_sampler.sample():
+            logger.debug('starting Cassandra cql command: "%s"', command)
+        metric_args = (return_statement_type(command), default_timer())
+        response_future = session.execute_async(statement, parameters)
+        response_future.add_callbacks(_record_statement, _record_statement_error, callback_args=metric_args,
+                                      errback_args=metric_args)
+        return response_future
+
+    def run_cassandra_cql_concurrent(self, command, parameters_list, concurrency=100):
+        """
+        Runs a Cassandra CQL command once for each set of parameters as a prepared statement, with at most
+        concurrency executions in flight
+        :param: command: command to run
+        :param: parameters_list: list of parameters, one execution per item
+        :param: concurrency: maximum number of executions in flight
+        :return: list of (success, result set or exception), in the order of parameters_list
+        :rtype: list
+        """
+        session = get_session(contact_points=self.contact_points, keyspace=self.keyspace, port=self.port)
+        statement = get_prepared_statement(command, contact_points=self.contact_points, keyspace=self.keyspace,
+                                           port=self.port)
+        logger.debug('running Cassandra cql command: "%s" %d times, concurrency: %d', command,
+                     len(parameters_list), concurrency)
+        statement_type = return_statement_type(command)
+        start = default_timer()
+        results = execute_concurrent_with_args(session, statement, parameters_list, concurrency=concurrency,
+                                               raise_on_first_error=False)
+        # one observation for the whole fan out, labelled apart from the single statements
+        cassandra_statement_duration.observe(('{0} concurrent'.format(statement_type),), default_timer() - start)
+        for success, result in results:
+            if not success:
+                cassandra_statement_errors.inc((statement_type, type(result).__name__))
+        return results
+
+
+def _record_statement(rows, statement_type, start):
+    cassandra_statement_duration.observe((statement_type,), default_timer() - start)
+
+
+def _record_statement_error(error, statement_type, start):
+    cassandra_statement_errors.inc((statement_type, type(error).__name__))
+    cassandra_statement_duration.observe((statement_type,), default_timer() - start)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Non blocking variants of the User read methods
+Each method starts its Cassandra reads with the driver's execute_async and returns a concurrent.futures.Future
+straight away, so a single thread can keep hundreds of reads in flight and chain dependent steps (name resolution,
+then the detail read) without blocking between them.  The futures are waited on with result() from the WSGI views
+"""
+
+__author__ = "GGibson"
+
+from concurrent.futures import Future
+import logging
+import threading
+
+from gpg_cache import user_cache
+from gpg_cassandra import Cassandra, User
+from gpg_cassandra_utility import get_prepared_statement
+
+logger = logging.getLogger(__name__)
+
+
+def return_future(response_future, transform=None):
+    """
+    Bridges a driver ResponseFuture to a concurrent.futures.Future
+    :param response_future: Cassandra ResponseFuture
+    :param transform: function applied to the rows before they are set as the result, it runs on the driver's event
+                      loop thread so it must not block
+    :rtype: Future
+    """
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    def callback(rows):
+        try:
+            future.set_result(transform(rows) if transform else rows)
+        except Exception as e:
+            future.set_exception(e)
+
+    response_future.add_callbacks(callback, future.set_exception)
+    return future
+
+
+def completed(value):
+    """:return: a Future that already has value as its result"""
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(value)
+    return future
+
+
+def chain(future, function):
+    """
+    Runs function on the result of future once it is done
+    :param function: function(result) returning a value or a Future, it must not block
+    :return: Future of the value returned by function (or of the result of the Future it returned)
+    :rtype: Future
+    """
+    chained = Future()
+    chained.set_running_or_notify_cancel()
+
+    def copy(done):
+        try:
+            chained.set_result(done.result())
+        except Exception as e:
+            chained.set_exception(e)
+
+    def run(done):
+        try:
+            value = function(done.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(copy)
+        else:
+            chained.set_result(value)
+
+    future.add_done_callback(run)
+    return chained
+
+
+def gather(futures):
+    """
+    :param futures: list of Future
+    :return: Future of the list of results, in order, or of the first exception raised
+    :rtype: Future
+    """
+    gathered = Future()
+    gathered.set_running_or_notify_cancel()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            if gathered.done():
+                return
+            if future.exception() is not None:
+                gathered.set_exception(future.exception())
+                return
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        gathered.set_result([future.result() for future in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+class AsyncUser(object):
+    """
+    Reads users through the user cache like User does, without blocking the calling thread
+    """
+    # prepared up front, a statement prepared on the driver's event loop thread (in a chained read) would block it
+    COMMANDS = (User.USER_ID_BY_NAME_COMMAND, User.USER_DETAILS_COMMAND)
+
+    def __init__(self, cassandra=None):
+        self.cassandra = cassandra or Cassandra.return_default()
+        for command in AsyncUser.COMMANDS:
+            get_prepared_statement(command, contact_points=self.cassandra.contact_points,
+                                   keyspace=self.cassandra.keyspace, port=self.cassandra.port)
+
+    def get_user_id_by_name(self, name):
+        """
+        :return: Future of the id of the user name, None if the name is not found
+        :rtype: Future
+        """
+        user_id = user_cache.get_user_id(name)
+        if user_id:
+            return completed(user_id)
+
+        def set_user_id(rows):
+            if not rows:
+                return None
+            user_cache.set_user_id(name, rows[0].id)
+            return rows[0].id
+
+        return return_future(self.cassandra.run_cassandra_cql_async(User.USER_ID_BY_NAME_COMMAND, (name,)),
+                             set_user_id)
+
+    def get_user_record(self, user_id):
+        """
+        :param user_id: uuid, None returns a Future of None
+        :return: Future of the user record (see User.return_record_from_row), None if the id is not found
+        :rtype: Future
+        """
+        if not user_id:
+            return completed(None)
+        record = user_cache.get_record(user_id)
+        if record is not None:
+            return completed(record)
+
+        def set_record(rows):
+            if not rows:
+                return None
+            record = User.return_record_from_row(rows[0])
+            user_cache.set_record(user_id, record)
+            return record
+
+        return return_future(self.cassandra.run_cassandra_cql_async(User.USER_DETAILS_COMMAND, (user_id,)),
+                             set_record)
+
+    def get_user_record_by_name(self, name):
+        """
+        :return: Future of the user record for the name, None if the name is not found
+        :rtype: Future
+        """
+        return chain(self.get_user_id_by_name(name), self.get_user_record)
+
+    def lookup(self, names, user_ids, concurrency=100):
+        """
+        Reads the records for many user names and ids with at most concurrency keys in flight.  The record for a name
+        is read as soon as its id is resolved, and each record is read once however many keys refer to it
+        :param names: list of user names
+        :param user_ids: list of uuid, None for keys that are not valid ids
+        :param concurrency: maximum number of keys in flight
+        :return: Future of (list of name records, list of id records), in the order of names and user_ids, None
+                 for keys that are not found
+        :rtype: Future
+        """
+        logger.debug('entering lookup of %d names and %d ids, concurrency: %d', len(names), len(user_ids),
+                     concurrency)
+        slots = threading.BoundedSemaphore(concurrency)
+        lock = threading.RLock()
+        records = {}
+
+        def read_record(user_id):
+            with lock:
+                if user_id not in records:
+                    records[user_id] = self.get_user_record(user_id)
+                return records[user_id]
+
+        def start(read, key):
+            # blocks the calling thread (never the driver's event loop) until a slot is free
+            slots.acquire()
+            future = read(key)
+            future.add_done_callback(lambda done: slots.release())
+            return future
+
+        name_futures = [start(lambda name: chain(self.get_user_id_by_name(name), read_record), name)
+                        for name in names]
+        id_futures = [start(read_record, user_id) for user_id in user_ids]
+        return chain(gather(name_futures + id_futures),
+                     lambda results: (results[:len(names)], results[len(names):]))
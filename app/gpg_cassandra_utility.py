@@ -7,13 +7,20 @@ Cassandra utility functions
 __author__ = "GGibson"
 
 from cassandra.cluster import Cluster
+import atexit
 import contextlib
 import logging
+import os
+import threading
 
 module = __name__
 
 logger = logging.getLogger(__name__)
 
+# token range of the Murmur3Partitioner
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
 @contextlib.contextmanager
 def get_connection(contact_points=None, keyspace=None, port=9042):
     """
@@ -29,3 +36,173 @@ def get_connection(contact_points=None, keyspace=None, port=9042):
         if session and not session.is_shutdown:
             logger.debug('shutting down connection')
             session.cluster.shutdown()
+
+
+def split_token_ranges(count):
+    """
+    Splits the full Murmur3 token ring into contiguous ranges, used to scan a table in parallel with
+    "WHERE token(key) > ? AND token(key) <= ?"
+    :param count: number of ranges
+    :return: list of (start exclusive, end inclusive) token pairs covering the ring
+    :rtype: list
+    """
+    width = (MAX_TOKEN - MIN_TOKEN) // count
+    boundaries = [MIN_TOKEN + width * i for i in range(count)] + [MAX_TOKEN]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class SessionManager(object):
+    """
+    Holds long lived Cassandra sessions for the current process so every CQL command reuses warm connections.
+    Sessions are created lazily on first use and keyed by (contact points, port, keyspace).  The driver's
+    connections and event loop threads do not survive a fork, so the sessions are dropped (not shut down) when the
+    manager is first used in a new process
+    """
+    def __init__(self, cluster_factory=Cluster):
+        self.cluster_factory = cluster_factory
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._registries = {}
+        self._pid = os.getpid()
+
+    def get_session(self, contact_points=None, keyspace=None, port=9042):
+        """
+        Returns the shared session for the contact points, port and keyspace, connecting if needed
+        :param contact_points: list of contact points
+        :param keyspace: keyspace to connect to
+        :param port: native protocol port
+        :rtype: Session
+        """
+        key = (tuple(contact_points or ()), port, keyspace)
+        self._check_pid()
+        session = self._sessions.get(key)
+        if session is not None and not session.is_shutdown:
+            return session
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.is_shutdown:
+                logger.info('creating shared session, contact_points=%s, port=%s, keyspace=%s', contact_points,
+                            port, keyspace)
+                cluster = self.cluster_factory(contact_points=contact_points, port=port)
+                session = cluster.connect(keyspace)
+                self._sessions[key] = session
+                self._registries[key] = PreparedStatementRegistry(session)
+        return session
+
+    def get_prepared_statement(self, command, contact_points=None, keyspace=None, port=9042):
+        """
+        Returns the prepared statement for the CQL command on the shared session, preparing it on first use
+        :param command: CQL command with ? bind markers
+        :rtype: PreparedStatement
+        """
+        self.get_session(contact_points=contact_points, keyspace=keyspace, port=port)
+        return self._registries[(tuple(contact_points or ()), port, keyspace)].get(command)
+
+    def session_count(self):
+        """returns the number of open shared sessions in this process"""
+        self._check_pid()
+        return len(self._sessions)
+
+    def connection_stats(self):
+        """
+        Returns the connection counts of the shared sessions in this process
+        :return: {'sessions', 'hosts' (connection pools), 'connections', 'in_flight' (requests)}
+        :rtype: dictionary
+        """
+        self._check_pid()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        stats = {'sessions': len(sessions), 'hosts': 0, 'connections': 0, 'in_flight': 0}
+        for session in sessions:
+            for pool in list(getattr(session, '_pools', {}).values()):
+                stats['hosts'] += 1
+                # HostConnection (protocol v3 and later) has one connection, HostConnectionPool has several
+                connections = getattr(pool, '_connections', None)
+                if connections is None:
+                    connections = [pool._connection] if getattr(pool, '_connection', None) else []
+                stats['connections'] += len(connections)
+                stats['in_flight'] += sum(connection.in_flight for connection in list(connections))
+        return stats
+
+    def shutdown(self):
+        """
+        Shuts down all of the shared sessions (and their clusters) owned by this process
+        """
+        with self._lock:
+            sessions = self._sessions.values() if self._pid == os.getpid() else []
+            self._sessions = {}
+            self._registries = {}
+        for session in sessions:
+            if not session.is_shutdown:
+                logger.debug('shutting down shared session: %s', session)
+                try:
+                    session.cluster.shutdown()
+                except Exception:
+                    logger.exception('failed to shut down shared session: %s', session)
+
+    def reset(self):
+        """
+        Forgets the sessions without shutting them down, call this in a child process after a fork
+        """
+        with self._lock:
+            self._sessions = {}
+            self._registries = {}
+            self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            logger.debug('process id changed from %s to %s, dropping inherited sessions', self._pid, os.getpid())
+            self.reset()
+
+
+class PreparedStatementRegistry(object):
+    """
+    Prepares each CQL command once per session and caches the PreparedStatement, so the server only parses a
+    statement the first time it is seen and later calls only bind the parameters
+    """
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def get(self, command):
+        """
+        Returns the prepared statement for a CQL command, preparing it if this is the first time it is seen
+        :param command: CQL command with ? bind markers
+        :rtype: PreparedStatement
+        """
+        statement = self._statements.get(command)
+        if statement is not None:
+            return statement
+        with self._lock:
+            statement = self._statements.get(command)
+            if statement is None:
+                logger.debug('preparing CQL command: "%s"', command)
+                statement = self.session.prepare(command)
+                self._statements[command] = statement
+        return statement
+
+    def __len__(self):
+        return len(self._statements)
+
+
+session_manager = SessionManager()
+atexit.register(session_manager.shutdown)
+
+
+def get_session(contact_points=None, keyspace=None, port=9042):
+    """
+    Returns the process wide shared session, see SessionManager.get_session
+    :rtype: Session
+    """
+    return session_manager.get_session(contact_points=contact_points, keyspace=keyspace, port=port)
+
+
+def get_prepared_statement(command, contact_points=None, keyspace=None, port=9042):
+    """
+    Returns the cached prepared statement for the command on the shared session, see
+    SessionManager.get_prepared_statement
+    :rtype: PreparedStatement
+    """
+    return session_manager.get_prepared_statement(command, contact_points=contact_points, keyspace=keyspace,
+                                                  port=port)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+In process stand in for a Cassandra cluster, used by the unit tests and the benchmark (gpg_benchmark.py)
+FakeSession answers the User CQL commands from two dicts standing in for users_tbl and users_by_name, with an optional
+latency per statement, and FakeCluster hands it to the session manager:
+    session = FakeSession(latency=0.001)
+    install(session)
+"""
+
+__author__ = "GGibson"
+
+from collections import namedtuple
+import threading
+import time
+import uuid
+
+from cassandra import InvalidRequest
+from cassandra.query import FETCH_SIZE_UNSET, named_tuple_factory, PreparedStatement, Statement
+
+from gpg_cassandra import User
+from gpg_cassandra_utility import Cluster, session_manager
+
+UserRow = namedtuple('UserRow', ['id', 'name', 'description', 'owner', 'owner_email', 'notes', 'is_domain',
+                                 'domain'])
+IdRow = namedtuple('IdRow', ['id'])
+NameRow = namedtuple('NameRow', ['name'])
+IdNameRow = namedtuple('IdNameRow', ['id', 'name'])
+AppliedRow = namedtuple('AppliedRow', ['applied'])
+APPLIED = [AppliedRow(True)]
+NOT_APPLIED = [AppliedRow(False)]
+
+
+def fake_token(user_id):
+    """a stand in for the Murmur3 token of a uuid partition key"""
+    return (user_id.int >> 64) - 2 ** 63
+
+
+class FakeResult(list):
+    """list of rows with the LWT was_applied flag and paging state of a Cassandra ResultSet"""
+    def __init__(self, rows=(), paging_state=None):
+        super(FakeResult, self).__init__(rows)
+        self.paging_state = paging_state
+
+    @property
+    def current_rows(self):
+        return self
+
+    @property
+    def was_applied(self):
+        return self[0][0]
+
+
+class FakeFuture(object):
+    """
+    the parts of a ResponseFuture used by execute_concurrent and gpg_cassandra_async.  Without latency the callbacks
+    run straight away, with latency they run on a timer thread, like the driver's event loop thread
+    """
+    row_factory = staticmethod(named_tuple_factory)
+    has_more_pages = False
+    _col_names = None
+
+    def __init__(self, rows=None, error=None, latency=0):
+        self.rows = rows
+        self.error = error
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if latency:
+            timer = threading.Timer(latency, self._complete)
+            timer.daemon = True
+            timer.start()
+        else:
+            self._done.set()
+
+    def _complete(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callbacks_and_args in callbacks:
+            self._run_callback(*callbacks_and_args)
+
+    def _run_callback(self, callback, errback, callback_args, errback_args):
+        if self.error:
+            errback(self.error, *errback_args)
+        else:
+            callback(self.rows, *callback_args)
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, errback, callback_args, errback_args))
+                return
+        self._run_callback(callback, errback, callback_args, errback_args)
+
+    def clear_callbacks(self):
+        with self._lock:
+            self._callbacks = []
+
+    def result(self):
+        self._done.wait()
+        if self.error:
+            raise self.error
+        return FakeResult(self.rows)
+
+
+class FakeTracedFuture(object):
+    """the response future of a statement run with trace=True"""
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+
+    def get_query_trace_ids(self):
+        return [self.trace_id]
+
+
+class FakePrepared(PreparedStatement):
+    def __init__(self, query_string):
+        self.query_string = query_string
+        self.query_id = query_string
+
+    def bind(self, values):
+        return FakeBound(self, values)
+
+
+class FakeBound(Statement):
+    def __init__(self, prepared_statement, values):
+        super(FakeBound, self).__init__()
+        self.prepared_statement = prepared_statement
+        self.values = values
+        self.fetch_size = prepared_statement.fetch_size
+
+
+class FakeSession(object):
+    """
+    Answers the User CQL commands from two dicts standing in for users_tbl and users_by_name, and records every
+    statement executed.  Each statement takes latency seconds
+    """
+    is_shutdown = False
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.users = {}
+        self.users_by_name = {}
+        self.executed = []
+
+    def add_user(self, row):
+        """adds a UserRow to both tables"""
+        self.users[row.id] = row
+        self.users_by_name[row.name] = row.id
+
+    def prepare(self, command):
+        return FakePrepared(command)
+
+    def execute(self, statement, parameters=None, paging_state=None, trace=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._execute(statement, parameters, paging_state, trace)
+
+    def execute_async(self, statement, parameters=None, timeout=None):
+        try:
+            return FakeFuture(list(self._execute(statement, parameters)), latency=self.latency)
+        except Exception as e:
+            return FakeFuture(error=e, latency=self.latency)
+
+    def _execute(self, statement, parameters=None, paging_state=None, trace=False):
+        fetch_size = getattr(statement, 'fetch_size', FETCH_SIZE_UNSET)
+        if isinstance(statement, FakeBound):
+            statement, parameters = statement.prepared_statement, statement.values
+        command = getattr(statement, 'query_string', statement)
+        self.executed.append(command)
+        result = self._run(command, parameters or ())
+        if fetch_size not in (None, FETCH_SIZE_UNSET):
+            # the paging state is the offset of the next page
+            try:
+                start = int(paging_state or 0)
+            except ValueError:
+                raise InvalidRequest('Invalid value for the paging state')
+            end = start + fetch_size
+            result = FakeResult(result[start:end], paging_state=str(end) if end < len(result) else None)
+        if trace:
+            result.response_future = FakeTracedFuture(uuid.uuid4())
+        return result
+
+    def _run(self, command, parameters):
+        if command == User.USER_ID_BY_NAME_COMMAND:
+            user_id = self.users_by_name.get(parameters[0])
+            return FakeResult([IdRow(user_id)] if user_id else [])
+        if command == User.CLAIM_USER_NAME_COMMAND:
+            if parameters[0] in self.users_by_name:
+                return FakeResult(NOT_APPLIED)
+            self.users_by_name[parameters[0]] = parameters[1]
+            return FakeResult(APPLIED)
+        if command == User.RELEASE_USER_NAME_COMMAND:
+            if self.users_by_name.get(parameters[0]) != parameters[1]:
+                return FakeResult(NOT_APPLIED)
+            del self.users_by_name[parameters[0]]
+            return FakeResult(APPLIED)
+        if command == User.CREATE_USER_COMMAND:
+            if parameters[0] in self.users:
+                return FakeResult(NOT_APPLIED)
+            self.users[parameters[0]] = UserRow(*parameters)
+            return FakeResult(APPLIED)
+        if command == User.USER_DETAILS_COMMAND:
+            return FakeResult([self.users[parameters[0]]] if parameters[0] in self.users else [])
+        if command == User.USER_NAME_BY_ID_COMMAND:
+            return FakeResult([NameRow(self.users[parameters[0]].name)] if parameters[0] in self.users else [])
+        if command == User.USERS_COMMAND:
+            return FakeResult(sorted(IdNameRow(user.id, user.name) for user in self.users.values()))
+        if command == User.USERS_TOKEN_RANGE_COMMAND:
+            return FakeResult(sorted(user for user in self.users.values()
+                                     if parameters[0] < fake_token(user.id) <= parameters[1]))
+        if command == User.DELETE_USER_COMMAND:
+            self.users.pop(parameters[0], None)
+            return FakeResult()
+        if command.startswith('UPDATE {0} SET '.format(User.USERS_TABLE)):
+            columns = [column.split('=')[0] for column in command.split(' SET ')[1].split(' WHERE ')[0].split(', ')]
+            user_id = parameters[-1]
+            if user_id not in self.users:
+                return FakeResult(NOT_APPLIED)
+            self.users[user_id] = self.users[user_id]._replace(**dict(zip(columns, parameters)))
+            return FakeResult(APPLIED)
+        raise AssertionError('unexpected CQL command: {0}'.format(command))
+
+
+class FakeCluster(object):
+    session = None
+
+    def __init__(self, contact_points=None, port=None):
+        pass
+
+    def connect(self, keyspace=None):
+        return FakeCluster.session
+
+
+def install(session):
+    """makes the session manager hand out session for every contact point"""
+    FakeCluster.session = session
+    session_manager.reset()
+    session_manager.cluster_factory = FakeCluster
+
+
+def uninstall():
+    """puts the real Cluster back"""
+    session_manager.reset()
+    session_manager.cluster_factory = Cluster
+    FakeCluster.session = None
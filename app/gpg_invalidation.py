@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Cache invalidation bus, so an update or delete handled by one app instance evicts the user from the caches of every
+other instance (and every worker process)
+Implementations:
+    LocalInvalidationBus - in process only, for tests and single process deployments
+    UdpInvalidationBus - udp multicast, every subscribed process on the network receives every message
+    FileInvalidationBus - messages appended to a shared file that every subscriber tails, for tests and hosts
+                          sharing a volume
+environment variable:
+    cache_invalidation_bus - udp://<multicast group>:<port>, file://<path> or empty for no bus (the default)
+"""
+
+__author__ = "GGibson"
+
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationBus(object):
+    """
+    interface for invalidation buses.  Messages published by a bus are not delivered back to the same bus, the
+    publisher has already invalidated its own cache
+    """
+
+    def __init__(self):
+        self._origin = None
+        self._origin_pid = None
+        self._callbacks = []
+
+    @property
+    def origin(self):
+        """
+        the id of this bus in the messages it sends, new in each process: workers forked from a master that built the
+        bus (preload_app) must not drop each other's messages as their own
+        """
+        if self._origin_pid != os.getpid():
+            self._origin = str(uuid.uuid4())
+            self._origin_pid = os.getpid()
+        return self._origin
+
+    def publish(self, name=None, user_id=None):
+        """sends an invalidation for the user name and/or id to the other subscribers"""
+        raise NotImplementedError('publish must be implemented on the child class')
+
+    def subscribe(self, callback):
+        """
+        Registers a callback for invalidations from other publishers
+        :param callback: function(name, user_id)
+        """
+        self._callbacks.append(callback)
+        self.start()
+
+    def start(self):
+        """starts receiving messages in this process if it is not already, safe to call after a fork"""
+        pass
+
+    def close(self):
+        """stops receiving messages"""
+        pass
+
+    def _encode(self, name, user_id):
+        return json.dumps({'origin': self.origin, 'name': name, 'user_id': str(user_id) if user_id else None})
+
+    def _deliver(self, data):
+        """decodes a message and passes it to the callbacks, unless this bus sent it"""
+        try:
+            message = json.loads(data)
+            if message['origin'] == self.origin:
+                return
+            name, user_id = message['name'], message['user_id']
+        except (ValueError, KeyError, TypeError):
+            logger.warning('ignoring invalid cache invalidation message: %r', data)
+            return
+        logger.debug('received cache invalidation, name: "%s", id: %s', name, user_id)
+        for callback in self._callbacks:
+            try:
+                callback(name, user_id)
+            except Exception:
+                logger.exception('cache invalidation callback failed')
+
+
+class LocalInvalidationBus(InvalidationBus):
+    """
+    Delivers messages to the other LocalInvalidationBus instances of the same channel in this process
+    """
+    _channels = {}
+
+    def __init__(self, channel='default'):
+        super(LocalInvalidationBus, self).__init__()
+        LocalInvalidationBus._channels.setdefault(channel, []).append(self)
+        self.channel = channel
+
+    def publish(self, name=None, user_id=None):
+        data = self._encode(name, user_id)
+        for bus in LocalInvalidationBus._channels[self.channel]:
+            bus._deliver(data)
+
+    def close(self):
+        LocalInvalidationBus._channels[self.channel].remove(self)
+
+
+class _ThreadedInvalidationBus(InvalidationBus):
+    """
+    base for buses with a receiver thread, the thread is (re)started in each process that uses the bus because
+    threads do not survive a fork
+    """
+
+    def __init__(self):
+        super(_ThreadedInvalidationBus, self).__init__()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._pid == os.getpid() or not self._callbacks:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._open_receiver()
+            self._thread = threading.Thread(target=self._receive, args=(self._stop,),
+                                            name='cache-invalidation-{0}'.format(type(self).__name__))
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+            logger.info('started cache invalidation receiver: %s in process: %s', self, self._pid)
+
+    def close(self):
+        self._stop.set()
+        if self._thread and self._pid == os.getpid():
+            self._thread.join(UdpInvalidationBus.RECEIVE_TIMEOUT * 2)
+        self._pid = None
+
+    def _open_receiver(self):
+        raise NotImplementedError('_open_receiver must be implemented on the child class')
+
+    def _receive(self, stop):
+        raise NotImplementedError('_receive must be implemented on the child class')
+
+
+class UdpInvalidationBus(_ThreadedInvalidationBus):
+    """
+    Sends each invalidation as one udp multicast datagram.  Every process subscribed to the group and port
+    receives it, including other worker processes on the same host
+    """
+    RECEIVE_TIMEOUT = 1.0
+
+    def __init__(self, group, port, multicast_ttl=1):
+        super(UdpInvalidationBus, self).__init__()
+        self.group = group
+        self.port = port
+        self.multicast_ttl = multicast_ttl
+        self._send_socket = None
+        self._send_pid = None
+        self._receive_socket = None
+
+    def publish(self, name=None, user_id=None):
+        if self._send_pid != os.getpid():
+            self._send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self._send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            self._send_pid = os.getpid()
+        try:
+            self._send_socket.sendto(self._encode(name, user_id).encode('utf-8'), (self.group, self.port))
+        except socket.error:
+            logger.exception('failed to publish cache invalidation to %s:%s', self.group, self.port)
+
+    def _open_receiver(self):
+        receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            receive_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        receive_socket.bind(('', self.port))
+        membership = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+        receive_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        receive_socket.settimeout(UdpInvalidationBus.RECEIVE_TIMEOUT)
+        self._receive_socket = receive_socket
+
+    def _receive(self, stop):
+        receive_socket = self._receive_socket
+        while not stop.is_set():
+            try:
+                data = receive_socket.recv(65535)
+            except socket.timeout:
+                continue
+            except socket.error:
+                logger.exception('failed to receive cache invalidation')
+                continue
+            self._deliver(data.decode('utf-8'))
+        receive_socket.close()
+
+    def __str__(self):
+        return 'udp://{0}:{1}'.format(self.group, self.port)
+
+
+class FileInvalidationBus(_ThreadedInvalidationBus):
+    """
+    Appends each invalidation as a line to a shared file, subscribers poll the file for lines added since they
+    started
+    """
+
+    def __init__(self, path, poll_interval=0.1):
+        super(FileInvalidationBus, self).__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self._offset = 0
+
+    def publish(self, name=None, user_id=None):
+        try:
+            # a single write of a short line to a file opened for append is not interleaved with other writers
+            with open(self.path, 'a') as bus_file:
+                bus_file.write(self._encode(name, user_id) + '\n')
+        except EnvironmentError:
+            logger.exception('failed to publish cache invalidation to: "%s"', self.path)
+
+    def _open_receiver(self):
+        self._offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _receive(self, stop):
+        partial = ''
+        while not stop.wait(self.poll_interval):
+            try:
+                if not os.path.exists(self.path):
+                    continue
+                with open(self.path) as bus_file:
+                    bus_file.seek(self._offset)
+                    data = bus_file.read()
+            except EnvironmentError:
+                logger.exception('failed to read cache invalidations from: "%s"', self.path)
+                continue
+            self._offset += len(data)
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                if line:
+                    self._deliver(line)
+
+    def __str__(self):
+        return 'file://{0}'.format(self.path)
+
+
+def return_bus_from_environment():
+    """
+    Creates the bus named by the cache_invalidation_bus environment variable
+    :return: the bus or None if no bus is configured
+    :rtype: InvalidationBus
+    """
+    bus_url = os.environ.get('cache_invalidation_bus')
+    if not bus_url:
+        return None
+    if bus_url.startswith('udp://'):
+        group, port = bus_url[len('udp://'):].rsplit(':', 1)
+        return UdpInvalidationBus(group, int(port))
+    if bus_url.startswith('file://'):
+        return FileInvalidationBus(bus_url[len('file://'):])
+    if bus_url == 'local':
+        return LocalInvalidationBus()
+    raise ValueError('unsupported cache_invalidation_bus: "{0}"'.format(bus_url))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Streaming reader for Json documents that are an object with one large array, e.g. the users document of gpg_user.py.
+The document is read in chunks and each item of the array is decoded and handed over on its own, so loading needs
+memory for one chunk and one item at a time rather than for the whole file, its decoded text and every parsed item
+"""
+
+__author__ = "GGibson"
+
+import codecs
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Reader(object):
+    """decoded text of the file, read a chunk at a time, with the position reached"""
+
+    def __init__(self, json_file, chunk_size):
+        self._file = json_file
+        self._chunk_size = chunk_size
+        # works with or without a BOM
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        # the scanner json.loads uses, it decodes one value starting at an index
+        self._scan = json.JSONDecoder().scan_once
+        self.text = u''
+        self.position = 0
+        self.eof = False
+
+    def read(self):
+        """:return: False at the end of the file"""
+        if self.eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        self.eof = not chunk
+        # drop the text already parsed so the buffer stays around a chunk long
+        self.text = self.text[self.position:] + self._decoder.decode(chunk, self.eof)
+        self.position = 0
+        return True
+
+    def next_character(self):
+        """
+        :return: the next character that is not whitespace, which stays unread, or None at the end of the file
+        """
+        while True:
+            self.position = WHITESPACE.match(self.text, self.position).end()
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.read():
+                return None
+
+    def expect(self, characters):
+        """
+        Reads one of characters, after any whitespace
+        :return: the character read
+        :raise ValueError if the next character is not one of characters
+        """
+        character = self.next_character()
+        if character is None or character not in characters:
+            raise ValueError('expected one of: {0} at: {1}, found: {2!r}'.format(
+                characters, self.position, character))
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decodes the next value, reading more of the file until it is complete.  A value ending at the end of the text
+        read so far may continue in the next chunk (a number), so it is decoded again with more text
+        :raise ValueError if the value cannot be decoded
+        """
+        self.next_character()
+        while True:
+            try:
+                value, end = self._scan(self.text, self.position)
+            except (StopIteration, ValueError):
+                if not self.read():
+                    raise ValueError('failed to decode the value at: {0}'.format(self.position))
+                continue
+            if end < len(self.text) or not self.read():
+                self.position = end
+                return value
+
+
+def iter_object(json_file, stream_key, chunk_size=CHUNK_SIZE):
+    """
+    Reads a Json object a chunk at a time
+    :param json_file: file object opened in binary mode, utf-8 with or without a BOM
+    :param stream_key: key of the array whose items are yielded one at a time
+    :param chunk_size: bytes read at a time
+    :return: generator of (key, value) for each member of the object, except (stream_key, item) for each item of the
+             stream_key array
+    :raise ValueError if the document is not a Json object or cannot be parsed
+    """
+    reader = _Reader(json_file, chunk_size)
+    reader.expect('{')
+    if reader.next_character() == '}':
+        reader.position += 1
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, basestring):
+            raise ValueError('expected a key at: {0}, found: {1!r}'.format(reader.position, key))
+        reader.expect(':')
+        if key == stream_key and reader.next_character() == '[':
+            reader.position += 1
+            if reader.next_character() == ']':
+                reader.position += 1
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            break
+    if reader.next_character() is not None:
+        raise ValueError('extra data after the Json object at: {0}'.format(reader.position))
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+HTTP load generator for a running instance of the app, replaying a weighted mix of the CRUD calls:
+    get_users    GET /users
+    get_user     GET /user/<name>
+    update_user  PUT /user/<name>
+    create_user  POST /user
+    delete_user  DELETE /user/<name> (deletes a user created by create_user, skipped if there is none)
+With --rate the requests are sent open loop: request i is due at start + i / rate whether or not earlier requests have
+completed, and its latency is measured from when it was due, so a slow server shows up as queueing in the latency
+instead of lowering the request rate (coordinated omission).  With --concurrency each connection sends its next request
+when the last one completes (closed loop), which finds the maximum throughput but understates the latency under load.
+The users read and updated are created before the run and deleted after it.  Reports the latency percentiles, rate and
+error rate per call as json
+usage: python gpg_load_generator.py http://10.158.15.138:5005 --rate 200 --duration 60
+       python gpg_load_generator.py http://10.158.15.138:5005 --concurrency 32 --mix get_user=90,update_user=10
+"""
+
+__author__ = "GGibson"
+
+import argparse
+from collections import deque
+import httplib
+import json
+import logging
+import Queue
+import random
+import socket
+import sys
+import threading
+import time
+from timeit import default_timer
+import urlparse
+import uuid
+
+from gpg_stats import return_percentile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIX = 'get_users=5,get_user=65,update_user=10,create_user=10,delete_user=10'
+ENDPOINTS = {'get_users': 'GET /users',
+             'get_user': 'GET /user/<name>',
+             'update_user': 'PUT /user/<name>',
+             'create_user': 'POST /user',
+             'delete_user': 'DELETE /user/<name>'}
+PERCENTILES = (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('p999_ms', 0.999))
+SEED_CHUNK_SIZE = 500
+
+
+class LoadError(Exception):
+    """the load could not be generated, e.g. the users could not be created"""
+
+
+def parse_mix(mix):
+    """
+    :param mix: comma separated call=weight, e.g. get_user=90,update_user=10
+    :return: list of (call, weight)
+    :rtype: list
+    :raise ValueError if a call is unknown or a weight is not a positive number
+    """
+    weights = []
+    for item in mix.split(','):
+        if not item.strip():
+            continue
+        call, separator, weight = item.partition('=')
+        call = call.strip()
+        if call not in ENDPOINTS:
+            raise ValueError('unknown call: "{0}", expected one of {1}'.format(call, ', '.join(sorted(ENDPOINTS))))
+        try:
+            weight = float(weight) if separator else 1.0
+        except ValueError:
+            raise ValueError('weight of call: "{0}" is not a number: "{1}"'.format(call, weight))
+        if weight <= 0:
+            raise ValueError('weight of call: "{0}" must be positive'.format(call))
+        weights.append((call, weight))
+    if not weights:
+        raise ValueError('the mix has no calls')
+    return weights
+
+
+class UserNames(object):
+    """the names the calls use: seeded users are read and updated, created users are the ones deleted"""
+
+    def __init__(self, seeded, prefix, random_source=random):
+        self.seeded = list(seeded)
+        self.prefix = prefix
+        self.random = random_source
+        self._created = deque()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def existing(self):
+        return self.random.choice(self.seeded)
+
+    def new(self):
+        with self._lock:
+            self._count += 1
+            return '{0}-{1}'.format(self.prefix, self._count)
+
+    def created(self, name):
+        self._created.append(name)
+
+    def take_created(self):
+        """:return: a name created during the run, None if there is none left"""
+        try:
+            return self._created.popleft()
+        except IndexError:
+            return None
+
+    def remaining_created(self):
+        return list(self._created)
+
+
+def return_user_json(name):
+    return {'name': name, 'description': 'load test user', 'owner': 'load test', 'owner_email': 'load@my.com',
+            'notes': 'created by gpg_load_generator', 'is_domain': False, 'domain': 'load.my.com'}
+
+
+def return_request(call, names):
+    """
+    :param call: call in the mix, e.g. get_user
+    :param names: UserNames
+    :return: (method, path, json body or None), None if the call cannot be made (no created user to delete)
+    """
+    if call == 'get_users':
+        return 'GET', '/users', None
+    if call == 'get_user':
+        return 'GET', '/user/' + names.existing(), None
+    if call == 'update_user':
+        return 'PUT', '/user/' + names.existing(), {'description': 'updated {0}'.format(time.time())}
+    if call == 'create_user':
+        return 'POST', '/user', return_user_json(names.new())
+    name = names.take_created()
+    if name is None:
+        return None
+    return 'DELETE', '/user/' + name, None
+
+
+class Client(object):
+    """one keep-alive connection to the app, reconnected after an error"""
+
+    def __init__(self, url, timeout=30):
+        parsed = urlparse.urlparse(url)
+        self.connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        """
+        :return: (status code, response body)
+        :raise httplib.HTTPException, socket.error
+        """
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        headers = {'Connection': 'keep-alive'}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, self.base_path + path, data, headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class LoadGenerator(object):
+    """sends the mix to the app open loop (rate) or closed loop (concurrency) and records the result of each call"""
+
+    def __init__(self, url, mix=DEFAULT_MIX, rate=None, concurrency=None, duration=60, connections=64, users=100,
+                 timeout=30, random_source=None):
+        """
+        :param url: base url of the app, e.g. http://10.158.15.138:5005
+        :param mix: see parse_mix
+        :param rate: requests per second, open loop
+        :param concurrency: requests in flight, closed loop (used if rate is not set)
+        :param duration: seconds to send requests for
+        :param connections: open loop, connections (threads) sending the requests that are due, the requests queue
+                            once they are all busy
+        :param users: users created before the run for the reads and updates
+        :param timeout: seconds to wait for a response
+        :param random_source: random.Random, for a repeatable sequence of calls
+        """
+        if not rate and not concurrency:
+            raise ValueError('a rate or a concurrency is required')
+        self.url = url
+        self.mix = parse_mix(mix)
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.connections = connections
+        self.users = users
+        self.timeout = timeout
+        self.random = random_source or random.Random()
+        self.prefix = 'load-{0}'.format(uuid.uuid4().hex[:8])
+        self.names = None
+        self.results = []
+        self.skipped = 0
+        self.max_schedule_lag = 0.0
+        self._lock = threading.Lock()
+        self._calls = [call for call, weight in self.mix]
+        total = sum(weight for call, weight in self.mix)
+        self._cumulative = []
+        running = 0.0
+        for call, weight in self.mix:
+            running += weight / total
+            self._cumulative.append(running)
+
+    def run(self):
+        """
+        creates the users, sends the load, deletes the users
+        :return: report, see return_report
+        :rtype: dict
+        :raise LoadError if the users cannot be created
+        """
+        client = Client(self.url, self.timeout)
+        try:
+            self.names = UserNames(self._seed_users(client), self.prefix + '-created', self.random)
+            logger.info('sending load to: %s, mix: %s, rate: %s, concurrency: %s, duration: %ss', self.url, self.mix,
+                        self.rate, self.concurrency, self.duration)
+            start = default_timer()
+            if self.rate:
+                self._run_open_loop()
+            else:
+                self._run_closed_loop()
+            elapsed = default_timer() - start
+            self._delete_users(client, self.names.seeded + self.names.remaining_created())
+        finally:
+            client.close()
+        return self.return_report(elapsed)
+
+    def _choose_call(self):
+        value = self.random.random()
+        for call, cumulative in zip(self._calls, self._cumulative):
+            if value < cumulative:
+                return call
+        return self._calls[-1]
+
+    def _seed_users(self, client):
+        names = ['{0}-seed-{1}'.format(self.prefix, i) for i in range(self.users)]
+        for start in range(0, len(names), SEED_CHUNK_SIZE):
+            try:
+                status, body = client.request('POST', '/users/bulk', [return_user_json(name)
+                                                                      for name in names[start:start + SEED_CHUNK_SIZE]])
+            except (socket.error, httplib.HTTPException) as e:
+                raise LoadError('cannot connect to: {0}, error: {1}'.format(self.url, e))
+            if status != 200:
+                raise LoadError('cannot create the load test users, status: {0}, response: {1}'.format(status, body))
+        return names
+
+    def _delete_users(self, client, names):
+        for name in names:
+            try:
+                client.request('DELETE', '/user/' + name)
+            except Exception as e:
+                logger.warning('cannot delete load test user: %s, error: %s', name, e)
+
+    def _send(self, client, call, start):
+        """
+        sends one call and records it
+        :param start: timer value the latency is measured from, when the request was due (open loop) or sent
+        """
+        request = return_request(call, self.names)
+        if request is None:
+            with self._lock:
+                self.skipped += 1
+            return
+        method, path, body = request
+        try:
+            status, response = client.request(method, path, body)
+            error = None
+        except Exception as e:
+            status, error = None, type(e).__name__
+        latency = default_timer() - start
+        if call == 'create_user' and status == 201:
+            self.names.created(body['name'])
+        with self._lock:
+            self.results.append((call, status, error, latency))
+
+    def _run_open_loop(self):
+        due = Queue.Queue()
+
+        def work():
+            client = Client(self.url, self.timeout)
+            try:
+                while True:
+                    item = due.get()
+                    if item is None:
+                        return
+                    self._send(client, *item)
+            finally:
+                client.close()
+
+        workers = [threading.Thread(target=work, name='load-{0}'.format(i)) for i in range(self.connections)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        interval = 1.0 / self.rate
+        start = default_timer()
+        i = 0
+        while True:
+            scheduled = start + i * interval
+            if scheduled - start >= self.duration:
+                break
+            delay = scheduled - default_timer()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.max_schedule_lag = max(self.max_schedule_lag, -delay)
+            due.put((self._choose_call(), scheduled))
+            i += 1
+        for worker in workers:
+            due.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _run_closed_loop(self):
+        end = default_timer() + self.duration
+
+        def work():
+            client = Client(self.url, self.timeout)
+            try:
+                while default_timer() < end:
+                    self._send(client, self._choose_call(), default_timer())
+            finally:
+                client.close()
+
+        workers = [threading.Thread(target=work, name='load-{0}'.format(i)) for i in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def return_report(self, elapsed):
+        """
+        :param elapsed: seconds the load ran for
+        :return: {'meta': {...}, 'calls': {call: {'endpoint', 'requests', 'errors', 'error_rate', 'rate', 'mean_ms',
+                 'p50_ms', 'p90_ms', 'p99_ms', 'p999_ms', 'max_ms'}}, 'total': {...}}.  A call is an error if it
+                 returned a 4xx or 5xx status or failed to get a response
+        :rtype: dict
+        """
+        by_call = {}
+        for result in self.results:
+            by_call.setdefault(result[0], []).append(result)
+        calls = dict((call, self._return_summary(results, elapsed)) for call, results in by_call.items())
+        for call, summary in calls.items():
+            summary['endpoint'] = ENDPOINTS[call]
+        meta = {'url': self.url, 'mix': dict(self.mix), 'rate': self.rate, 'concurrency': self.concurrency,
+                'duration': self.duration, 'elapsed': round(elapsed, 3), 'users': self.users,
+                'skipped': self.skipped, 'loop': 'open' if self.rate else 'closed'}
+        if self.rate:
+            # the generator itself could not keep up if this is more than a few milliseconds
+            meta['max_schedule_lag_ms'] = round(self.max_schedule_lag * 1000, 3)
+            meta['connections'] = self.connections
+        return {'meta': meta, 'calls': calls, 'total': self._return_summary(self.results, elapsed)}
+
+    @staticmethod
+    def _return_summary(results, elapsed):
+        latencies = sorted(result[3] for result in results)
+        errors = sum(1 for call, status, error, latency in results if error or status >= 400)
+        errors_by_kind = {}
+        for call, status, error, latency in results:
+            if error or status >= 400:
+                kind = error or str(status)
+                errors_by_kind[kind] = errors_by_kind.get(kind, 0) + 1
+        summary = {'requests': len(results), 'errors': errors, 'errors_by_kind': errors_by_kind,
+                   'error_rate': round(float(errors) / len(results), 4) if results else None,
+                   'rate': round(len(results) / elapsed, 1) if elapsed else None,
+                   'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                   'max_ms': round(latencies[-1] * 1000, 3) if latencies else None}
+        for key, fraction in PERCENTILES:
+            summary[key] = round(return_percentile(latencies, fraction) * 1000, 3) if latencies else None
+        return summary
+
+
+def return_table(report):
+    """:return: the report as a text table"""
+    columns = ('requests', 'rate', 'error_rate', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'p999_ms', 'max_ms')
+    rows = [(ENDPOINTS[call], summary) for call, summary in sorted(report['calls'].items())]
+    rows.append(('total', report['total']))
+    lines = ['{0:<22}'.format('endpoint') + ''.join('{0:>{1}}'.format(column, len(column) + 2) for column in columns)]
+    for name, summary in rows:
+        lines.append('{0:<22}'.format(name) + ''.join('{0:>{1}}'.format(summary[column], len(column) + 2)
+                                                      for column in columns))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='send a mix of the CRUD calls to the app and report the latency')
+    parser.add_argument('url', help='base url of the app, e.g. http://10.158.15.138:5005')
+    load = parser.add_mutually_exclusive_group(required=True)
+    load.add_argument('--rate', type=float, help='requests per second, sent open loop')
+    load.add_argument('--concurrency', type=int, help='requests in flight, sent closed loop')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='comma separated call=weight, default: ' + DEFAULT_MIX)
+    parser.add_argument('--duration', type=float, default=60, help='seconds to send requests for')
+    parser.add_argument('--connections', type=int, default=64,
+                        help='open loop, connections sending the requests that are due')
+    parser.add_argument('--users', type=int, default=100, help='users created for the reads and updates')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a response')
+    parser.add_argument('--seed', type=int, help='random seed, for a repeatable sequence of calls')
+    parser.add_argument('--output', help='file to write the json report to, defaults to stdout')
+    options = parser.parse_args(args)
+    try:
+        generator = LoadGenerator(options.url, options.mix, options.rate, options.concurrency, options.duration,
+                                  options.connections, options.users, options.timeout, random.Random(options.seed))
+        report = generator.run()
+    except (ValueError, LoadError) as e:
+        sys.stderr.write('{0}\n'.format(e))
+        return 2
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    sys.stderr.write(return_table(report) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    sys.exit(main())
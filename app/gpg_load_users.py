@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Loads users into the users keyspace from a json array or newline delimited json file
+Writes the result for each user as newline delimited json to stdout and exits with 1 if any user failed to load
+usage: python gpg_load_users.py users.ndjson [--format ndjson|json] [--concurrency 100] [--chunk-size 1000]
+       cat users.ndjson | python gpg_load_users.py -
+"""
+
+__author__ = "GGibson"
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import gpg_bulk
+import gpg_setup_logger
+
+module = __name__
+
+log_file_name, module = gpg_setup_logger.create_log_file_name_and_module(__file__, __package__)
+gpg_setup_logger.setup_logger('/var/log/gpg', log_file_name, module=module, log_level=logging.INFO,
+                              use_console_logger=False)
+logger = logging.getLogger(module)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='load users from a json array or newline delimited json file')
+    parser.add_argument('file', help='file to load, - for stdin')
+    parser.add_argument('--format', choices=('ndjson', 'json'),
+                        help='file format, defaults to json for .json files and ndjson otherwise')
+    parser.add_argument('--contact-points', default=os.environ.get('contact_points'),
+                        help='comma separated Cassandra contact points, defaults to the contact_points env var')
+    parser.add_argument('--concurrency', type=int, default=100, help='number of writes in flight')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of users read and written together')
+    options = parser.parse_args(args)
+    if not options.contact_points:
+        parser.error('no contact points provided, use --contact-points or set contact_points')
+    os.environ['contact_points'] = options.contact_points
+    file_format = options.format or ('json' if options.file.endswith('.json') else 'ndjson')
+
+    logger.info('loading users from: "%s", format: %s', options.file, file_format)
+    users_file = sys.stdin if options.file == '-' else open(options.file)
+    created = failed = 0
+    try:
+        if file_format == 'ndjson':
+            records = gpg_bulk.iter_ndjson(users_file)
+        else:
+            try:
+                records = gpg_bulk.iter_json_array(users_file.read())
+            except gpg_bulk.BulkRecordError as e:
+                logger.error('cannot load users from: "%s", error: %s', options.file, e)
+                sys.stderr.write('{0}\n'.format(e))
+                return 2
+        for result in gpg_bulk.load_users(records, options.concurrency, options.chunk_size):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            if result['status'] == gpg_bulk.CREATED:
+                created += 1
+            else:
+                failed += 1
+    finally:
+        if users_file is not sys.stdin:
+            users_file.close()
+    logger.info('completed loading users from: "%s", created: %d, failed: %d', options.file, created, failed)
+    sys.stderr.write('created: {0}, failed: {1}\n'.format(created, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+In process metrics (counters, histograms and gauges read from a function) rendered in the Prometheus text format
+for GET /metrics
+Recording is lock free on the hot path: each thread updates its own shard of a metric, the shards are only summed
+when the metrics are rendered.  Every worker process has its own metrics, a scrape reports the worker that served it
+"""
+
+__author__ = "GGibson"
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# seconds, from 1ms (a cached read) to 10s (an export page)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _return_header(metric):
+    return ['# HELP {0} {1}'.format(metric.name, metric.help_text),
+            '# TYPE {0} {1}'.format(metric.name, metric.metric_type)]
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardedMetric(object):
+    """
+    base for metrics recorded per thread: a thread only writes to its own shard (a dictionary of label values to
+    value), the lock is only taken when a thread records for the first time
+    """
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _merged(self):
+        """:return: dictionary of label values to the shard values, one list per label values"""
+        with self._lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            # copied first, the owning thread can add label values while this runs
+            for labels, value in list(shard.items()):
+                merged.setdefault(labels, []).append(value)
+        return merged
+
+    def render(self):
+        """:return: the metric in the Prometheus text format"""
+        lines = _return_header(self)
+        for labels, values in sorted(self._merged().items()):
+            lines.extend(self._render_samples(labels, values))
+        return '\n'.join(lines)
+
+    def _render_samples(self, labels, values):
+        raise NotImplementedError('_render_samples must be implemented on the child class')
+
+
+class Counter(_ShardedMetric):
+    metric_type = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        """
+        :param label_values: tuple of values, in the order of label_names
+        """
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def value(self, label_values=()):
+        return sum(self._merged().get(label_values, []))
+
+    def _render_samples(self, labels, values):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(self.label_names, labels), _format_value(sum(values)))]
+
+
+class Histogram(_ShardedMetric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, label_values, value):
+        """
+        :param label_values: tuple of values, in the order of label_names
+        :param value: observation, e.g. a duration in seconds
+        """
+        shard = self._shard()
+        counts = shard.get(label_values)
+        if counts is None:
+            # a count per bucket (not cumulative), then +Inf, then the sum
+            counts = shard[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, label_values=()):
+        return sum(sum(counts[:-1]) for counts in self._merged().get(label_values, []))
+
+    def total_count(self):
+        """:return: the number of observations for every label value"""
+        return sum(sum(counts[:-1]) for values in self._merged().values() for counts in values)
+
+    def _render_samples(self, labels, values):
+        totals = [sum(column) for column in zip(*values)]
+        lines = []
+        cumulative = 0
+        for upper, count in zip(self.buckets + (float('inf'),), totals[:-1]):
+            cumulative += count
+            lines.append('{0}_bucket{1} {2}'.format(
+                self.name, _format_labels(self.label_names, labels, [('le', _format_value(upper))]), cumulative))
+        label_text = _format_labels(self.label_names, labels)
+        lines.append('{0}_sum{1} {2}'.format(self.name, label_text, _format_value(totals[-1])))
+        lines.append('{0}_count{1} {2}'.format(self.name, label_text, cumulative))
+        return lines
+
+
+class FunctionMetric(object):
+    """
+    A metric read from a function when the metrics are rendered, for values that are already counted elsewhere
+    (cache stats, open sessions, dropped log records)
+    """
+
+    def __init__(self, name, help_text, function, label_names=(), metric_type='gauge'):
+        """
+        :param function: returns a number, or a dictionary of label values to number if label_names are set
+        """
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.label_names = tuple(label_names)
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = _return_header(self)
+        try:
+            values = self.function()
+        except Exception:
+            logger.exception('failed to read metric: %s', self.name)
+            return '\n'.join(lines)
+        if not self.label_names:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.label_names, labels),
+                                             _format_value(value)))
+        return '\n'.join(lines)
+
+
+class MetricsRegistry(object):
+    """the metrics of the process, by name"""
+
+    def __init__(self):
+        self._metrics = []
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        :return: the metric
+        :raise ValueError if a metric with the same name is registered
+        """
+        with self._lock:
+            if metric.name in self._names:
+                raise ValueError('metric: "{0}" is already registered'.format(metric.name))
+            self._names.add(metric.name)
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def function(self, name, help_text, function, label_names=(), metric_type='gauge'):
+        return self.register(FunctionMetric(name, help_text, function, label_names, metric_type))
+
+    def render(self):
+        """:return: every metric in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route, method and status, _count is the request count',
+    ('route', 'method', 'status'))
+cassandra_statement_duration = registry.histogram(
+    'cassandra_statement_duration_seconds', 'Cassandra statement latency by statement type', ('statement',))
+cassandra_statement_errors = registry.counter(
+    'cassandra_statement_errors_total', 'Cassandra statements that failed, by statement type and error',
+    ('statement', 'error'))
+
+_statement_types = {}
+
+
+def return_statement_type(command):
+    """
+    :param command: CQL command
+    :return: a short label for the command, e.g. "select users_by_name", "update users_tbl", "insert users_tbl lwt"
+    :rtype: string
+    """
+    statement_type = _statement_types.get(command)
+    if statement_type is None:
+        words = command.replace(';', ' ').split()
+        upper_words = [word.upper() for word in words]
+        verb = upper_words[0].lower() if words else 'unknown'
+        table = ''
+        for keyword in ('FROM', 'INTO', 'UPDATE'):
+            if keyword in upper_words and upper_words.index(keyword) + 1 < len(words):
+                table = words[upper_words.index(keyword) + 1].split('.')[-1].split('(')[0]
+                break
+        statement_type = ' '.join(part for part in (verb, table) if part)
+        if 'IF' in upper_words:
+            statement_type += ' lwt'
+        # bounded, the app only runs a fixed set of commands (update commands by column set)
+        if len(_statement_types) < 1000:
+            _statement_types[command] = statement_type
+    return statement_type
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Migrates an existing users keyspace to the users_by_name lookup table
+Creates the users_by_name table if needed and backfills it from users_tbl.  Names are claimed with IF NOT EXISTS so
+a name that is already mapped (or duplicated in users_tbl) is reported instead of overwritten.  Once the backfill is
+clean the old secondary index on users_tbl.name can be dropped with --drop-name-index
+usage: python gpg_migrate_users_by_name.py [--contact-points 10.0.0.1,10.0.0.2] [--drop-name-index]
+"""
+
+__author__ = "GGibson"
+
+import argparse
+import logging
+import os
+import sys
+
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.query import SimpleStatement
+
+from gpg_cassandra_utility import get_connection
+import gpg_setup_logger
+
+module = __name__
+users_keyspace_name = 'users'
+name_index_name = 'users_tbl_name_idx'
+
+log_file_name, module = gpg_setup_logger.create_log_file_name_and_module(__file__, __package__)
+gpg_setup_logger.setup_logger('/var/log/gpg', log_file_name, module=module, log_level=logging.DEBUG,
+                              use_console_logger=True)
+logger = logging.getLogger(module)
+
+create_table_command = """CREATE TABLE IF NOT EXISTS users.users_by_name (
+    name text PRIMARY KEY,
+    id uuid
+    ) WITH caching = '{"keys":"ALL", "rows_per_partition":"ALL"}'
+    AND comment = 'name to id lookup for users_tbl, kept in sync by gpg_cassandra.User';"""
+select_users_command = 'SELECT id, name FROM users.users_tbl;'
+insert_name_command = 'INSERT INTO users.users_by_name (name, id) VALUES (?, ?) IF NOT EXISTS;'
+drop_index_command = 'DROP INDEX IF EXISTS users.{0};'.format(name_index_name)
+
+
+def backfill_users_by_name(session, fetch_size=1000, concurrency=50):
+    """
+    Copies every (name, id) from users_tbl into users_by_name, a page at a time
+    :param session: session connected to the cluster
+    :param fetch_size: rows read per page of users_tbl
+    :param concurrency: number of inserts in flight
+    :return: number of names added, list of (name, id, existing id) conflicts
+    :rtype: (int, list)
+    """
+    logger.info('backfilling users_by_name from users_tbl, fetch size: %d, concurrency: %d', fetch_size, concurrency)
+    insert_statement = session.prepare(insert_name_command)
+    rows = session.execute(SimpleStatement(select_users_command, fetch_size=fetch_size))
+    added = 0
+    conflicts = []
+    while True:
+        page = [(row.name, row.id) for row in rows.current_rows if row.name]
+        results = execute_concurrent_with_args(session, insert_statement, page, concurrency=concurrency)
+        for (name, user_id), (success, result) in zip(page, results):
+            if not success:
+                logger.error('failed to add name: "%s", id: %s, error: %s', name, user_id, result)
+                raise result
+            if result[0].applied:
+                added += 1
+            elif result[0].id != user_id:
+                logger.warning('name: "%s" for id: %s is already mapped to id: %s', name, user_id, result[0].id)
+                conflicts.append((name, user_id, result[0].id))
+        logger.debug('backfilled page of %d names, total added: %d', len(page), added)
+        if not rows.has_more_pages:
+            break
+        rows.fetch_next_page()
+    logger.info('completed backfilling users_by_name, added: %d, conflicts: %d', added, len(conflicts))
+    return added, conflicts
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='create and backfill the users_by_name lookup table')
+    parser.add_argument('--contact-points', default=os.environ.get('contact_points'),
+                        help='comma separated Cassandra contact points, defaults to the contact_points env var')
+    parser.add_argument('--fetch-size', type=int, default=1000, help='rows read per page of users_tbl')
+    parser.add_argument('--concurrency', type=int, default=50, help='number of inserts in flight')
+    parser.add_argument('--drop-name-index', action='store_true',
+                        help='drop the secondary index on users_tbl.name once the backfill has no conflicts')
+    options = parser.parse_args(args)
+    if not options.contact_points:
+        parser.error('no contact points provided, use --contact-points or set contact_points')
+
+    with get_connection(contact_points=options.contact_points.split(','), keyspace=users_keyspace_name) \
+            as (cluster, session):
+        logger.debug('running cql command: %s', create_table_command)
+        session.execute(create_table_command)
+        added, conflicts = backfill_users_by_name(session, options.fetch_size, options.concurrency)
+        if options.drop_name_index:
+            if conflicts:
+                logger.error('not dropping index: "%s" as %d names conflict', name_index_name, len(conflicts))
+                return 1
+            logger.info('dropping secondary index: "%s"', name_index_name)
+            session.execute(drop_index_command)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Slotted record types.  A record keeps its fields in __slots__ rather than a per instance __dict__, so a large set of
+users held in the user cache, the memory backend or the file backend takes a fraction of the memory, and records are
+immutable by default: replace returns a changed copy.  Records convert to and from dictionaries (the json of the user
+detail routes and the users document) with return_dict / return_json and from_dict
+    UserRecord - the user record of the storage backends and the user cache (user_id, name, ... domain)
+gpg_user.UserAccount (the file backend) and gpg_cassandra.User (the Cassandra backend) are records too
+"""
+
+__author__ = "GGibson"
+
+from operator import attrgetter
+
+
+class RecordType(type):
+    """
+    Builds the slots of a record class from its FIELDS, the fields of the class and its parents.  An immutable record
+    keeps each field in a private slot (_name for name) behind a read only property, so __init__ sets the private
+    slots with plain assignments, as cheap as setting an attribute of a plain object, while setting a field raises
+    AttributeError.  A mutable record keeps each field in a slot of its name
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        base_fields = ()
+        for base in bases:
+            base_fields += getattr(base, 'FIELDS', ())
+        fields = namespace.get('FIELDS', base_fields)
+        if fields[:len(base_fields)] != base_fields:
+            raise TypeError('the FIELDS of record: {0} do not start with the fields of its parents'.format(name))
+        new_fields = fields[len(base_fields):]
+        mutable = namespace.get('MUTABLE', any(getattr(base, 'MUTABLE', False) for base in bases))
+        if mutable:
+            if base_fields and not all(getattr(base, 'MUTABLE', True) for base in bases):
+                raise TypeError('mutable record: {0} cannot have the fields of an immutable parent'.format(name))
+            namespace['__slots__'] = new_fields
+        else:
+            namespace['__slots__'] = tuple('_' + field for field in new_fields)
+            for field in new_fields:
+                namespace[field] = property(attrgetter('_' + field), doc='{0} field, read only'.format(field))
+        namespace['FIELDS'] = fields
+        namespace['MUTABLE'] = mutable
+        slots = fields if mutable else tuple('_' + field for field in fields)
+        # the field names to check dictionary keys against
+        namespace['_field_names'] = frozenset(fields)
+        # the field values in the order of FIELDS, read from the slots, attrgetter returns a tuple for more than one
+        if len(slots) > 1:
+            return_values = attrgetter(*slots)
+        else:
+            return_values = lambda record: tuple(getattr(record, slot) for slot in slots)
+        namespace['_return_values'] = staticmethod(return_values)
+        cls = super(RecordType, mcs).__new__(mcs, name, bases, namespace)
+        # (field, setter of its slot) in the order of FIELDS, calling the slot's setter directly is the fastest way to
+        # set it from outside __init__
+        cls._field_setters = tuple((field, getattr(cls, slot).__set__) for field, slot in zip(fields, slots))
+        return cls
+
+
+class Record(object):
+    """
+    Base class for records.  A subclass lists every field (its parents' first) in FIELDS, RecordType builds the
+    slots.  Records are immutable unless the subclass sets MUTABLE, use replace to change one
+    """
+    __metaclass__ = RecordType
+    FIELDS = ()
+    MUTABLE = False
+
+    def __init__(self, *values, **fields):
+        """
+        :param values: field values in the order of FIELDS
+        :param fields: field values by name, the fields not given are None
+        :raise TypeError if a field is unknown or given twice
+        """
+        if len(values) > len(self.FIELDS):
+            raise TypeError('{0} takes at most {1} values'.format(type(self).__name__, len(self.FIELDS)))
+        for field, value in zip(self.FIELDS, values):
+            if field in fields:
+                raise TypeError('{0} got two values for field: {1}'.format(type(self).__name__, field))
+            fields[field] = value
+        self._set_fields(fields)
+
+    def _set_fields(self, fields):
+        """
+        sets every field, from the dictionary or None
+        :raise TypeError if the dictionary has a key that is not a field
+        """
+        get = fields.get
+        for field, set_slot in self._field_setters:
+            set_slot(self, get(field))
+        if len(fields) > len(self.FIELDS) or not self._field_names.issuperset(fields):
+            unknown = ', '.join(sorted(set(fields).difference(self.FIELDS)))
+            raise TypeError('unknown fields for {0}: {1}'.format(type(self).__name__, unknown))
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Builds a record from a dictionary without running __init__ (no defaults or conversions)
+        :param values: dictionary of field values, the fields not in it are None
+        :raise TypeError if the dictionary has a key that is not a field
+        """
+        record = cls.__new__(cls)
+        record._set_fields(values)
+        return record
+
+    def return_values(self):
+        """
+        :return: the field values in the order of FIELDS
+        :rtype: tuple
+        """
+        return self._return_values(self)
+
+    def return_dict(self):
+        """
+        :return: a new dictionary of the fields
+        :rtype: dictionary
+        """
+        return dict(zip(self.FIELDS, self._return_values(self)))
+
+    def return_json(self):
+        """the dictionary json.dump writes for the record (json.dump(..., default=methodcaller('return_json')))"""
+        return self.return_dict()
+
+    def replace(self, **changes):
+        """
+        :return: a copy of the record with the fields in changes set
+        :raise TypeError if a field is unknown
+        """
+        values = self.return_dict()
+        values.update(changes)
+        return self.from_dict(values)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._return_values(self) == other._return_values(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self.MUTABLE:
+            raise TypeError('unhashable mutable record: {0}'.format(type(self).__name__))
+        return hash(self._return_values(self))
+
+    def __getstate__(self):
+        return self.return_dict()
+
+    def __setstate__(self, state):
+        self._set_fields(state)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(field, value) for field, value in zip(self.FIELDS, self._return_values(self))))
+
+
+class UserRecord(Record):
+    """a user of the storage backends, with the keys of the user detail json, user_id is a string"""
+    FIELDS = ('user_id', 'name', 'description', 'owner', 'owner_email', 'notes', 'is_domain', 'domain')
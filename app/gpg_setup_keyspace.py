@@ -48,7 +48,11 @@ commands = [
     AND min_index_interval = 128
     AND read_repair_chance = 0.0
     AND speculative_retry = '99.0PERCENTILE';""",
-    'create index on users_tbl (name);',
+    """CREATE TABLE IF NOT EXISTS users.users_by_name (
+    name text PRIMARY KEY,
+    id uuid
+    ) WITH caching = '{"keys":"ALL", "rows_per_partition":"ALL"}'
+    AND comment = 'name to id lookup for users_tbl, kept in sync by gpg_cassandra.User';""",
     'create index on users_tbl (owner);',
     'create index on users_tbl (owner_email);',
     """INSERT INTO users.users_tbl (id, name, description, owner, owner_email, notes, is_domain, domain)
@@ -59,7 +63,10 @@ commands = [
       'test2@my.com', 'no notes2', false, 'myMac');""",
     """INSERT INTO users.users_tbl (id, name, description, owner, owner_email, notes, is_domain, domain)
     VALUES (5d204d7e-0c08-425d-ac03-cb1fe48c01f8, 'testUser3', 'a test account for test user 3', 'Tester 3',
-      'test3@my.com', 'no notes3', true, 'wp.fsi');"""
+      'test3@my.com', 'no notes3', true, 'wp.fsi');""",
+    "INSERT INTO users.users_by_name (name, id) VALUES ('testUser1', f5c54eea-a9e8-4f81-898e-b965675f46b4);",
+    "INSERT INTO users.users_by_name (name, id) VALUES ('testUser2', f5d599bb-975f-47d4-ba50-ed965f0d44cb);",
+    "INSERT INTO users.users_by_name (name, id) VALUES ('testUser3', 5d204d7e-0c08-425d-ac03-cb1fe48c01f8);"
 ]
 
 logger.info('setting up "%s" keyspace', users_keyspace_name)
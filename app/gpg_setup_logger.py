@@ -7,15 +7,218 @@ used to setup loggers
 __author__ = "GGibson"
 
 
+import atexit
+import copy
 import getpass
+import itertools
 import logging
 import logging.handlers
 import os
+import threading
 import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DROP = 'drop'
+BLOCK = 'block'
+
+# the QueueHandler set up by setup_logger(use_queue=True), None if logging is synchronous
+queue_handler = None
+
+
+class QueueListener(object):
+    """
+    Passes the records put on its queue to the handlers on a background thread, so formatting and file writes do not
+    happen on the threads that log.  The thread (and a fresh queue) is started again in a forked child process
+    """
+    _sentinel = None
+
+    def __init__(self, handlers, queue_size=10000):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.queue = None
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """starts the listener thread in this process if it is not already running"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # the queue of the parent process may have been locked when it forked, do not reuse it
+            self.queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._monitor, name='log-queue-listener')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """writes the records already queued and stops the listener thread"""
+        if self._pid != os.getpid():
+            return
+        self.queue.put(QueueListener._sentinel)
+        self._thread.join()
+        self._pid = None
+
+    def _monitor(self):
+        record_queue = self.queue
+        while True:
+            record = record_queue.get()
+            if record is QueueListener._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        # a failing handler must not stop the thread, the queue would fill up
+                        handler.handleError(record)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on the queue of a QueueListener instead of writing them.  When the queue is full the record is
+    dropped (and counted) with the drop policy, or the logging thread waits for space with the block policy
+    """
+
+    def __init__(self, listener, policy=DROP, block_timeout=None):
+        """
+        :param listener: QueueListener that writes the records
+        :param policy: DROP or BLOCK
+        :param block_timeout: seconds to wait for space with the block policy before dropping, None to wait forever
+        """
+        super(QueueHandler, self).__init__()
+        if policy not in (DROP, BLOCK):
+            raise ValueError('unsupported log queue policy: "{0}"'.format(policy))
+        self.listener = listener
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """
+        Formats the message and any traceback on the logging thread, as logging.handlers.QueueHandler does: the
+        arguments may be changed by the time the listener writes the record (a mutable User logged with %s) and the
+        frames of a traceback may be gone
+        :return: a copy of the record with the formatted message and no arguments or exception info
+        """
+        message = self.format(record)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        self.listener.start()
+        try:
+            self.listener.queue.put(self.prepare(record), self.policy == BLOCK, self.block_timeout)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def close(self):
+        self.listener.stop()
+        super(QueueHandler, self).close()
+
+
+class LogSampler(object):
+    """
+    Guards a log call on a hot path (per row, per statement), so it costs a level check when the level is off and
+    otherwise lets through one call in every calls and/or at most max_per_second calls a second:
+        if row_log_sampler.sample():
+            logger.debug('adding user: "%s"', name)
+    """
+
+    def __init__(self, logger, every=1, max_per_second=None, level=logging.DEBUG, clock=time.time):
+        self.logger = logger
+        self.every = max(every, 1)
+        self.max_per_second = max_per_second
+        self.level = level
+        self.clock = clock
+        self.suppressed = 0
+        self._calls = itertools.count()
+        self._lock = threading.Lock()
+        self._second = None
+        self._second_count = 0
+
+    def sample(self):
+        """:return: True if this call should be logged"""
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        if self.every > 1 and next(self._calls) % self.every:
+            return False
+        if self.max_per_second:
+            second = int(self.clock())
+            with self._lock:
+                if second != self._second:
+                    self._second = second
+                    self._second_count = 0
+                if self._second_count >= self.max_per_second:
+                    self.suppressed += 1
+                    return False
+                self._second_count += 1
+        return True
+
+
+def return_level(level_name):
+    """
+    :param level_name: logging level name, e.g. DEBUG
+    :return: the logging level
+    :rtype: int
+    :raise ValueError if the name is not a logging level
+    """
+    level = logging.getLevelName(level_name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError('unknown logging level: "{0}"'.format(level_name))
+    return level
+
+
+def return_levels_from_environment():
+    """
+    Reads per logger levels from the log_levels environment variable, comma separated logger=LEVEL pairs,
+    e.g. log_levels=app.gpg_cassandra=INFO,app.gpg_cache=DEBUG,cassandra=WARNING
+    :return: dictionary of logger name to level
+    :rtype: dictionary
+    """
+    levels = {}
+    for pair in os.environ.get('log_levels', '').split(','):
+        if not pair.strip():
+            continue
+        name, _, level_name = pair.partition('=')
+        levels[name.strip()] = return_level(level_name)
+    return levels
+
+
+def return_dropped_record_count():
+    """:return: the number of log records dropped because the log queue was full"""
+    return queue_handler.dropped if queue_handler else 0
+
+
+def return_file_handler(filename, rotate=True):
+    """
+    :param filename: log file
+    :param rotate: bool: rotate the file from this process, False to only reopen it when it has been rotated by
+                   another program (logrotate), for a file that several processes (gunicorn workers) write to: each
+                   would rotate it under the others
+    :rtype: logging.FileHandler
+    """
+    if rotate:
+        return logging.handlers.RotatingFileHandler(filename, mode='a', maxBytes=1048576, backupCount=5)
+    return logging.handlers.WatchedFileHandler(filename, mode='a')
 
 
 def setup_logger(log_dir, log_name_prefix, use_date_suffix=True, log_level=logging.DEBUG, format_string=None,
-                 module=None, use_console_logger=True):
+                 module=None, use_console_logger=True, use_queue=False, queue_size=10000, queue_policy=DROP,
+                 rotate=True):
     """
     Create a logger, set up console and file handlers in the root logger
     NOTE: This should only be called once, from the script where __name__ == '__main__'
@@ -27,28 +230,42 @@ def setup_logger(log_dir, log_name_prefix, use_date_suffix=True, log_level=loggi
     :param format_string: formatting string to use when logging to file. In None,
                           creates a standard format for scripts with classes
     :param module: Used to create the logger instance name, if None, then log_name_prefix is used
+    :param use_queue: bool: the root logger only queues records, the console and file handlers run on a background
+                      thread (see QueueListener)
+    :param queue_size: maximum number of queued records when use_queue is set
+    :param queue_policy: DROP to drop (and count) records when the queue is full, BLOCK to wait for space
+    :param rotate: bool: the file is rotated by the logger, False to leave the rotation to logrotate (see
+                   return_file_handler)
     :return: The constructed logger object
     """
+    global queue_handler
 
     logger = logging.getLogger(module or log_name_prefix)
     logger.setLevel(log_level)
 
+    # loggers named in log_levels can be more or less verbose than log_level, the handlers let the most verbose through
+    levels = return_levels_from_environment()
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    handler_level = min([log_level] + list(levels.values()))
+
     # adjust the console logger
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
+    handlers = []
     for handler in root_logger.handlers:
         if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            root_logger.removeHandler(handler)
             if use_console_logger:
                 handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-            else:
-                root_logger.removeHandler(handler)
+                handlers.append(handler)
             break
     else:
         # Add a console handler
         if use_console_logger:
             handler = logging.StreamHandler()
             handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-            root_logger.addHandler(handler)
+            handlers.append(handler)
 
     # create the file logger
     if not os.path.isdir(log_dir):
@@ -64,16 +281,23 @@ def setup_logger(log_dir, log_name_prefix, use_date_suffix=True, log_level=loggi
     filename += '.log'
     if use_console_logger:
         logger.debug("Setting up file logger with logfile '%s'", filename)
-    mode = 'a'
-    max_bytes = 1048576
-    backup_count = 5
-    fh = logging.handlers.RotatingFileHandler(filename, mode, max_bytes, backup_count)
-    fh.setLevel(log_level)
+    fh = return_file_handler(filename, rotate)
+    fh.setLevel(handler_level)
     if not format_string:
         format_string = '%(asctime)s %(levelname)s %(name)s#%(funcName)s:%(lineno)d - %(message)s'
     file_formatter = logging.Formatter(format_string)
     fh.setFormatter(file_formatter)
-    root_logger.addHandler(fh)
+    handlers.append(fh)
+
+    if use_queue:
+        listener = QueueListener(handlers, queue_size)
+        queue_handler = QueueHandler(listener, queue_policy)
+        queue_handler.setLevel(handler_level)
+        root_logger.addHandler(queue_handler)
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            root_logger.addHandler(handler)
     return logger
 
 def create_log_file_name(file_name):
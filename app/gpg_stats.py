@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Latency statistics shared by the benchmark (gpg_benchmark.py) and the load generator (gpg_load_generator.py).  It has
+no settings and no side effects on import, unlike the benchmark, which changes the log level of the views
+"""
+
+__author__ = "GGibson"
+
+import math
+
+
+def return_percentile(sorted_values, fraction):
+    """
+    :param sorted_values: list of numbers, in ascending order
+    :param fraction: e.g. 0.99 for p99
+    :return: the nearest rank percentile, None for no values
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
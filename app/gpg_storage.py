@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+User storage backends behind one repository interface, so the views do not depend on where the users are kept
+    cassandra - users_tbl and users_by_name through User, with the user cache (the default)
+    memory - dictionaries in the worker process, nothing is persisted
+    file - the gpg_user.Users json document, rewritten on every change, or a journal of the changes next to it
+The backend is named by the user_storage environment variable, the file backend's document by user_storage_file
+(default /tmp/users.json).  Set user_storage_journal=true to append each change of the file backend to the journal
+(the document plus .journal) and only write the document every user_storage_compact_every (1000) changes, the journal
+is fsynced per user_storage_fsync: always (the default), interval (every user_storage_fsync_interval seconds, 1) or
+never, see gpg_user_journal.  Without the journal, user_storage_write_delay (seconds, default 0) writes the document
+that long after a change, with every change made by then, rather than once per change.  Set user_storage_lazy=true
+to build each account of the file backend only when it is first read.  The memory and file
+backends keep their users in the worker process, so they are for a single node run with one gunicorn worker
+(gunicorn_workers=1, gunicorn_threads sets the requests served at a time)
+Records are dictionaries with the keys of the user detail json: user_id (string), name, description, owner,
+owner_email, notes, is_domain and domain
+"""
+
+__author__ = "GGibson"
+
+import base64
+import binascii
+from bisect import bisect_right
+import datetime
+import logging
+import os
+import threading
+import uuid
+
+import gpg_bulk
+from gpg_cassandra import CreateUserError, PageTokenError, UpdateUserError, User, UserExistsError, UserIdError
+from gpg_cassandra_async import AsyncUser
+from gpg_record import UserRecord
+import gpg_user
+from gpg_user_journal import FSYNC_ALWAYS, UsersJournal
+
+logger = logging.getLogger(__name__)
+
+CASSANDRA = 'cassandra'
+MEMORY = 'memory'
+FILE = 'file'
+# value of each field when a new user does not set it
+RECORD_DEFAULTS = {'description': '', 'owner': '', 'owner_email': '', 'notes': '', 'is_domain': False, 'domain': ''}
+
+
+def return_user_id(user_id):
+    """
+    :param user_id: uuid or string
+    :rtype: uuid
+    :raise UserIdError if user_id is not a valid uuid
+    """
+    if isinstance(user_id, uuid.UUID):
+        return user_id
+    try:
+        return uuid.UUID(str(user_id))
+    except ValueError:
+        message = 'user id: "{0}" is not a valid uuid'.format(user_id)
+        logger.error(message)
+        raise UserIdError(message)
+
+
+def return_new_record(values):
+    """
+    Validates the values of a new user and returns its record, with a new id if none is set and the defaults for the
+    fields that are not set
+    :param values: dictionary of record fields
+    :rtype: dictionary
+    :raise CreateUserError if a field is unknown or of the wrong type, or the name is not set
+    :raise UserIdError if the user id is not a valid uuid
+    """
+    unknown_fields = set(values) - set(gpg_bulk.USER_FIELDS)
+    if unknown_fields:
+        raise CreateUserError('unknown user fields: {0}'.format(', '.join(sorted(unknown_fields))))
+    type_error = gpg_bulk.return_field_type_error(values)
+    if type_error:
+        raise CreateUserError(type_error)
+    if not values.get('name'):
+        raise CreateUserError('Cannot create user without user name')
+    record = dict((field, values.get(field) or default) for field, default in RECORD_DEFAULTS.items())
+    record['name'] = values['name']
+    record['user_id'] = str(return_user_id(values['user_id']) if values.get('user_id') else uuid.uuid4())
+    return record
+
+
+def return_update_values(values):
+    """
+    :param values: dictionary of record fields, fields that are not set (or cannot be updated) are ignored
+    :return: the updatable fields that are set, as User.update_user does
+    :rtype: dictionary
+    :raise UpdateUserError if no updatable field is set, or a field is of the wrong type
+    """
+    type_error = gpg_bulk.return_field_type_error(values)
+    if type_error:
+        raise UpdateUserError(type_error)
+    update_values = dict((column, values[column]) for column in User.UPDATABLE_COLUMNS if values.get(column))
+    if not update_values:
+        raise UpdateUserError('No columns to update')
+    return update_values
+
+
+class UserRepository(object):
+    """
+    The storage interface used by the views.  Child classes implement the single user methods, iter_users and
+    export_users, the batch methods and paging fall back to those
+    """
+
+    def get(self, user_id):
+        """
+        :param user_id: uuid
+        :return: the user record, None if the id is not found
+        :rtype: dictionary
+        """
+        raise NotImplementedError('get must be implemented on the child class')
+
+    def get_id_by_name(self, name, cached=True):
+        """
+        :param cached: False to read the id from the backend itself, not from a cache another worker may have made
+                       stale, for the ids that are written to
+        :return: the id of the user name, None if the name is not found
+        :rtype: uuid
+        """
+        raise NotImplementedError('get_id_by_name must be implemented on the child class')
+
+    def get_by_name(self, name):
+        """:return: the user record for the name, None if the name is not found"""
+        user_id = self.get_id_by_name(name)
+        return self.get(user_id) if user_id else None
+
+    def create(self, values):
+        """
+        :param values: dictionary of record fields, name is required
+        :return: the record created
+        :rtype: dictionary
+        :raise UserExistsError if a user with the same name or id exists
+        :raise UserExceptions if the values are not a valid user
+        """
+        raise NotImplementedError('create must be implemented on the child class')
+
+    def update(self, user_id, values, name=None):
+        """
+        Sets the updatable fields (User.UPDATABLE_COLUMNS) that have a value, the others are left as they are
+        :param user_id: uuid
+        :param values: dictionary of record fields
+        :param name: name of the user, if it is known
+        :return: the record after the update
+        :rtype: dictionary
+        :raise UpdateUserError if no updatable field is set
+        :raise UserIdError if the user id is not found
+        """
+        raise NotImplementedError('update must be implemented on the child class')
+
+    def delete(self, user_id, name=None):
+        """
+        :param user_id: uuid
+        :param name: name of the user, if it is known
+        """
+        raise NotImplementedError('delete must be implemented on the child class')
+
+    def iter_users(self, fetch_size=1000):
+        """
+        :param fetch_size: users read at a time, for backends that page
+        :rtype: generator of (name, id string)
+        """
+        raise NotImplementedError('iter_users must be implemented on the child class')
+
+    def list_users(self):
+        """:return: dictionary of user name to id string"""
+        return dict(self.iter_users())
+
+    def get_users_page(self, limit, page_token=None):
+        """
+        Returns one page of users in name order, the page token holds the last name of the previous page
+        :param limit: maximum number of users to return
+        :param page_token: token returned with the previous page, None for the first page
+        :return: dictionary of user name to id string, token for the next page or None if this is the last page
+        :rtype: (dictionary, string)
+        :raise PageTokenError if the page token cannot be decoded
+        """
+        after = None
+        if page_token:
+            try:
+                after = base64.urlsafe_b64decode(str(page_token)).decode('utf-8')
+            except (TypeError, ValueError, binascii.Error):
+                message = 'invalid page token: "{0}"'.format(page_token)
+                logger.error(message)
+                raise PageTokenError(message)
+        users = self.list_users()
+        names = sorted(users)
+        start = bisect_right(names, after) if after is not None else 0
+        page = names[start:start + limit]
+        next_page_token = None
+        if start + limit < len(names):
+            next_page_token = base64.urlsafe_b64encode(page[-1].encode('utf-8'))
+        return dict((name, users[name]) for name in page), next_page_token
+
+    def export_users(self, range_count=64, workers=8, fetch_size=1000):
+        """
+        :param range_count: scan hint, token ranges for the cassandra backend
+        :param workers: scan hint, ranges scanned at the same time for the cassandra backend
+        :param fetch_size: scan hint, rows per page for the cassandra backend
+        :rtype: generator of record
+        """
+        raise NotImplementedError('export_users must be implemented on the child class')
+
+    def get_ids_by_names(self, names, concurrency=100):
+        """:return: dictionary of name to id, None for names that are not found"""
+        return dict((name, self.get_id_by_name(name)) for name in names)
+
+    def get_many(self, user_ids, concurrency=100):
+        """:return: dictionary of id to record, None for ids that are not found"""
+        return dict((user_id, self.get(user_id)) for user_id in user_ids)
+
+    def lookup(self, names, user_ids, concurrency=100):
+        """
+        :param names: list of user names
+        :param user_ids: list of uuid, None for keys that are not valid ids
+        :param concurrency: maximum number of reads in flight, for backends that read concurrently
+        :return: (list of name records, list of id records), in the order of names and user_ids, None for keys that
+                 are not found
+        :rtype: (list, list)
+        """
+        ids_by_name = self.get_ids_by_names(names, concurrency)
+        records = self.get_many(set(user_id for user_id in list(ids_by_name.values()) + list(user_ids) if user_id),
+                                concurrency)
+        return ([records[ids_by_name[name]] if ids_by_name[name] else None for name in names],
+                [records[user_id] if user_id else None for user_id in user_ids])
+
+    def create_many(self, records, concurrency=100, chunk_size=1000):
+        """
+        :param records: iterable of user dictionaries (or exceptions for records that failed to parse)
+        :param concurrency: maximum number of writes in flight, for backends that write concurrently
+        :param chunk_size: number of records written together, for backends that write concurrently
+        :return: one result per record, in order, see gpg_bulk.load_users
+        :rtype: generator of dictionary
+        """
+        return gpg_bulk.create_users(records, self.create)
+
+    def close(self):
+        pass
+
+
+class CassandraUserRepository(UserRepository):
+    """users_tbl and users_by_name, read through the user cache"""
+
+    def get(self, user_id):
+        return User.get_user_record(user_id)
+
+    def get_id_by_name(self, name, cached=True):
+        return User(name=name).return_user_id_by_name(cached)
+
+    def create(self, values):
+        # validated like the other backends, so unknown fields raise CreateUserError rather than TypeError
+        user = User(**return_new_record(values))
+        user.create_user()
+        return user.return_json()
+
+    def update(self, user_id, values, name=None):
+        # validated like the other backends, a value the driver cannot bind raises UpdateUserError rather than TypeError
+        user = User(**return_update_values(values))
+        user.name = name
+        user.user_id = user_id
+        user.update_user()
+        if not user.is_update_complete():
+            # only read the record back when the update didn't set every column
+            user.get_user_details()
+        return user.return_json()
+
+    def delete(self, user_id, name=None):
+        User(user_id=user_id, name=name).delete_user()
+
+    def iter_users(self, fetch_size=1000):
+        return User.iter_all_users(fetch_size)
+
+    def list_users(self):
+        return User.get_all_users()
+
+    def get_users_page(self, limit, page_token=None):
+        # paged by the server, the token is the driver's paging state
+        return User.get_users_page(limit, page_token)
+
+    def export_users(self, range_count=64, workers=8, fetch_size=1000):
+        return User.export_users(range_count, workers, fetch_size)
+
+    def get_ids_by_names(self, names, concurrency=100):
+        return User.get_user_ids_by_names(names, concurrency)
+
+    def get_many(self, user_ids, concurrency=100):
+        return User.get_user_records_by_ids(list(user_ids), concurrency)
+
+    def lookup(self, names, user_ids, concurrency=100):
+        # every name resolution and detail read is in flight at once, each name's detail read starts when its id is
+        # known
+        return AsyncUser().lookup(names, user_ids, concurrency).result()
+
+    def create_many(self, records, concurrency=100, chunk_size=1000):
+        return gpg_bulk.load_users(records, concurrency, chunk_size)
+
+
+class InMemoryUserRepository(UserRepository):
+    """users by id and by name, held as gpg_record.UserRecord, for tests, benchmarks and single node runs"""
+
+    def __init__(self):
+        self._records = {}
+        self._ids_by_name = {}
+        self._lock = threading.RLock()
+
+    def get(self, user_id):
+        record = self._records.get(user_id)
+        return record.return_dict() if record else None
+
+    def get_id_by_name(self, name, cached=True):
+        return self._ids_by_name.get(name)
+
+    def create(self, values):
+        record = return_new_record(values)
+        user_id = uuid.UUID(record['user_id'])
+        with self._lock:
+            _verify_new_user(record, user_id, self._ids_by_name, user_id in self._records)
+            self._records[user_id] = UserRecord.from_dict(record)
+            self._ids_by_name[record['name']] = user_id
+        return record
+
+    def update(self, user_id, values, name=None):
+        update_values = return_update_values(values)
+        with self._lock:
+            record = self._records.get(user_id)
+            if record is None:
+                raise UserIdError('failed to find the user id: {0}'.format(user_id))
+            # records are immutable, the record is replaced by a changed copy
+            record = self._records[user_id] = record.replace(**update_values)
+        return record.return_dict()
+
+    def delete(self, user_id, name=None):
+        with self._lock:
+            record = self._records.pop(user_id, None)
+            if record is not None:
+                del self._ids_by_name[record.name]
+
+    def iter_users(self, fetch_size=1000):
+        with self._lock:
+            users = [(record.name, record.user_id) for record in self._records.values()]
+        return iter(users)
+
+    def export_users(self, range_count=64, workers=8, fetch_size=1000):
+        with self._lock:
+            records = list(self._records.values())
+        return (record.return_dict() for record in records)
+
+
+class FileUserRepository(UserRepository):
+    """
+    users in a gpg_user.Users json document: domain users (is_domain) are DomainUser accounts with the domain as the
+    domain name, the others are LocalUser accounts with the domain as the hostname.  Accounts are found by id with the
+    uuid index of gpg_user.Users.  The whole document is written after every change, or write_delay seconds after a
+    change with the changes made by then, or with a journal each change is appended to the journal and the document
+    is written when the journal is compacted.  In lazy mode an account is only built from the document when it is
+    first read
+    """
+
+    def __init__(self, conf_file=None, journal=False, fsync=FSYNC_ALWAYS, fsync_interval=1.0, compact_every=1000,
+                 write_delay=None, lazy=False):
+        """
+        :param conf_file: json document, created on the first change if it does not exist
+        :param journal: True to journal the changes to conf_file plus .journal
+        :param fsync: durability policy of the journal, see gpg_user_journal
+        :param fsync_interval: seconds between fsyncs of the journal for the interval policy
+        :param compact_every: journal records after which the document is written and the journal emptied
+        :param write_delay: seconds to wait after a change before writing the document, None to write at once
+        :param lazy: True to build each account from the document when it is first read
+        :raise UserJsonDocError if the document or the journal exists but cannot be loaded
+        :raise ValueError if the fsync policy is unknown
+        """
+        self.users = gpg_user.Users(conf_file=conf_file, compact_every=compact_every, write_delay=write_delay,
+                                    lazy=lazy)
+        if journal:
+            self.users.journal = UsersJournal(self.users.conf_file + '.journal', fsync, fsync_interval)
+        if journal or os.path.isfile(self.users.conf_file):
+            self.users.load_users()
+        self._lock = threading.RLock()
+        # names are unique across domain and local users here, gpg_user.Users only indexes them per domain or host
+        self._user_uuids_by_name = dict(self.users.iter_user_names_and_uuids())
+        logger.info('loaded %d users from: "%s"', len(self.users), self.users.conf_file)
+
+    def _write(self):
+        """writes (or schedules the write of) the document, unless the change is already in the journal"""
+        if self.users.journal is None:
+            self.users.date_modified = str(datetime.datetime.now())
+            self.users.write_users_later()
+
+    def get(self, user_id):
+        account = self.users.find_user_by_uuid(str(user_id))
+        return return_record_from_account(account) if account else None
+
+    def get_id_by_name(self, name, cached=True):
+        user_uuid = self._user_uuids_by_name.get(name)
+        return uuid.UUID(user_uuid) if user_uuid else None
+
+    def create(self, values):
+        record = return_new_record(values)
+        user_id = uuid.UUID(record['user_id'])
+        account = return_account_from_record(record)
+        with self._lock:
+            id_in_use = self.users.find_user_by_uuid(account.user_uuid) is not None
+            _verify_new_user(record, user_id, self._user_uuids_by_name, id_in_use)
+            self.users.add_user(account)
+            self._user_uuids_by_name[account.name] = account.user_uuid
+            self._write()
+        return record
+
+    def update(self, user_id, values, name=None):
+        update_values = return_update_values(values)
+        with self._lock:
+            old_account = self.users.find_user_by_uuid(str(user_id))
+            if old_account is None:
+                raise UserIdError('failed to find the user id: {0}'.format(user_id))
+            # is_domain picks the account class, so the account is replaced rather than changed
+            record = dict(return_record_from_account(old_account), **update_values)
+            account = return_account_from_record(record)
+            self.users.replace_user(account)
+            self._write()
+        return record
+
+    def delete(self, user_id, name=None):
+        with self._lock:
+            account = self.users.find_user_by_uuid(str(user_id))
+            if account is None:
+                return
+            del self._user_uuids_by_name[account.name]
+            self.users.remove_user_by_uuid(account.user_uuid)
+            self._write()
+
+    def iter_users(self, fetch_size=1000):
+        with self._lock:
+            users = list(self.users.iter_user_names_and_uuids())
+        return iter(users)
+
+    def export_users(self, range_count=64, workers=8, fetch_size=1000):
+        # only the uuids are copied under the lock, each account (built from the document in lazy mode) is read as the
+        # export reaches it, so the writes are not held up for the whole export
+        with self._lock:
+            user_uuids = [user_uuid for _, user_uuid in self.users.iter_user_names_and_uuids()]
+        return self._iter_records(user_uuids)
+
+    def _iter_records(self, user_uuids):
+        """:return: generator of the record of each account, skipping the accounts deleted since"""
+        for user_uuid in user_uuids:
+            account = self.users.find_user_by_uuid(user_uuid)
+            if account is not None:
+                yield return_record_from_account(account)
+
+    def close(self):
+        with self._lock:
+            self.users.close()
+
+
+def _verify_new_user(record, user_id, by_name, id_in_use):
+    """:raise UserExistsError if the name or the id of the record is in use"""
+    if record['name'] in by_name:
+        raise UserExistsError('Failed, a user already exists that matches the name: {0}'.format(record['name']))
+    if id_in_use:
+        raise UserExistsError('Failed, a user already exists that matches the id: {0}'.format(user_id))
+
+
+def return_record_from_account(account):
+    """
+    :param account: gpg_user.DomainUser or gpg_user.LocalUser
+    :return: the user record
+    :rtype: dictionary
+    """
+    is_domain = account.user_type == gpg_user.DomainUser.TYPE
+    return {'user_id': account.user_uuid, 'name': account.name, 'description': account.description,
+            'owner': account.owner, 'owner_email': account.owner_email, 'notes': account.notes,
+            'is_domain': is_domain, 'domain': account.domain_name if is_domain else account.hostname}
+
+
+def return_account_from_record(record):
+    """
+    :param record: user record
+    :return: gpg_user.DomainUser if the record is a domain user, otherwise gpg_user.LocalUser
+    """
+    account_class = gpg_user.DomainUser if record['is_domain'] else gpg_user.LocalUser
+    return account_class(record['name'], record['domain'], record['description'], record['owner'],
+                         record['owner_email'], record['notes'], user_uuid=record['user_id'])
+
+
+def return_repository_from_environment():
+    """
+    Creates the storage backend named by the user_storage environment variable
+    :rtype: UserRepository
+    :raise ValueError if the backend is unknown
+    """
+    storage = os.environ.get('user_storage', CASSANDRA).lower()
+    logger.info('user storage: %s', storage)
+    if storage == CASSANDRA:
+        return CassandraUserRepository()
+    if storage == MEMORY:
+        return InMemoryUserRepository()
+    if storage == FILE:
+        return FileUserRepository(os.environ.get('user_storage_file'),
+                                  os.environ.get('user_storage_journal', '').lower() in ('1', 'true'),
+                                  os.environ.get('user_storage_fsync', FSYNC_ALWAYS).lower(),
+                                  float(os.environ.get('user_storage_fsync_interval', 1)),
+                                  int(os.environ.get('user_storage_compact_every', 1000)),
+                                  float(os.environ.get('user_storage_write_delay', 0)),
+                                  os.environ.get('user_storage_lazy', '').lower() in ('1', 'true'))
+    raise ValueError('unknown user storage: "{0}", expected {1}, {2} or {3}'.format(storage, CASSANDRA, MEMORY, FILE))
+
+
+repository = return_repository_from_environment()
+
+
+def set_repository(new_repository):
+    """
+    Replaces the storage backend used by the views, e.g. with an InMemoryUserRepository in tests
+    :return: the backend that was replaced
+    :rtype: UserRepository
+    """
+    global repository
+    old_repository, repository = repository, new_repository
+    return old_repository
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Opt in per request tracing: the time spent in each phase of a request (routing, name lookup, each CQL statement,
+json encoding) is returned in a Server-Timing response header, and requests slower than a threshold are written to
+the slow request log as one json line
+environment variables:
+    request_tracing - off (default), on (every request) or header (requests with an X-Request-Trace: 1 header)
+    slow_request_seconds - requests that take longer are logged to the app.gpg_tracing.slow logger, 0 turns the
+                           slow request log off, default 1
+    cassandra_tracing - true to run the CQL statements of traced requests with driver tracing on, the query trace ids
+                        are added to the slow request log (tracing puts load on the cluster), default false
+"""
+
+__author__ = "GGibson"
+
+import json
+import logging
+import os
+import threading
+from timeit import default_timer
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger(__name__ + '.slow')
+
+TRACE_HEADER = 'X-Request-Trace'
+WSGI_START_KEY = 'gpg.request_start'
+
+request_tracing = os.environ.get('request_tracing', 'off').lower()
+slow_request_seconds = float(os.environ.get('slow_request_seconds', 1))
+cassandra_tracing = os.environ.get('cassandra_tracing', '').lower() in ('1', 'true')
+
+_local = threading.local()
+# shared, must not be changed
+_NO_EXECUTE_OPTIONS = {}
+_TRACE_EXECUTE_OPTIONS = {'trace': True}
+
+
+class RequestTrace(object):
+    """the spans of one request, in the order they completed"""
+
+    def __init__(self, cassandra_tracing=False):
+        self.start = default_timer()
+        self.cassandra_tracing = cassandra_tracing
+        self.spans = []
+        self.trace_ids = []
+
+    def span(self, name, description=None):
+        """:return: context manager that adds a span for the time spent in it"""
+        return _Span(self, name, description)
+
+    def add_span(self, name, duration, description=None):
+        """
+        :param name: phase, e.g. cql
+        :param duration: seconds
+        :param description: detail for the phase, e.g. the statement type
+        """
+        self.spans.append((name, duration, description))
+
+    def return_server_timing(self, total=None):
+        """
+        Returns the Server-Timing header value, one entry per span name with the total duration and the number of
+        spans, e.g. 'name_lookup;dur=0.8, cql;dur=3.1;desc="2 spans", total;dur=5.2'
+        :param total: seconds for the whole request, None to leave it out
+        :rtype: string
+        """
+        durations = {}
+        counts = {}
+        names = []
+        for name, duration, description in self.spans:
+            if name not in durations:
+                names.append(name)
+                durations[name] = counts[name] = 0
+            durations[name] += duration
+            counts[name] += 1
+        entries = []
+        for name in names:
+            entry = '{0};dur={1:.3f}'.format(name, durations[name] * 1000)
+            if counts[name] > 1:
+                entry += ';desc="{0} spans"'.format(counts[name])
+            entries.append(entry)
+        if total is not None:
+            entries.append('total;dur={0:.3f}'.format(total * 1000))
+        return ', '.join(entries)
+
+    def return_record(self):
+        """:return: the spans (in milliseconds) and query trace ids as a dictionary for the slow request log"""
+        return {'spans': [{'name': name, 'ms': round(duration * 1000, 3), 'desc': description}
+                          for name, duration, description in self.spans],
+                'cassandra_trace_ids': [str(trace_id) for trace_id in self.trace_ids]}
+
+
+class _Span(object):
+
+    def __init__(self, trace, name, description):
+        self.trace = trace
+        self.name = name
+        self.description = description
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.trace.add_span(self.name, default_timer() - self.start, self.description)
+        return False
+
+
+class _NullSpan(object):
+    """returned by span() when the request is not traced, so an untraced span costs a thread local lookup"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def is_trace_requested(headers):
+    """
+    :param headers: request headers
+    :return: True if the request should be traced (see request_tracing)
+    """
+    if request_tracing == 'on':
+        return True
+    return request_tracing == 'header' and headers.get(TRACE_HEADER) in ('1', 'true')
+
+
+def start_trace():
+    """starts tracing the request handled by this thread"""
+    _local.trace = RequestTrace(cassandra_tracing)
+    return _local.trace
+
+
+def current_trace():
+    """:return: the trace of the request handled by this thread, None if it is not traced"""
+    return getattr(_local, 'trace', None)
+
+
+def end_trace():
+    """:return: the trace of the request handled by this thread (None if it is not traced), and stops tracing"""
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    return trace
+
+
+def span(name, description=None):
+    """
+    Times a phase of the current request:
+        with gpg_tracing.span('json'):
+            body = json.dumps(user)
+    :return: context manager, it does nothing if the request is not traced
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name, description)
+
+
+def return_execute_options():
+    """:return: keyword arguments for Session.execute, trace=True if the request is traced with cassandra_tracing"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None and trace.cassandra_tracing:
+        return _TRACE_EXECUTE_OPTIONS
+    return _NO_EXECUTE_OPTIONS
+
+
+def record_trace_ids(result):
+    """adds the query trace ids of a result set to the current trace"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None or not trace.cassandra_tracing:
+        return
+    try:
+        trace.trace_ids.extend(result.response_future.get_query_trace_ids())
+    except (AttributeError, TypeError):
+        # no trace id was returned for the statement
+        pass
+
+
+def log_slow_request(method, path, status, duration, trace=None):
+    """writes the request to the slow request log if it took longer than slow_request_seconds"""
+    if not slow_request_seconds or duration < slow_request_seconds:
+        return
+    record = {'method': method, 'path': path, 'status': status, 'ms': round(duration * 1000, 3)}
+    if trace is not None:
+        record.update(trace.return_record())
+    slow_logger.warning('slow request: %s', json.dumps(record, sort_keys=True))
+
+
+class WsgiTimer(object):
+    """WSGI middleware that records when the request reached the app, so routing time can be traced"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ[WSGI_START_KEY] = default_timer()
+        return self.wsgi_app(environ, start_response)
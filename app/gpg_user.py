@@ -2,22 +2,34 @@
 # Copyright line goes here
 """
 users code that reads and writes to json file
-This code is not actually used, originally I wasn't sure I was going to create the backend so I started creating a
-    json backend (this).  I wanted to share this code I wrote for this project as it shows reading and writing from
-    json to classes (serialization / deserialization), class enheritance, etc.  Please note, I didn't fully test this
-    code as I replaced it when I was about 90% done
+Originally I wasn't sure I was going to create the backend so I started creating a json backend (this).  I wanted to
+    share this code I wrote for this project as it shows reading and writing from json to classes (serialization /
+    deserialization), class enheritance, etc.  It is now the document behind the file storage backend
+    (gpg_storage.FileUserRepository, user_storage=file), for single node deployments without Cassandra
+With a gpg_user_journal.UsersJournal the changes are appended to the journal and the document is a snapshot written
+when the journal is compacted, rather than the document being rewritten for every change
+The document is written to a temporary file that is renamed over it, so a crash while writing leaves the previous
+document, and with a write_delay the changes made within the delay are written together (write behind)
+The document is loaded a user at a time with gpg_json_stream, and in lazy mode each user is kept as a tuple of its
+fields until it is first looked up, so loading does not build every DomainUser and LocalUser up front
 """
 
 
 __author__ = "GGibson"
 
+from collections import namedtuple, OrderedDict
 import datetime
 import json
 import logging
-from operator import attrgetter, methodcaller
+from operator import methodcaller
 import os
+import stat
+import tempfile
+import threading
 import uuid
 
+from gpg_json_stream import iter_object
+from gpg_record import Record
 
 logger = logging.getLogger(__name__)
 user_conf_file = '/tmp/users.json'
@@ -47,11 +59,29 @@ class RemoveUserError(GpgUserExceptions):
     pass
 
 
+class UserExistsError(GpgUserExceptions):
+    pass
+
+
 class Users(object):
     """
     Class to contain the users information for creating the users document
+    The users are indexed by uuid, by (name, domain name) for domain users and by (name, hostname) for local users, so
+    lookups, adds and removes take the same time however many users there are.  Remove and add a user again to change
+    its name, domain name or hostname (or replace it), so the indexes stay consistent
     """
-    def __init__(self, users=None, date_created=None, date_modified=None):
+    def __init__(self, users=None, date_created=None, date_modified=None, conf_file=None, journal=None,
+                 compact_every=1000, write_delay=None, lazy=False):
+        """
+        :param conf_file: json file the users are loaded from and written to, defaults to user_conf_file
+        :param journal: gpg_user_journal.UsersJournal each change is appended to, None to only write the whole
+                        document with write_users
+        :param compact_every: journal records after which the document is written as a snapshot and the journal is
+                              emptied
+        :param write_delay: seconds write_users_later waits before writing the document, None to write at once
+        :param lazy: True to keep each loaded user as a tuple of its fields until it is first looked up
+        """
+        self.conf_file = conf_file or user_conf_file
         if date_created:
             self.date_created = date_created
         else:
@@ -62,23 +92,246 @@ class Users(object):
         else:
             self.date_modified = self.date_created
 
-        if users:
-            self.users = users
+        self.journal = journal
+        self.compact_every = compact_every
+        # sequence of the last journal record in the document
+        self.journal_sequence = 0
+        self.write_delay = write_delay
+        self.lazy = lazy
+        # changes to the users are made under the lock so the write behind thread copies a consistent set of users
+        self._lock = threading.RLock()
+        # one write of the document at a time, the versions stop an older copy of the users replacing a newer one
+        self._write_lock = threading.Lock()
+        self._version = 0
+        self._written_version = 0
+        self._write_timer = None
+        self.users = users or []
+
+    @property
+    def users(self):
+        """
+        the users, in the order they were added, as a tuple: it is a copy, change the users with add_user,
+        replace_user and the remove methods
+        """
+        return tuple(self._return_user(user_uuid) for user_uuid in list(self._users_by_uuid))
+
+    @users.setter
+    def users(self, users):
+        # the users (or their fields in lazy mode) by uuid, the name indexes hold the uuids
+        self._users_by_uuid = OrderedDict()
+        self._domain_user_uuids_by_name = {}
+        self._local_user_uuids_by_name = {}
+        for user in users:
+            if not self._index_user(user):
+                logger.warning('skipping user: "%s" as a user with the same uuid or name already exists', user)
+
+    def _return_index_keys(self, user):
+        """
+        :param user: UserAccount, or LazyUser in lazy mode
+        :return: the user uuid, the name index for the user type and the key of the user in it
+        :rtype: (str, dictionary, tuple)
+        """
+        if isinstance(user, LazyUser):
+            place = user.place
+        elif user.user_type == DomainUser.TYPE:
+            place = user.domain_name
         else:
-            self.users = []
+            place = user.hostname
+        if user.user_type == DomainUser.TYPE:
+            return user.user_uuid, self._domain_user_uuids_by_name, (user.name, place)
+        return user.user_uuid, self._local_user_uuids_by_name, (user.name, place)
+
+    def _is_new_user(self, user, replacing=False):
+        """
+        :param replacing: True if user replaces the user with the same uuid, which does not count as a user that exists
+        :return: False if a user with the same uuid, or the same name in the same domain or on the same host, exists
+        :rtype: bool
+        """
+        user_uuid, name_index, name_key = self._return_index_keys(user)
+        if not replacing and user_uuid in self._users_by_uuid:
+            return False
+        return name_index.get(name_key, user_uuid) == user_uuid
+
+    def _index_user(self, user):
+        """
+        Adds a user to the indexes
+        :return: False if a user with the same uuid, or the same name in the same domain or on the same host, exists
+        :rtype: bool
+        """
+        user_uuid, name_index, name_key = self._return_index_keys(user)
+        if user_uuid in self._users_by_uuid or name_key in name_index:
+            return False
+        self._users_by_uuid[user_uuid] = user
+        name_index[name_key] = user_uuid
+        self._version += 1
+        return True
+
+    def _unindex_user(self, user):
+        """Removes a user from the indexes"""
+        self._version += 1
+        user_uuid, name_index, name_key = self._return_index_keys(user)
+        del self._users_by_uuid[user_uuid]
+        del name_index[name_key]
+
+    def _swap_user(self, old_user, user):
+        """Replaces a user in the indexes with a user with the same uuid, keeping its place in the users order"""
+        self._version += 1
+        _, name_index, name_key = self._return_index_keys(old_user)
+        del name_index[name_key]
+        user_uuid, name_index, name_key = self._return_index_keys(user)
+        self._users_by_uuid[user_uuid] = user
+        name_index[name_key] = user_uuid
+
+    def _return_user(self, user_uuid):
+        """
+        Returns a user, building it from its fields the first time a user loaded in lazy mode is looked up
+        :return: User (UserAccount), None if there is no user with the uuid
+        """
+        user = self._users_by_uuid.get(user_uuid)
+        if isinstance(user, LazyUser):
+            with self._lock:
+                user = self._users_by_uuid.get(user_uuid)
+                if isinstance(user, LazyUser):
+                    user = user.return_user_object()
+                    # the same key, so the user keeps its place in the order
+                    self._users_by_uuid[user_uuid] = user
+        return user
+
+    def _return_loaded_user(self, user):
+        """
+        :param user: user json from the document or the journal
+        :return: LazyUser in lazy mode if the json has the user fields and only them, otherwise the User (UserAccount)
+        :raise UserJsonDocError if the user type is unknown
+        """
+        if self.lazy:
+            lazy_user = LazyUser.return_lazy_user(user)
+            if lazy_user:
+                return lazy_user
+        return UserAccount.return_user_object(user)
+
+    def _journal_change(self, operation, **fields):
+        """
+        Appends a change to the journal, before the change is made to the users
+        :param operation: add, replace or remove
+        :param fields: the user (json) for add and replace, the user_uuid for remove
+        :raise UserJsonDocError if the journal cannot be written
+        """
+        if self.journal is None:
+            return
+        self.date_modified = str(datetime.datetime.now())
+        try:
+            self.journal.append(dict(fields, op=operation, date_modified=self.date_modified))
+        except EnvironmentError:
+            message = 'failed to append to journal: "{0}"'.format(self.journal.journal_file)
+            logger.exception(message)
+            raise UserJsonDocError(message)
+
+    def _compact_if_due(self):
+        """Compacts the journal once it has compact_every records, the journal is kept if compaction fails"""
+        if self.journal is None or self.journal.records < self.compact_every:
+            return
+        try:
+            self.compact()
+        except UserJsonDocError:
+            logger.warning('failed to compact journal: "%s", retrying after the next change', self.journal.journal_file)
+
+    def compact(self):
+        """
+        Writes the document as a snapshot of the users and empties the journal
+        :raise UserJsonDocError if the document or the journal cannot be written
+        """
+        logger.debug('compacting journal: "%s" into: "%s"', self.journal.journal_file, self.conf_file)
+        self.write_users()
+        try:
+            self.journal.reset()
+        except EnvironmentError:
+            message = 'failed to empty journal: "{0}"'.format(self.journal.journal_file)
+            logger.exception(message)
+            raise UserJsonDocError(message)
+        logger.info('compacted journal: "%s" at sequence: %d', self.journal.journal_file, self.journal_sequence)
+
+    def _replay_journal(self):
+        """
+        Applies the journal records after the snapshot to the users
+        :raise UserJsonDocError if the journal cannot be read or has a record that cannot be applied
+        """
+        try:
+            records = self.journal.replay(self.journal_sequence)
+        except (EnvironmentError, ValueError):
+            message = 'failed to read journal: "{0}"'.format(self.journal.journal_file)
+            logger.exception(message)
+            raise UserJsonDocError(message)
+        for record in records:
+            operation = record.get('op')
+            if operation == 'remove':
+                user = self._users_by_uuid.get(record['user_uuid'])
+                if user:
+                    self._unindex_user(user)
+            elif operation == 'add':
+                self._index_user(self._return_loaded_user(record['user']))
+            elif operation == 'replace':
+                user = self._return_loaded_user(record['user'])
+                old_user = self._users_by_uuid.get(self._return_index_keys(user)[0])
+                if old_user:
+                    self._swap_user(old_user, user)
+                else:
+                    self._index_user(user)
+            else:
+                message = 'unknown operation: "{0}" in journal record: {1}'.format(operation, record['seq'])
+                logger.error(message)
+                raise UserJsonDocError(message)
+            self.date_modified = record['date_modified']
+
+    def __len__(self):
+        return len(self._users_by_uuid)
 
     def add_user(self, user):
         """
         Adds a user to the users list
         :param: user (User) either DomainUser or LocalUser
         :return: None
+        :raise UserExistsError: if a user with the same uuid, or the same name in the same domain or on the same host,
+                                exists
         """
         logger.debug('adding user: %s to users list', user)
-        if user in self.users:
-            logger.warning('cannot add user: "%s" to users list as user already exists', user)
-        self.users.append(user)
+        with self._lock:
+            if not self._is_new_user(user):
+                message = 'cannot add user: "{0}" to users list as user already exists'.format(user)
+                logger.error(message)
+                raise UserExistsError(message)
+            self._journal_change('add', user=user.return_json())
+            self._index_user(user)
+            self._compact_if_due()
         logger.info('successfully added user: %s to users list', user)
 
+    def replace_user(self, user):
+        """
+        Replaces the user with the same uuid, which can change its type, name, domain name or hostname
+        :param: user (User) either DomainUser or LocalUser
+        :return: None
+        :raise UserNameError: if there is no user with the uuid
+        :raise UserExistsError: if another user has the same name in the same domain or on the same host
+        """
+        logger.debug('replacing user: %s', user)
+        with self._lock:
+            old_user = self.return_user_by_uuid(user.user_uuid)
+            if not self._is_new_user(user, replacing=True):
+                message = 'cannot replace user: "{0}" as another user has the same name'.format(user)
+                logger.error(message)
+                raise UserExistsError(message)
+            self._journal_change('replace', user=user.return_json())
+            self._swap_user(old_user, user)
+            self._compact_if_due()
+        logger.info('successfully replaced user: %s', user)
+
+    def find_user_by_uuid(self, user_uuid):
+        """
+        Returns a user based on the user uuid
+        :param: user_uuid (str)
+        :return User (UserAccount), None if there is no user with the uuid
+        """
+        return self._return_user(user_uuid)
+
     def return_user_by_uuid(self, user_uuid):
         """
         Returns a user based on the user uuid
@@ -91,10 +344,10 @@ class Users(object):
             message = 'cannot find user by uuid as the uuid to remove was not provided'
             logger.error(message)
             raise UserNameError(message)
-        for user in self.users:
-            if user.user_uuid == user_uuid:
-                logger.debug('found user: %s', user)
-                return user
+        user = self._return_user(user_uuid)
+        if user:
+            logger.debug('found user: %s', user)
+            return user
         message = 'Failed to find user with uuid: "{0}"'.format(user_uuid)
         logger.error(message)
         raise UserNameError(message)
@@ -118,15 +371,11 @@ class Users(object):
             logger.error(error_message)
             raise UserNameError(error_message)
 
-        for user in self.users:
-            if user.user_type == DomainUser.TYPE and user.name == user_name:
-                if hasattr(user, 'domain_name'):
-                    if domain_name == user.domain_name:
-                        logger.debug('found user: %s', user)
-                        return user
-                else:
-                    logger.warning('Failed to find the domain_name attribute for the domain user')
-
+        user_uuid = self._domain_user_uuids_by_name.get((user_name, domain_name))
+        user = self._return_user(user_uuid) if user_uuid else None
+        if user:
+            logger.debug('found user: %s', user)
+            return user
         message = 'Failed to find user: "{0}", domain: "{1}"'.format(user_name, domain_name)
         logger.error(message)
         raise UserNameError(message)
@@ -150,15 +399,11 @@ class Users(object):
             logger.error(error_message)
             raise UserNameError(error_message)
 
-        for user in self.users:
-            if user.type == LocalUser.TYPE and user.name == user_name:
-                if hasattr(user, 'hostname'):
-                    if hostname == user.hostname:
-                        logger.debug('returning user: %s', user)
-                        return user
-                else:
-                    logger.warning('Failed to find the hostname attribute for the local user')
-
+        user_uuid = self._local_user_uuids_by_name.get((user_name, hostname))
+        user = self._return_user(user_uuid) if user_uuid else None
+        if user:
+            logger.debug('returning user: %s', user)
+            return user
         message = 'Failed to find user: "{0}", hostname: "{1}"'.format(user_name, hostname)
         logger.error(message)
         raise UserNameError(message)
@@ -222,12 +467,14 @@ class Users(object):
         if error_message:
             logger.error(error_message)
             raise RemoveUserError(error_message)
-        try:
-            self.users.remove(user)
-        except ValueError:
-            message = 'failed to remove user: {0}'.format(user)
-            logger.exception(message)
-            raise RemoveUserError(message)
+        with self._lock:
+            if self._users_by_uuid.get(user.user_uuid) is not user:
+                message = 'failed to remove user: {0}'.format(user)
+                logger.error(message)
+                raise RemoveUserError(message)
+            self._journal_change('remove', user_uuid=user.user_uuid)
+            self._unindex_user(user)
+            self._compact_if_due()
         logger.info('successfully removed user: "%s"', user)
 
     def return_user_names(self):
@@ -236,67 +483,168 @@ class Users(object):
         :rtype: List(str)
         """
         logger.debug('return list of user names')
-        return map(attrgetter('name'), self.users)
+        return [name for name, _ in self.iter_user_names_and_uuids()]
+
+    def iter_user_names_and_uuids(self):
+        """
+        Iterates the user names and uuids, without building the users not looked up yet in lazy mode
+        :return: generator of (name, uuid)
+        """
+        for user_uuid, user in self._users_by_uuid.items():
+            yield user.name, user_uuid
 
     def load_users(self):
         """
-        Loads the users from the user conf file
+        Loads the users from the user conf file, then replays the journal records after it if there is a journal
+        :raise UserJsonDocError if the file, or the journal, cannot be loaded
         """
-        logger.debug('entering load users conf (json) file: "%s"', user_conf_file)
-        self.users = []
-        users_doc = _load_json_document(user_conf_file)
-        if not users_doc:
-            message = 'failed to load user conf (json) file: "{0}"'.format(user_conf_file)
-            logger.error(message)
+        logger.debug('entering load users conf (json) file: "%s"', self.conf_file)
+        with self._lock:
+            self.users = []
+            users_doc = {}
+            if self.journal is not None and not os.path.isfile(self.conf_file):
+                logger.info('no snapshot: "%s", loading the users from the journal', self.conf_file)
+            else:
+                self._load_users_document(users_doc)
+            self.date_created = users_doc.get('date_created', self.date_created)
+            self.date_modified = users_doc.get('date_modified', self.date_modified)
+            if self.journal is not None:
+                self.journal_sequence = users_doc.get('journal_sequence', 0)
+                self._replay_journal()
+            self._written_version = self._version
+        logger.info('loaded %d users from: "%s"', len(self), self.conf_file)
+        logger.debug('completed loading users conf (json) file: "%s"', self.conf_file)
+
+    def _load_users_document(self, users_doc):
+        """
+        Adds the users of the user conf file a user at a time
+        :param users_doc: dictionary the other fields of the document are added to
+        :raise UserJsonDocError if the file cannot be read or parsed, the users loaded so far are dropped
+        """
+        try:
+            with open(self.conf_file, 'rb') as users_file:
+                for key, value in iter_object(users_file, 'users'):
+                    if key != 'users':
+                        users_doc[key] = value
+                    elif not self._index_user(self._return_loaded_user(value)):
+                        logger.warning('skipping user: "%s" as a user with the same uuid or name already exists',
+                                       value.get('name'))
+        except (EnvironmentError, ValueError):
+            self.users = []
+            message = 'failed to load user conf (json) file: "{0}"'.format(self.conf_file)
+            logger.exception(message)
             raise UserJsonDocError(message)
-        for user in users_doc['users']:
-            self.users.append(UserAccount.return_user_object(user))
-        logger.info('loaded users: %s', ', '.join(self.return_user_names()))
-        logger.debug('completed loading users conf (json) file: "%s"', user_conf_file)
 
     def write_users(self):
-        logger.debug('entering write users conf file: "%s"', user_conf_file)
+        """
+        Writes the whole document, with a journal the document is a snapshot of every change in the journal
+        :raise UserJsonDocError if the document cannot be written
+        """
+        logger.debug('entering write users conf file: "%s"', self.conf_file)
+        with self._lock:
+            if self.journal is not None:
+                self.journal_sequence = self.journal.sequence
+            document = self.return_json()
+            version = self._version
+        with self._write_lock:
+            if version < self._written_version:
+                logger.debug('skipping write of users conf file: "%s", newer users were written', self.conf_file)
+                return
+            try:
+                _write_json_document(self.conf_file, document)
+            except EnvironmentError:
+                message = 'failed to create user conf file: "{0}"'.format(self.conf_file)
+                logger.exception(message)
+                raise UserJsonDocError(message)
+            self._written_version = version
+        logger.debug('successfully wrote users conf file: "%s"', self.conf_file)
+
+    def write_users_later(self):
+        """
+        Writes the document write_delay seconds from now, with every change made by then, or at once without a
+        write_delay.  The write runs on a (non daemon) timer thread, so the interpreter waits for it before exiting
+        :raise UserJsonDocError if there is no write_delay and the document cannot be written
+        """
+        if not self.write_delay:
+            self.write_users()
+            return
+        with self._lock:
+            if self._write_timer is None:
+                self._write_timer = threading.Timer(self.write_delay, self._write_scheduled)
+                self._write_timer.start()
+
+    def _write_scheduled(self):
+        with self._lock:
+            self._write_timer = None
         try:
-            with open(user_conf_file, 'w') as users_file:
-                json.dump(self, users_file, default=methodcaller("return_json"), indent=4)
-        except EnvironmentError:
-            message = 'failed to create user conf file: "{0}"'.format(user_conf_file)
-            logger.exception(message)
-            raise UserJsonDocError(message)
-        logger.debug('successfully wrote users conf file: "%s"', user_conf_file)
+            self.write_users()
+        except UserJsonDocError:
+            logger.warning('failed the scheduled write of: "%s", retrying after the next change', self.conf_file)
+
+    def flush(self):
+        """
+        Makes the changes durable now: writes the document if changes are waiting for a scheduled write, or fsyncs
+        the journal if there is one
+        :raise UserJsonDocError if the document cannot be written
+        """
+        with self._lock:
+            write_timer, self._write_timer = self._write_timer, None
+        if write_timer:
+            write_timer.cancel()
+        if self.journal is not None:
+            self.journal.sync()
+        elif self._written_version < self._version:
+            self.write_users()
 
     def create_users(self):
         """
         Creates a sample user conf file
         """
-        logger.debug('creating user conf file: "%s"', user_conf_file)
+        logger.debug('creating user conf file: "%s"', self.conf_file)
         #users_list = []
-        self.users.append(DomainUser('bobHopeTestUser', 'wp', 'An account for Bob', 'Bob Hope', 'bobHope@bobby.com',
-                                     'a temp account for testing'))
-        self.users.append(DomainUser('bobHopeTestAdmin', 'wp', 'An admin account for Bob', 'Bob Hope',
-                                     'bobHope@bobby.com', 'a temp account for testing admin rights'))
-        self.users.append(LocalUser('smithers', 'smithers-lt', 'Smithers local user account for his laptop', 'Smithers',
-                                    'smithers@someone.com', 'smithers local account'))
+        self.add_user(DomainUser('bobHopeTestUser', 'wp', 'An account for Bob', 'Bob Hope', 'bobHope@bobby.com',
+                                 'a temp account for testing'))
+        self.add_user(DomainUser('bobHopeTestAdmin', 'wp', 'An admin account for Bob', 'Bob Hope',
+                                 'bobHope@bobby.com', 'a temp account for testing admin rights'))
+        self.add_user(LocalUser('smithers', 'smithers-lt', 'Smithers local user account for his laptop', 'Smithers',
+                                'smithers@someone.com', 'smithers local account'))
         self.write_users()
-        logger.info('successfully created user conf file: "%s"', user_conf_file)
+        logger.info('successfully created user conf file: "%s"', self.conf_file)
+
+    def close(self):
+        """Flushes the changes and closes the journal, if there is one"""
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def return_json(self):
-        return self.__dict__
+        # users not looked up yet in lazy mode are written without building them
+        users = [user.return_json() if isinstance(user, LazyUser) else user for user in self._users_by_uuid.values()]
+        document = {'users': users, 'date_created': self.date_created, 'date_modified': self.date_modified}
+        if self.journal is not None:
+            document['journal_sequence'] = self.journal_sequence
+        return document
+
 
+class UserAccount(Record):
+    """base class for user accounts, slotted and immutable (see gpg_record), replace returns a changed copy"""
+    FIELDS = ('name', 'description', 'owner', 'owner_email', 'notes', 'user_type', 'user_uuid')
 
-class UserAccount(object):
-    """base class for user accounts"""
     def __init__(self, name, description, owner, owner_email, notes, user_type, user_uuid=None):
-        self.name = name
-        self.description = description
-        self.owner = owner
-        self.owner_email = owner_email
-        self.notes = notes
-        self.user_type = user_type
-        if user_uuid:
-            self.user_uuid = user_uuid
-        else:
-            self.user_uuid = self._return_uuid()
+        # the fields are read only properties over these slots
+        self._name = name
+        self._description = description
+        self._owner = owner
+        self._owner_email = owner_email
+        self._notes = notes
+        self._user_type = user_type
+        self._user_uuid = user_uuid or self._return_uuid()
 
     @staticmethod
     def return_user_object(user):
@@ -370,16 +718,14 @@ class UserAccount(object):
         return 'name: {0} description: {1} owner: {2} owner email: {3} notes: {4} uuid: {5}'.format(
             self.name, self.description, self.owner, self.owner_email, self.notes, self.user_uuid)
 
-    def return_json(self):
-        return self.__dict__
-
 
 class DomainUser(UserAccount):
     TYPE = 'domainUser'
+    FIELDS = UserAccount.FIELDS + ('domain_name',)
 
     def __init__(self, name, domain_name, description, owner, owner_email, notes, user_type=None, user_uuid=None):
         super(DomainUser, self).__init__(name, description, owner, owner_email, notes, DomainUser.TYPE, user_uuid)
-        self.domain_name = domain_name
+        self._domain_name = domain_name
 
     def return_login_name(self):
         """
@@ -413,16 +759,14 @@ class DomainUser(UserAccount):
     def __str__(self):
         return '{0} domain: {1}'.format(super(DomainUser, self).__str__(), self.domain_name)
 
-    def return_json(self):
-        return self.__dict__
-
 
 class LocalUser(UserAccount):
     TYPE = 'localUser'
+    FIELDS = UserAccount.FIELDS + ('hostname',)
 
     def __init__(self, name, hostname, description, owner, owner_email, notes, user_type=None, user_uuid=None):
         super(LocalUser, self).__init__(name, description, owner, owner_email, notes, LocalUser.TYPE, user_uuid)
-        self.hostname = hostname
+        self._hostname = hostname
 
     def return_login_name(self):
         """
@@ -456,35 +800,68 @@ class LocalUser(UserAccount):
     def __str__(self):
         return '{0} hostname: {1}'.format(super(LocalUser, self).__str__(), self.hostname)
 
+
+class LazyUser(namedtuple('LazyUser', 'name place description owner owner_email notes user_type user_uuid')):
+    """
+    The fields of a user loaded in lazy mode, in the order of the DomainUser and LocalUser arguments, with place for
+    the domain name or hostname.  A tuple is built faster than the user object and takes less memory than its json
+    """
+    __slots__ = ()
+    PLACES = {DomainUser.TYPE: 'domain_name', LocalUser.TYPE: 'hostname'}
+
+    @classmethod
+    def return_lazy_user(cls, user):
+        """
+        :param user: user json
+        :return: LazyUser, None if the json has other fields than a DomainUser or LocalUser, or no uuid
+        """
+        place = cls.PLACES.get(user.get('user_type'))
+        if place not in user or not user.get('user_uuid') or len(user) != len(cls._fields):
+            return None
+        try:
+            return cls(user['name'], user[place], user['description'], user['owner'], user['owner_email'],
+                       user['notes'], DomainUser.TYPE if place == 'domain_name' else LocalUser.TYPE, user['user_uuid'])
+        except KeyError:
+            return None
+
+    def return_user_object(self):
+        """:rtype: DomainUser or LocalUser"""
+        return (DomainUser if self.user_type == DomainUser.TYPE else LocalUser)(*self)
+
     def return_json(self):
-        return self.__dict__
+        user = dict(zip(self._fields, self))
+        user[self.PLACES[self.user_type]] = user.pop('place')
+        return user
 
 
-def _load_json_document(json_file):
+def _write_json_document(json_file, document):
     """
-    Reads a Json document and returns that object so it can be read
-    :param json_file the Json file to load
-    :return object containing Json document, if the file is empty, not existing, or has a syntax error returns None
-    :Json
+    Writes a Json document to a temporary file in the same directory then renames it over json_file, so json_file is
+    either the previous document or the whole new one
+    :param json_file: the Json file to write
+    :param document: object to dump, objects with a return_json method are dumped with what it returns
+    :raise EnvironmentError if the document cannot be written
     """
-    logger.debug('entering load json document from file: "%s"', json_file)
-    if not os.path.isfile(json_file):
-        logger.error('Json file: "%s" does not exist, cannot load Json document', json_file)
-        return None
-    else:
-        logger.debug('Loaded Json file: "{0}"'.format(json_file))
+    directory = os.path.dirname(os.path.abspath(json_file))
+    temp_file = tempfile.NamedTemporaryFile('w', dir=directory, prefix=os.path.basename(json_file) + '.',
+                                            suffix='.tmp', delete=False)
+    try:
+        with temp_file:
+            json.dump(document, temp_file, default=methodcaller("return_json"), indent=4)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if os.path.isfile(json_file):
+            os.chmod(temp_file.name, stat.S_IMODE(os.stat(json_file).st_mode))
+        os.rename(temp_file.name, json_file)
+    except:
+        os.remove(temp_file.name)
+        raise
+    # the rename is durable once the directory is synced
+    directory_fd = os.open(directory, os.O_RDONLY)
     try:
-        with open(json_file) as fp:
-            data = fp.read()
-            json_document = json.loads(data.decode('utf-8-sig'))  # will work with or without BOM
-    except IOError:
-        logger.exception('Failed to read the Json file: "%s"', json_file)
-        return None
-    except ValueError:
-        logger.exception('Failed to parse Json file: "%s"', json_file)
-        return None
-    logger.debug('completed loading json document from file: "%s", document: %s', json_file, json_document)
-    return json_document
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
 
 
 def update_user(users, uuid, **kwargs):
@@ -503,7 +880,9 @@ def update_user(users, uuid, **kwargs):
         for key, value in kwargs.iteritems():
             if hasattr(user, key):
                 print('Update: "{0}" from: "{1}" to: "{2}"'.format(key, getattr(user, key), value))
-                setattr(user, key, value)
+                # users are immutable, the user is replaced by a changed copy
+                user = user.replace(**{key: value})
+                users.replace_user(user)
             else:
                 print('Warning, cannot update attribute: "{0}" as it does not exist', key)
     else:
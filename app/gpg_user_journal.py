@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Write ahead journal for the gpg_user.Users json document.  Each change to the users is appended to the journal as one
+compact json line, so a change costs a write the size of the change instead of rewriting the whole document.  The
+document becomes a snapshot: it is rewritten when the journal reaches a number of records (compaction) and records the
+sequence of the last journal record it contains, so loading replays only the journal records after it
+Durability policies, when the journal is fsynced:
+    always - after every record, a change is on disk before the call making it returns (the default)
+    interval - after a record when fsync_interval seconds have passed since the last fsync, so at most that long of
+               changes can be lost if the host fails.  Nothing is lost if only the process dies, every record is
+               written to the operating system before the call making the change returns
+    never - left to the operating system
+"""
+
+__author__ = "GGibson"
+
+import json
+import logging
+import os
+from timeit import default_timer
+
+logger = logging.getLogger(__name__)
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+class UsersJournal(object):
+    """
+    Appends journal records and reads them back.  Records are dictionaries, each one is given the next sequence (seq)
+    when appended.  Not thread safe, the owner of the journal serialises the changes
+    """
+
+    def __init__(self, journal_file, fsync=FSYNC_ALWAYS, fsync_interval=1.0):
+        """
+        :param journal_file: created on the first record if it does not exist
+        :param fsync: durability policy, one of FSYNC_POLICIES
+        :param fsync_interval: seconds between fsyncs for the interval policy
+        :raise ValueError if the policy is unknown
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('unknown journal fsync policy: "{0}", expected one of: {1}'.format(
+                fsync, ', '.join(FSYNC_POLICIES)))
+        self.journal_file = journal_file
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        # sequence of the last record appended or replayed
+        self.sequence = 0
+        # records in the journal file, the snapshot is due when there are too many
+        self.records = 0
+        self._file = None
+        self._last_fsync = default_timer()
+
+    def replay(self, after_sequence=0):
+        """
+        Reads the journal.  A last record without its new line was torn by a crash while it was being appended, it is
+        dropped and cut from the file so the next record starts on its own line
+        :param after_sequence: sequence of the last record in the snapshot, the records up to it are skipped
+        :return: the records after after_sequence, in order
+        :rtype: list
+        :raise ValueError if a whole record cannot be parsed
+        :raise EnvironmentError if the journal cannot be read
+        """
+        self.close()
+        self.sequence = after_sequence
+        self.records = 0
+        if not os.path.isfile(self.journal_file):
+            return []
+        with open(self.journal_file, 'rb') as journal:
+            data = journal.read()
+        lines = data.split('\n')
+        torn = lines.pop()
+        records = []
+        for line_number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError('failed to parse record {0} of journal: "{1}"'.format(line_number, self.journal_file))
+            self.records += 1
+            if record['seq'] > self.sequence:
+                records.append(record)
+                self.sequence = record['seq']
+        if torn:
+            logger.warning('dropping the torn last record of journal: "%s"', self.journal_file)
+            with open(self.journal_file, 'r+b') as journal:
+                journal.truncate(len(data) - len(torn))
+        logger.info('replaying %d of %d records from journal: "%s"', len(records), self.records, self.journal_file)
+        return records
+
+    def append(self, record):
+        """
+        Appends a record and fsyncs the journal per the durability policy
+        :param record: dictionary, written with the next sequence
+        :raise EnvironmentError if the journal cannot be written
+        """
+        self.sequence += 1
+        record = dict(record, seq=self.sequence)
+        if self._file is None:
+            self._file = open(self.journal_file, 'ab')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.records += 1
+        if self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL and
+                                          default_timer() - self._last_fsync >= self.fsync_interval):
+            self._fsync()
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+        self._last_fsync = default_timer()
+
+    def sync(self):
+        """fsyncs the records appended so far, whatever the policy"""
+        if self._file is not None:
+            self._fsync()
+
+    def reset(self):
+        """
+        Empties the journal, once a snapshot contains every record
+        :raise EnvironmentError if the journal cannot be written
+        """
+        self.close()
+        with open(self.journal_file, 'wb') as journal:
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(journal.fileno())
+        self.records = 0
+        logger.debug('emptied journal: "%s" at sequence: %d', self.journal_file, self.sequence)
+
+    def close(self):
+        """fsyncs the records not yet fsynced, unless the policy is never, and closes the journal"""
+        if self._file is None:
+            return
+        if self.fsync != FSYNC_NEVER:
+            self._fsync()
+        self._file.close()
+        self._file = None
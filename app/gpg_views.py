@@ -7,31 +7,134 @@ The Flask (Rest) API code for users
 __author__ = "GGibson"
 
 
-from flask import request, jsonify, make_response, Response
+from flask import g, request, jsonify, make_response, Response, stream_with_context
 import logging
 from operator import methodcaller
+import os
+from timeit import default_timer
 
 from app import app
+import gpg_bulk
+import gpg_cache
 import gpg_cassandra
+from gpg_cassandra_utility import session_manager
+import gpg_metrics
+import gpg_tracing
 import json
 import gpg_setup_logger
+import gpg_storage
+import uuid
 
 module = __name__
 log_file_name, module = gpg_setup_logger.create_log_file_name_and_module(__file__, __package__)
-gpg_setup_logger.setup_logger('/var/log/gpg', log_file_name, module=module, log_level=logging.DEBUG,
-                              use_console_logger=False)
+# request threads only queue log records, the file is written on a background thread.  Every gunicorn worker appends
+# to the same file, so it is not rotated by the workers (logrotate rotates it) and has no date suffix
+gpg_setup_logger.setup_logger('/var/log/gpg', log_file_name, module=module, use_date_suffix=False, rotate=False,
+                              log_level=gpg_setup_logger.return_level(os.environ.get('log_level', 'DEBUG')),
+                              use_console_logger=False, use_queue=True,
+                              queue_size=int(os.environ.get('log_queue_size', 10000)),
+                              queue_policy=os.environ.get('log_queue_policy', gpg_setup_logger.DROP))
 global logger
 logger = logging.getLogger(module)
 
+MAX_PAGE_SIZE = 1000
+STREAM_FETCH_SIZE = 1000
+EXPORT_TOKEN_RANGES = 64
+EXPORT_WORKERS = 8
+BULK_CONCURRENCY = 100
+BULK_CHUNK_SIZE = 1000
+MAX_LOOKUP_KEYS = 1000
+LOOKUP_CONCURRENCY = 100
+
+for stat in ('hits', 'misses', 'evictions', 'expirations'):
+    gpg_metrics.registry.function('user_cache_{0}_total'.format(stat), 'User cache {0}'.format(stat),
+                                  lambda stat=stat: gpg_cache.user_cache.stats().get(stat, 0), metric_type='counter')
+gpg_metrics.registry.function('user_cache_size', 'Entries in the user cache',
+                              lambda: gpg_cache.user_cache.stats().get('size', 0))
+for stat, help_text in (('sessions', 'Open shared Cassandra sessions'),
+                        ('hosts', 'Cassandra hosts with a connection pool'),
+                        ('connections', 'Open Cassandra connections'),
+                        ('in_flight', 'Cassandra requests in flight')):
+    gpg_metrics.registry.function('cassandra_{0}'.format(stat), help_text,
+                                  lambda stat=stat: session_manager.connection_stats()[stat])
+gpg_metrics.registry.function('log_records_dropped_total', 'Log records dropped because the log queue was full',
+                              gpg_setup_logger.return_dropped_record_count, metric_type='counter')
+
+
+app.wsgi_app = gpg_tracing.WsgiTimer(app.wsgi_app)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = default_timer()
+    if gpg_tracing.is_trace_requested(request.headers):
+        trace = gpg_tracing.start_trace()
+        # from the app receiving the request to the view: request context, url matching and before_request
+        wsgi_start = request.environ.get(gpg_tracing.WSGI_START_KEY, g.request_start)
+        trace.add_span('routing', default_timer() - wsgi_start)
+
+
+@app.after_request
+def record_request(response):
+    duration, trace = _record_request(response.status_code)
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.return_server_timing(duration)
+    return response
+
+
+@app.teardown_request
+def record_failed_request(exception):
+    # after_request is not called when the view raises
+    if exception is not None:
+        _record_request(500)
+    gpg_tracing.end_trace()
+
+
+def _record_request(status):
+    """
+    records the request metrics and writes slow requests to the slow request log
+    :return: seconds the request took, the request trace or None
+    """
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return None, None
+    g.request_start = None
+    duration = default_timer() - start
+    # the route pattern (not the path) keeps the label values bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    gpg_metrics.http_request_duration.observe((route, request.method, str(status)), duration)
+    trace = gpg_tracing.end_trace()
+    gpg_tracing.log_slow_request(request.method, request.path, status, duration, trace)
+    return duration, trace
+
+
+def _return_json_response(**return_json):
+    with gpg_tracing.span('json'):
+        return jsonify(**return_json)
+
+
+def _return_user_response(user, status=200):
+    with gpg_tracing.span('json'):
+        return Response(json.dumps(user, default=methodcaller("return_json"), indent=4, sort_keys=True),
+                        status=status, mimetype='application/json')
+
+
 @app.route('/')
 @app.route('/index')
 def index():
     calls = """
     GET /users - returns all users
+        ?limit=<n> - return at most n users and a next_page_token, ?page_token=<token> - return the next page
+        ?stream=true - stream all users as the pages are read
+    GET /users/export - stream every user record as newline delimited json
     GET /user/<user_name> - return user details
     POST /user - create user
+    POST /users/lookup - return the details of many users: {"names": [...], "ids": [...]}
+    POST /users/bulk - create users from a json array or newline delimited json (application/x-ndjson)
     PUT /user/<user_name> - update user
     DELETE /user/<user_name> - delete user
+    GET /cache/stats - user cache hit, miss and eviction counters
+    GET /metrics - request, Cassandra, cache and logging metrics in the Prometheus text format
 
     sample user values (create user and update user):
     {
@@ -48,17 +151,124 @@ def index():
 
 
 def return_all_users():
-    u = (gpg_cassandra.User.get_all_users())
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return return_all_users_stream()
+    if 'limit' in request.args or 'page_token' in request.args:
+        return return_users_page()
+    u = gpg_storage.repository.list_users()
     return_json = {'users': u}
     logger.info('calling [%s] %s', request.method, request.path)
-    logger.debug('completed [%s] %s, response: %s', request.method, request.path, return_json)
-    return jsonify(**return_json)
+    logger.debug('completed [%s] %s, users: %d', request.method, request.path, len(u))
+    return _return_json_response(**return_json)
+
+
+def return_users_page():
+    logger.info('calling [%s] %s', request.method, request.path)
+    limit = request.args.get('limit', str(MAX_PAGE_SIZE))
+    # a limit that is not a number is rejected rather than read as the default
+    if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+        return make_response("limit must be an integer between 1 and {0}".format(MAX_PAGE_SIZE), 400)
+    limit = int(limit)
+    try:
+        users, next_page_token = gpg_storage.repository.get_users_page(limit, request.args.get('page_token'))
+    except gpg_cassandra.PageTokenError as e:
+        return make_response(str(e), 400)
+    return_json = {'users': users, 'next_page_token': next_page_token}
+    logger.debug('completed [%s] %s, users: %d, next page token: %s', request.method, request.path, len(users),
+                 next_page_token)
+    return _return_json_response(**return_json)
+
+
+def return_all_users_stream():
+    """
+    streams {"users": {name: id, ...}} as the pages are read, so the full user list is never held in memory
+    """
+    logger.info('calling [%s] %s', request.method, request.path)
 
+    def generate():
+        yield '{"users": {'
+        separator = ''
+        count = 0
+        for name, user_id in gpg_storage.repository.iter_users(STREAM_FETCH_SIZE):
+            yield '{0}{1}: {2}'.format(separator, json.dumps(name), json.dumps(user_id))
+            separator = ', '
+            count += 1
+        yield '}}'
+        logger.debug('completed [%s] %s, streamed: %d users', request.method, request.path, count)
 
-def return_user_detail(user_object):
-    user_object.get_user_details()
-    return Response(json.dumps(user_object, default=methodcaller("return_json"), indent=4, sort_keys=True),
-                    status=200, mimetype='application/json')
+    return Response(stream_with_context(generate()), status=200, mimetype='application/json')
+
+
+def export_users():
+    """
+    streams every full user record as newline delimited json, the table is scanned by token range in parallel
+    """
+    logger.info('calling [%s] %s', request.method, request.path)
+
+    def generate():
+        for record in gpg_storage.repository.export_users(EXPORT_TOKEN_RANGES, EXPORT_WORKERS, STREAM_FETCH_SIZE):
+            yield json.dumps(record, sort_keys=True) + '\n'
+
+    return Response(stream_with_context(generate()), status=200, mimetype='application/x-ndjson')
+
+
+def lookup_users():
+    """
+    returns the details for a list of user names and/or ids, a key that is not found maps to null
+    """
+    logger.info('calling [%s] %s', request.method, request.path)
+    if request.mimetype != 'application/json':
+        return make_response("unsupported request mimetype: {}".format(request.mimetype), 415)
+    try:
+        keys = json.loads(request.data)
+    except ValueError as e:
+        return make_response("cannot parse json document: {0}".format(e), 400)
+    names = keys.get('names', []) if isinstance(keys, dict) else None
+    ids = keys.get('ids', []) if isinstance(keys, dict) else None
+    if not isinstance(names, list) or not isinstance(ids, list):
+        return make_response('expected a json object with "names" and/or "ids" lists', 400)
+    if not all(isinstance(key, basestring) for key in names + ids):
+        return make_response('user names and ids must be strings', 400)
+    names = list(set(names))
+    ids = list(set(ids))
+    if len(names) + len(ids) > MAX_LOOKUP_KEYS:
+        return make_response("cannot lookup more than {0} users in one request".format(MAX_LOOKUP_KEYS), 400)
+
+    requested_ids = []
+    for user_id in ids:
+        try:
+            requested_ids.append(uuid.UUID(str(user_id)))
+        except ValueError:
+            requested_ids.append(None)
+    name_records, id_records = gpg_storage.repository.lookup(names, requested_ids, LOOKUP_CONCURRENCY)
+    return_json = {'names': dict(zip(names, name_records)), 'ids': dict(zip(ids, id_records))}
+    logger.debug('completed [%s] %s, names: %d, ids: %d', request.method, request.path, len(names), len(ids))
+    return _return_json_response(**return_json)
+
+
+def bulk_create_users():
+    logger.info('calling [%s] %s', request.method, request.path)
+    if request.mimetype == 'application/x-ndjson':
+        records = gpg_bulk.iter_ndjson(request.stream)
+    elif request.mimetype == 'application/json':
+        try:
+            records = gpg_bulk.iter_json_array(request.data)
+        except gpg_bulk.BulkRecordError as e:
+            return make_response(str(e), 400)
+    else:
+        return make_response("unsupported request mimetype: {}".format(request.mimetype), 415)
+    results = list(gpg_storage.repository.create_many(records, BULK_CONCURRENCY, BULK_CHUNK_SIZE))
+    created = sum(1 for result in results if result['status'] == gpg_bulk.CREATED)
+    logger.debug('completed [%s] %s, created: %d, failed: %d', request.method, request.path, created,
+                 len(results) - created)
+    return _return_json_response(created=created, failed=len(results) - created, results=results)
+
+
+def return_user_detail(user_name, user_id):
+    record = gpg_storage.repository.get(user_id)
+    if record is None:
+        return make_response('user: {0} does not exist'.format(user_name), 400)
+    return _return_user_response(record)
 
 
 def create_user():
@@ -66,30 +276,51 @@ def create_user():
     if request.method == 'POST':
         if request.mimetype != 'application/json':
             return make_response("unsupported request mimetype: {}".format(request.mimetype), 415)
-        new_user = gpg_cassandra.User(**json.loads(request.data))
-        if ' ' in new_user.name:
-            return make_response("user name cannot have a space in it: {}".format(new_user.name), 400)
-        new_user.create_user()
-        new_user.get_user_details()
-        logger.debug('completed [%s] %s')
-        return Response(json.dumps(new_user, default=methodcaller("return_json"), indent=4, sort_keys=True),
-                        status=201, mimetype='application/json')
-
-
-def delete_user(user_object):
-    user_object.delete_user()
+        try:
+            values = json.loads(request.data)
+        except ValueError as e:
+            return make_response("cannot parse json document: {0}".format(e), 400)
+        if not isinstance(values, dict):
+            return make_response('expected a json object of user fields', 400)
+        name = values.get('name') or ''
+        if not isinstance(name, basestring):
+            return make_response("user name must be a string: {0}".format(name), 400)
+        if ' ' in name:
+            return make_response("user name cannot have a space in it: {}".format(name), 400)
+        try:
+            new_user = gpg_storage.repository.create(values)
+        except gpg_cassandra.UserExistsError as e:
+            return make_response(str(e), 409)
+        except gpg_cassandra.UserExceptions as e:
+            # unknown fields, no name or an id that is not a uuid
+            return make_response(str(e), 400)
+        logger.debug('completed [%s] %s, user: "%s"', request.method, request.path, new_user['name'])
+        return _return_user_response(new_user, 201)
+
+
+def delete_user(user_name, user_id):
+    gpg_storage.repository.delete(user_id, user_name)
     return Response('', status=200, mimetype='application/json')
 
 
-def update_user(user_name):
+def update_user(user_name, user_id):
     if request.mimetype != 'application/json':
         return make_response("unsupported request mimetype: {}".format(request.mimetype), 415)
-    user = gpg_cassandra.User(**json.loads(request.data))
-    user.name = user_name
-    user.update_user()
-    user.get_user_details()
-    return Response(json.dumps(user, default=methodcaller("return_json"), indent=4, sort_keys=True),
-                    status=200, mimetype='application/json')
+    try:
+        values = json.loads(request.data)
+    except ValueError as e:
+        return make_response("cannot parse json document: {0}".format(e), 400)
+    if not isinstance(values, dict):
+        return make_response('expected a json object of user fields', 400)
+    try:
+        record = gpg_storage.repository.update(user_id, values, user_name)
+    except gpg_cassandra.UserIdError as e:
+        # deleted since the id was read
+        return make_response(str(e), 404)
+    except gpg_cassandra.UpdateUserError as e:
+        # no updatable field set, or a value of the wrong type
+        return make_response(str(e), 400)
+    return _return_user_response(record)
 
 
 @app.route('/users', methods=['GET'])
@@ -100,6 +331,47 @@ def flask_users():
     return return_all_users()
 
 
+@app.route('/users/export', methods=['GET'])
+def flask_export_users():
+    """
+    return every user record as newline delimited json
+    """
+    return export_users()
+
+
+@app.route('/users/lookup', methods=['POST'])
+def flask_lookup_users():
+    """
+    return the details of many users by name and/or id
+    """
+    return lookup_users()
+
+
+@app.route('/users/bulk', methods=['POST'])
+def flask_bulk_users():
+    """
+    create many users, returns the result for each one
+    """
+    return bulk_create_users()
+
+
+@app.route('/cache/stats', methods=['GET'])
+def flask_cache_stats():
+    """
+    return the user cache counters
+    """
+    return jsonify(**gpg_cache.user_cache.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def flask_metrics():
+    """
+    return the metrics of this worker process in the Prometheus text format
+    """
+    return Response(gpg_metrics.registry.render(), status=200,
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/user', methods=['POST'])
 def flask_user():
     """
@@ -113,14 +385,14 @@ def flask_update_user(user_name):
     """
     return a json list of user details, update user, delete user
     """
-    # verify the user id exists
-    user_object = gpg_cassandra.User(name=user_name)
-    user_object.return_user_id_by_name()
-    if not user_object.user_id:
+    # verify the user id exists, updates and deletes read it from the lookup table rather than a cached id that
+    # another worker may have made stale
+    user_id = gpg_storage.repository.get_id_by_name(user_name, cached=request.method == 'GET')
+    if not user_id:
         return make_response('user: {0} does not exist'.format(user_name), 400)
     if request.method == 'GET':
-        return return_user_detail(user_object)
+        return return_user_detail(user_name, user_id)
     if request.method == 'PUT':
-        return update_user(user_name)
+        return update_user(user_name, user_id)
     if request.method == 'DELETE':
-        return delete_user(user_object)
+        return delete_user(user_name, user_id)
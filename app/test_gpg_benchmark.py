@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_benchmark.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_benchmark.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import os
+import unittest
+
+os.environ.setdefault('contact_points', '127.0.0.1')
+
+from gpg_benchmark import Benchmark, compare_results
+
+
+def return_results(threads=1, **route):
+    values = {'requests': 10, 'errors': 0, 'throughput': 100.0, 'mean_ms': 10.0, 'p50_ms': 10.0, 'p99_ms': 20.0,
+              'max_ms': 25.0, 'statements_per_request': 2.0}
+    values.update(route)
+    return {'meta': {'mode': 'fake', 'latency': 0.001, 'requests': 10, 'threads': threads, 'users': 10,
+                     'cache': 'lru'},
+            'routes': {'get_user': values}}
+
+
+class CompareTests(unittest.TestCase):
+
+    def test_no_regression(self):
+        """changes within max_regression are not regressions"""
+        self.assertEqual(compare_results(return_results(), return_results(p99_ms=23.0, throughput=85.0), 0.2), [])
+
+    def test_regressions(self):
+        regressions = compare_results(return_results(), return_results(p50_ms=13.0, throughput=70.0,
+                                                                       statements_per_request=3.0), 0.2)
+        self.assertEqual(regressions, ['get_user: p50_ms 10.0 -> 13.0', 'get_user: throughput 100.0 -> 70.0',
+                                       'get_user: statements_per_request 2.0 -> 3.0'])
+
+    def test_statements_with_threads(self):
+        """statement counts vary with more than one thread, they are not compared"""
+        self.assertEqual(compare_results(return_results(4), return_results(4, statements_per_request=3.0)), [])
+
+    def test_different_settings(self):
+        self.assertRaises(ValueError, compare_results, return_results(), return_results(4))
+
+
+class FakeBenchmarkTests(unittest.TestCase):
+
+    def test_run(self):
+        """every route runs without errors against the fake session"""
+        results = Benchmark(latency=0, requests=3, warmup=1, users=20).run()
+        routes = results['routes']
+        self.assertEqual(len(routes), 12)
+        self.assertEqual(sum(route['errors'] for route in routes.values()), 0)
+        # delete reads the id from users_by_name, never the cache, before deleting both rows
+        self.assertEqual([routes[name]['statements_per_request'] for name in ('get_users', 'create_user',
+                                                                                'delete_user')], [1, 2, 3])
+        self.assertEqual(results['meta']['mode'], 'fake')
+
+    def test_memory_mode(self):
+        """no CQL is run on the memory storage backend"""
+        routes = Benchmark('memory', requests=2, warmup=1, users=20).run()['routes']
+        self.assertEqual(sum(route['errors'] for route in routes.values()), 0)
+        self.assertEqual(sum(route['statements_per_request'] for route in routes.values()), 0)
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, Benchmark, 'sqlite')
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_cache.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_cache.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from gpg_cache import LRUCache, NullCache, UserCache, return_backend_from_environment
+from gpg_record import UserRecord
+from gpg_invalidation import FileInvalidationBus, LocalInvalidationBus
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BackendFromEnvironmentTests(unittest.TestCase):
+    """return_backend_from_environment"""
+
+    def setUp(self):
+        self.backend_name = os.environ.pop('user_cache_backend', None)
+
+    def tearDown(self):
+        if self.backend_name is not None:
+            os.environ['user_cache_backend'] = self.backend_name
+
+    def _return_bus(self):
+        bus = LocalInvalidationBus('test')
+        self.addCleanup(bus.close)
+        return bus
+
+    def test_default_needs_bus(self):
+        """without an invalidation bus the workers would serve each other's stale entries, nothing is cached"""
+        self.assertIsInstance(return_backend_from_environment(), NullCache)
+        self.assertIsInstance(return_backend_from_environment(self._return_bus()), LRUCache)
+
+    def test_named_backend(self):
+        os.environ['user_cache_backend'] = 'lru'
+        self.assertIsInstance(return_backend_from_environment(), LRUCache)
+        os.environ['user_cache_backend'] = 'none'
+        self.assertIsInstance(return_backend_from_environment(self._return_bus()), NullCache)
+        del os.environ['user_cache_backend']
+
+
+class LRUCacheTests(unittest.TestCase):
+    """LRUCache"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_size=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        """get - hits and misses are counted"""
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_ttl(self):
+        """get - entries older than the ttl are misses"""
+        self.cache.set('a', 1)
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual((self.cache.expirations, self.cache.stats()['size']), (1, 0))
+
+    def test_evicts_least_recently_used(self):
+        """set - the least recently used entry is evicted at max size"""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_delete(self):
+        """delete"""
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+        self.cache.delete('b')
+        self.assertIsNone(self.cache.get('a'))
+
+
+class UserCacheTests(unittest.TestCase):
+    """UserCache"""
+
+    def test_invalidate(self):
+        """invalidate - removes the name and the record"""
+        cache = UserCache(LRUCache())
+        cache.set_user_id('bob', 'id1')
+        cache.set_record('id1', {'name': 'bob'})
+        cache.invalidate('bob', 'id1')
+        self.assertIsNone(cache.get_user_id('bob'))
+        self.assertIsNone(cache.get_record('id1'))
+
+    def test_record_is_copied(self):
+        """get_record - changing the returned record does not change the cache"""
+        cache = UserCache(LRUCache())
+        cache.set_record('id1', {'name': 'bob'})
+        cache.get_record('id1')['name'] = 'changed'
+        self.assertEqual(cache.get_record('id1'), {'name': 'bob'})
+
+    def test_full_record(self):
+        """set_record - a record with every user field is held as a UserRecord and handed out as a dictionary"""
+        cache = UserCache(LRUCache())
+        record = dict((field, None) for field in UserRecord.FIELDS)
+        cache.set_record('id1', dict(record, name='bob'))
+        self.assertIsInstance(cache.backend.get(UserCache.ID_PREFIX + 'id1'), UserRecord)
+        self.assertEqual(cache.get_record('id1'), dict(record, name='bob'))
+
+
+class InvalidationBusTests(unittest.TestCase):
+    """invalidations reach the caches of other instances"""
+
+    def setUp(self):
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.set_bus(None)
+
+    def _return_cache(self, bus):
+        cache = UserCache(LRUCache(), bus)
+        cache.set_user_id('bob', 'id1')
+        cache.set_record('id1', {'name': 'bob'})
+        self.caches.append(cache)
+        return cache
+
+    def test_local_bus(self):
+        """LocalInvalidationBus - an invalidation on one cache evicts from the other"""
+        first = self._return_cache(LocalInvalidationBus('test'))
+        second = self._return_cache(LocalInvalidationBus('test'))
+        first.invalidate('bob', 'id1')
+        self.assertIsNone(second.get_user_id('bob'))
+        self.assertIsNone(second.get_record('id1'))
+
+    def test_origin_per_process(self):
+        """a worker forked from the process that built the bus does not drop a sibling's message as its own"""
+        cache = self._return_cache(LocalInvalidationBus('test'))
+        # sent by a sibling worker, which inherited the same bus
+        message = cache.bus._encode('bob', 'id1')
+        cache.bus._deliver(message)
+        self.assertEqual(cache.get_user_id('bob'), 'id1')
+        # the pid the origin was made in is not this process, as in a child after a fork
+        cache.bus._origin_pid = os.getpid() + 1
+        cache.bus._deliver(message)
+        self.assertIsNone(cache.get_user_id('bob'))
+
+    def test_file_bus(self):
+        """FileInvalidationBus - an invalidation written to the file evicts from the other cache"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'invalidations')
+        first = self._return_cache(FileInvalidationBus(path, poll_interval=0.01))
+        second = self._return_cache(FileInvalidationBus(path, poll_interval=0.01))
+        first.invalidate(user_id='id1')
+        for i in range(200):
+            if second.backend.get('id:id1') is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(second.get_record('id1'))
+        self.assertEqual(second.get_user_id('bob'), 'id1')
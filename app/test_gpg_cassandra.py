@@ -15,7 +15,7 @@ import unittest
 import uuid
 import logging
 
-from gpg_cassandra import User, UserIdError, UpdateUserError
+from gpg_cassandra import User, UserExistsError, UserIdError, UpdateUserError
 import gpg_setup_logger
 
 module = __name__
@@ -31,28 +31,6 @@ def return_random_string(length):
     return ''.join(random.choice(string.lowercase) for i in range(length))
 
 
-class VerifyUserIdAndNameNotExist(unittest.TestCase):
-    """_verify_user_id_and_name_not_exist"""
-
-    def test_verify_existing_user_name_already_exists(self):
-        """_verify_user_id_and_name_not_exist - existing name"""
-        my_user = User(name='testUser1')
-        with self.assertRaises(UserIdError):
-            my_user._verify_user_id_and_name_not_exist()
-
-    def test_verify_existing_user_id_already_exists(self):
-        """_verify_user_id_and_name_not_exist existing id"""
-        my_user = User(user_id='f5c54eea-a9e8-4f81-898e-b965675f46b4', name='smithers')
-        with self.assertRaises(UserIdError):
-            my_user._verify_user_id_and_name_not_exist()
-
-    def test_verify_non_existing_user_works(self):
-        """_verify_user_id_and_name_not_exist - new user"""
-        my_user = User(user_id='f5c54eea-a9e8-4f81-898e-b3a5675f6fa4', name='non_existing_user')
-        my_user._verify_user_id_and_name_not_exist()
-        # it worked if we didn't get an exception!
-
-
 class GetAllUsers(unittest.TestCase):
     """"get_all_users"""
 
@@ -78,12 +56,24 @@ class CreateUser(unittest.TestCase):
         # if we got here it worked!
 
     def test_create_user_alerady_exists(self):
-        """create_user - existing"""
+        """create_user - existing name, the name claim (IF NOT EXISTS) is not applied"""
         u_name = 'testUser1'
         my_user = User(name=u_name, description='user account for {0}'.format(u_name), owner='Bob Hope',
                         owner_email='bob.hope@funny.com', is_domain=True, domain='funny.man')
-        with self.assertRaises(UserIdError):
+        with self.assertRaises(UserExistsError):
+            my_user.create_user()
+        self.assertEqual(User(name=u_name).return_user_id_by_name(),
+                         uuid.UUID('f5c54eea-a9e8-4f81-898e-b965675f46b4'))
+
+    def test_create_user_id_already_exists(self):
+        """create_user - existing id, the users_tbl insert (IF NOT EXISTS) is not applied and the name is released"""
+        u_name = return_random_string(7)
+        my_user = User(user_id='f5c54eea-a9e8-4f81-898e-b965675f46b4', name=u_name)
+        with self.assertRaises(UserExistsError):
             my_user.create_user()
+        self.assertIsNone(User(name=u_name).return_user_id_by_name())
+        self.assertEqual(User(name='testUser1').return_user_id_by_name(),
+                         uuid.UUID('f5c54eea-a9e8-4f81-898e-b965675f46b4'))
 
 
 class ReturnUserIdByName(unittest.TestCase):
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for the session manager in gpg_cassandra_utility.py, against the fake cluster and session (no live cluster
+needed)
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_cassandra_utility.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import os
+import threading
+import time
+import unittest
+
+os.environ.setdefault('contact_points', '127.0.0.1')
+
+from gpg_cassandra_utility import PreparedStatementRegistry, SessionManager
+from gpg_fake_cassandra import FakeCluster, FakeSession
+
+
+class PreparingSession(FakeSession):
+    """records every command prepared, slowly enough for threads to race"""
+
+    def __init__(self):
+        super(PreparingSession, self).__init__()
+        self.prepared = []
+
+    def prepare(self, command):
+        time.sleep(0.01)
+        self.prepared.append(command)
+        return super(PreparingSession, self).prepare(command)
+
+
+class CountingCluster(FakeCluster):
+    """connects a new FakeSession for every cluster, slowly enough for threads to race, and records the shutdowns"""
+    connects = []
+    shutdowns = []
+
+    def connect(self, keyspace=None):
+        time.sleep(0.01)
+        session = PreparingSession()
+        session.cluster = self
+        CountingCluster.connects.append((keyspace, session))
+        return session
+
+    def shutdown(self):
+        CountingCluster.shutdowns.append(self)
+
+
+class SessionManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        CountingCluster.connects = []
+        CountingCluster.shutdowns = []
+        self.manager = SessionManager(cluster_factory=CountingCluster)
+
+    def test_shared_session(self):
+        """one session per contact points, port and keyspace"""
+        session = self.manager.get_session(['10.0.0.1', '10.0.0.2'], 'users')
+        self.assertIs(self.manager.get_session(('10.0.0.1', '10.0.0.2'), 'users'), session)
+        self.assertIsNot(self.manager.get_session(['10.0.0.1', '10.0.0.2'], 'other'), session)
+        self.assertIsNot(self.manager.get_session(['10.0.0.1'], 'users'), session)
+        self.assertIsNot(self.manager.get_session(['10.0.0.1', '10.0.0.2'], 'users', port=9043), session)
+        self.assertEqual((self.manager.session_count(), len(CountingCluster.connects)), (4, 4))
+
+    def test_shut_down_session(self):
+        """a session shut down is replaced on the next use"""
+        session = self.manager.get_session(['10.0.0.1'], 'users')
+        session.is_shutdown = True
+        self.assertIsNot(self.manager.get_session(['10.0.0.1'], 'users'), session)
+        self.assertEqual(self.manager.session_count(), 1)
+
+    def test_new_process(self):
+        """the sessions inherited through a fork are dropped, not shut down, and connected again"""
+        session = self.manager.get_session(['10.0.0.1'], 'users')
+        # the pid the manager was last used in is not this process, as in a child after a fork
+        self.manager._pid = os.getpid() + 1
+        self.assertEqual(self.manager.session_count(), 0)
+        self.assertEqual(self.manager._pid, os.getpid())
+        self.assertIsNot(self.manager.get_session(['10.0.0.1'], 'users'), session)
+        self.assertEqual(CountingCluster.shutdowns, [])
+
+    def test_shutdown_in_other_process(self):
+        """shutdown does not shut down the sessions of the parent process"""
+        self.manager.get_session(['10.0.0.1'], 'users')
+        self.manager._pid = os.getpid() + 1
+        self.manager.shutdown()
+        self.assertEqual((self.manager._sessions, CountingCluster.shutdowns), ({}, []))
+
+    def test_shutdown(self):
+        self.manager.get_session(['10.0.0.1'], 'users')
+        self.manager.get_session(['10.0.0.1'], 'other')
+        self.manager.shutdown()
+        self.assertEqual((self.manager.session_count(), len(CountingCluster.shutdowns)), (0, 2))
+
+    def test_concurrent_first_use(self):
+        """threads racing to use a new session connect once"""
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(self.manager.get_session(['10.0.0.1'], 'users')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(CountingCluster.connects), 1)
+        self.assertEqual(set(map(id, sessions)), set([id(CountingCluster.connects[0][1])]))
+
+
+class PreparedStatementTests(unittest.TestCase):
+    command = 'SELECT id FROM users.users_by_name WHERE name=?;'
+
+    def setUp(self):
+        CountingCluster.connects = []
+        self.manager = SessionManager(cluster_factory=CountingCluster)
+
+    def test_prepared_once_per_session(self):
+        statement = self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users')
+        self.assertIs(self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users'), statement)
+        other = self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'other')
+        self.assertIsNot(other, statement)
+        sessions = [self.manager.get_session(['10.0.0.1'], keyspace) for keyspace in ('users', 'other')]
+        self.assertEqual([session.prepared for session in sessions], [[self.command], [self.command]])
+
+    def test_cleared_on_reset(self):
+        """the statements of a dropped session are prepared again on its replacement"""
+        statement = self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users')
+        self.manager.reset()
+        self.assertEqual(self.manager._registries, {})
+        self.assertIsNot(self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users'), statement)
+        self.assertEqual(self.manager.get_session(['10.0.0.1'], 'users').prepared, [self.command])
+
+    def test_cleared_after_fork(self):
+        self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users')
+        self.manager._pid = os.getpid() + 1
+        self.manager.get_prepared_statement(self.command, ['10.0.0.1'], 'users')
+        self.assertEqual([len(session.prepared) for keyspace, session in CountingCluster.connects], [1, 1])
+
+    def test_concurrent_prepare(self):
+        """threads racing to use a new command prepare it once"""
+        registry = PreparedStatementRegistry(PreparingSession())
+        statements = []
+        threads = [threading.Thread(target=lambda: statements.append(registry.get(self.command))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((registry.session.prepared, len(registry)), ([self.command], 1))
+        self.assertEqual(len(set(map(id, statements))), 1)
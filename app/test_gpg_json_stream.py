@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_json_stream.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_json_stream.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import codecs
+from io import BytesIO
+import json
+import unittest
+
+from gpg_json_stream import iter_object
+
+DOCUMENT = {'date_created': '2016-10-01', 'users': [{'name': u'b\xf6b', 'n': 12345}, {'name': 'smithers'}, [], 678],
+            'journal_sequence': 1234567, 'flags': [True, None]}
+
+
+def return_items(data, chunk_size):
+    return list(iter_object(BytesIO(data), 'users', chunk_size))
+
+
+class StreamTests(unittest.TestCase):
+
+    def test_chunk_sizes(self):
+        """the same items whether values are split over chunks or not, including numbers split at a chunk end"""
+        data = json.dumps(DOCUMENT, indent=4)
+        expected = sorted((key, value) for key, value in DOCUMENT.items() if key != 'users')
+        for chunk_size in (1, 2, 7, 64, 100000):
+            items = return_items(data, chunk_size)
+            self.assertEqual([value for key, value in items if key == 'users'], DOCUMENT['users'])
+            self.assertEqual(sorted(item for item in items if item[0] != 'users'), expected)
+
+    def test_bom_and_empty(self):
+        self.assertEqual(return_items(codecs.BOM_UTF8 + '{"users": [ ], "a": 1}', 3), [('a', 1)])
+        self.assertEqual(return_items(' {} ', 1), [])
+
+    def test_stream_key_not_an_array(self):
+        self.assertEqual(return_items('{"users": {"a": 1}}', 4), [('users', {'a': 1})])
+
+    def test_bad_documents(self):
+        for data in ('', '[]', '{"users": [{"name": "a"} {"name": "b"}]}', '{"users": [{"name": "a"}', '{1: 2}',
+                     '{"a": 1} {}', '{"a": tru}'):
+            self.assertRaises(ValueError, return_items, data, 4)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_load_generator.py, the load is sent to the app served on a local port against a fake Cassandra session
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_load_generator.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import os
+import random
+import socket
+import threading
+import unittest
+
+from werkzeug.serving import make_server
+
+os.environ.setdefault('contact_points', '127.0.0.1')
+
+from app import app
+import gpg_cache
+from gpg_fake_cassandra import FakeSession, install, uninstall
+from gpg_load_generator import LoadError, LoadGenerator, parse_mix, return_request, UserNames
+
+
+class MixTests(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix('get_user=90, update_user=10,'), [('get_user', 90.0), ('update_user', 10.0)])
+
+    def test_default_weight(self):
+        self.assertEqual(parse_mix('get_users'), [('get_users', 1.0)])
+
+    def test_bad_mix(self):
+        for mix in ('get_user=90,select_user=10', 'get_user=often', 'get_user=0', ''):
+            self.assertRaises(ValueError, parse_mix, mix)
+
+    def test_delete_without_created_user(self):
+        """delete_user is skipped until a user has been created"""
+        names = UserNames(['seeded'], 'created')
+        self.assertIsNone(return_request('delete_user', names))
+        names.created(names.new())
+        self.assertEqual(return_request('delete_user', names), ('DELETE', '/user/created-1', None))
+
+    def test_no_server(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{0}'.format(listener.getsockname()[1])
+        listener.close()
+        self.assertRaises(LoadError, LoadGenerator(url, rate=10, duration=0.1).run)
+
+
+class LoadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        install(self.session)
+        gpg_cache.user_cache.set_backend(gpg_cache.LRUCache())
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        uninstall()
+
+    def _check_report(self, report):
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertEqual(sum(summary['requests'] for summary in report['calls'].values()),
+                         report['total']['requests'])
+        # the seeded users and the users created during the run are deleted afterwards
+        self.assertEqual(self.session.users, {})
+
+    def test_open_loop(self):
+        """requests are sent at the rate for the duration"""
+        report = LoadGenerator(self.url, rate=100, duration=0.5, connections=4, users=5,
+                               random_source=random.Random(1)).run()
+        self.assertEqual(report['total']['requests'] + report['meta']['skipped'], 50)
+        self.assertEqual(report['meta']['loop'], 'open')
+        self._check_report(report)
+
+    def test_closed_loop(self):
+        report = LoadGenerator(self.url, concurrency=2, duration=0.3, users=5, random_source=random.Random(1)).run()
+        self.assertGreater(report['total']['requests'], 0)
+        self.assertEqual(report['meta']['loop'], 'closed')
+        self._check_report(report)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_metrics.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_metrics.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import threading
+import unittest
+
+from gpg_metrics import Counter, Histogram, MetricsRegistry, return_statement_type
+from gpg_cassandra import User
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_counter_shards(self):
+        """each thread records to its own shard, the value is the sum"""
+        counter = Counter('test_total', 'test', ('route',))
+
+        def record():
+            for i in range(1000):
+                counter.inc(('/users',))
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(('/users',)), 4000)
+        self.assertEqual(len(counter._shards), 4)
+
+    def test_histogram_render(self):
+        """buckets are cumulative and include +Inf, _count and _sum follow"""
+        histogram = Histogram('test_seconds', 'test', ('route',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(('/user',), value)
+        self.assertEqual(histogram.render().split('\n'), [
+            '# HELP test_seconds test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="/user",le="0.1"} 2',
+            'test_seconds_bucket{route="/user",le="1.0"} 3',
+            'test_seconds_bucket{route="/user",le="+Inf"} 4',
+            'test_seconds_sum{route="/user"} 5.65',
+            'test_seconds_count{route="/user"} 4'])
+
+    def test_function_and_duplicate_names(self):
+        registry = MetricsRegistry()
+        registry.function('test_size', 'size', lambda: 3)
+        self.assertIn('test_size 3\n', registry.render())
+        self.assertRaises(ValueError, registry.counter, 'test_size', 'size')
+
+    def test_statement_type(self):
+        self.assertEqual(return_statement_type(User.USER_ID_BY_NAME_COMMAND), 'select users_by_name')
+        self.assertEqual(return_statement_type(User.CREATE_USER_COMMAND), 'insert users_tbl lwt')
+        self.assertEqual(return_statement_type('UPDATE users.users_tbl SET notes=? WHERE id=?;'), 'update users_tbl')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_record.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_record.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import pickle
+import unittest
+
+from gpg_record import UserRecord
+from gpg_user import DomainUser, LocalUser
+
+
+def return_record(**fields):
+    values = {'user_id': 'f5c54eea-a9e8-4f81-898e-b965675f46b4', 'name': 'bob', 'description': 'an account',
+              'owner': 'Bob Hope', 'owner_email': 'bob@bobby.com', 'notes': None, 'is_domain': True, 'domain': 'wp'}
+    values.update(fields)
+    return UserRecord.from_dict(values)
+
+
+class RecordTests(unittest.TestCase):
+
+    def test_dict_round_trip(self):
+        record = return_record()
+        self.assertEqual(UserRecord.from_dict(record.return_dict()), record)
+        self.assertEqual(record.return_json()['domain'], 'wp')
+        self.assertEqual(UserRecord(name='bob').return_dict()['notes'], None)
+
+    def test_immutable(self):
+        record = return_record()
+        self.assertRaises(AttributeError, setattr, record, 'name', 'changed')
+        self.assertRaises(AttributeError, setattr, record, 'other', 'value')
+        self.assertRaises(AttributeError, delattr, record, 'name')
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_replace(self):
+        """replace returns a changed copy"""
+        record = return_record()
+        changed = record.replace(notes='moved')
+        self.assertEqual((record.notes, changed.notes, changed.name), (None, 'moved', 'bob'))
+        self.assertRaises(TypeError, record.replace, unknown='value')
+
+    def test_unknown_fields(self):
+        self.assertRaises(TypeError, UserRecord.from_dict, {'name': 'bob', 'unknown': 'value'})
+        self.assertRaises(TypeError, UserRecord, 'id', name='bob', user_id='id')
+        self.assertRaises(TypeError, UserRecord, *range(9))
+
+    def test_equal_and_hash(self):
+        self.assertEqual(return_record(), return_record())
+        self.assertNotEqual(return_record(), return_record(name='other'))
+        self.assertEqual(len(set([return_record(), return_record()])), 1)
+
+    def test_pickle(self):
+        record = return_record()
+        self.assertEqual(pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)), record)
+
+
+class UserAccountTests(unittest.TestCase):
+
+    def test_slotted(self):
+        user = DomainUser('bob', 'wp', 'an account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+        self.assertFalse(hasattr(user, '__dict__'))
+        self.assertRaises(AttributeError, setattr, user, 'notes', 'changed')
+        self.assertEqual(DomainUser.return_user_object(user.return_json()), user)
+
+    def test_replace(self):
+        user = LocalUser('bob', 'laptop', 'a local account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+        moved = user.replace(hostname='desktop')
+        self.assertIsInstance(moved, LocalUser)
+        self.assertEqual((moved.hostname, moved.user_uuid, moved.user_type), ('desktop', user.user_uuid, 'localUser'))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for the queue logging mode of gpg_setup_logger.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_setup_logger.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from gpg_setup_logger import (BLOCK, DROP, LogSampler, QueueHandler, QueueListener, return_file_handler, return_level,
+                              return_levels_from_environment)
+
+
+class ListHandler(logging.Handler):
+    """keeps the messages it handles, optionally waiting for an event before each one"""
+
+    def __init__(self, gate=None):
+        super(ListHandler, self).__init__()
+        self.messages = []
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate:
+            self.gate.wait()
+        self.messages.append(self.format(record))
+
+
+class QueueLoggingTests(unittest.TestCase):
+
+    def _return_logger(self, handler):
+        logger = logging.getLogger('test_gpg_setup_logger.{0}'.format(id(handler)))
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return logger
+
+    def test_records_written_by_listener(self):
+        """records are formatted and written by the listener thread, in order"""
+        target = ListHandler()
+        target.setLevel(logging.INFO)
+        listener = QueueListener([target])
+        logger = self._return_logger(QueueHandler(listener))
+        logger.debug('skipped by the handler level')
+        for i in range(3):
+            logger.info('message %d', i)
+        listener.stop()
+        self.assertEqual(target.messages, ['message 0', 'message 1', 'message 2'])
+
+    def test_formatted_when_logged(self):
+        """the arguments and the traceback are rendered on the logging thread, not when the listener writes them"""
+        gate = threading.Event()
+        target = ListHandler(gate)
+        listener = QueueListener([target])
+        logger = self._return_logger(QueueHandler(listener))
+        values = ['before']
+        logger.info('values: %s', values)
+        values[0] = 'after'
+        try:
+            raise ValueError('lost frame')
+        except ValueError:
+            logger.exception('failed')
+        gate.set()
+        listener.stop()
+        self.assertEqual(target.messages[0], "values: ['before']")
+        self.assertTrue(target.messages[1].startswith('failed\nTraceback'))
+        self.assertIn('ValueError: lost frame', target.messages[1])
+
+    def test_drop_when_full(self):
+        """drop policy - records that do not fit in the queue are dropped and counted"""
+        gate = threading.Event()
+        target = ListHandler(gate)
+        listener = QueueListener([target], queue_size=2)
+        handler = QueueHandler(listener, DROP)
+        logger = self._return_logger(handler)
+        for i in range(10):
+            logger.info('message %d', i)
+        gate.set()
+        listener.stop()
+        # the listener holds at most one record while it waits, the queue two more
+        self.assertEqual(handler.dropped + len(target.messages), 10)
+        self.assertGreaterEqual(handler.dropped, 7)
+
+    def test_block_when_full(self):
+        """block policy - nothing is dropped"""
+        target = ListHandler()
+        listener = QueueListener([target], queue_size=1)
+        handler = QueueHandler(listener, BLOCK)
+        logger = self._return_logger(handler)
+        for i in range(100):
+            logger.info('message %d', i)
+        listener.stop()
+        self.assertEqual((handler.dropped, len(target.messages)), (0, 100))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, QueueHandler, QueueListener([]), 'wait')
+
+
+class LogSamplerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('test_gpg_setup_logger.sampler')
+        self.logger.setLevel(logging.DEBUG)
+        self.now = 0.0
+
+    def test_level_off(self):
+        """nothing is sampled when the level is off"""
+        self.logger.setLevel(logging.INFO)
+        sampler = LogSampler(self.logger)
+        self.assertFalse(any(sampler.sample() for i in range(10)))
+
+    def test_every(self):
+        """one call in every calls is sampled"""
+        sampler = LogSampler(self.logger, every=10)
+        self.assertEqual([i for i in range(25) if sampler.sample()], [0, 10, 20])
+
+    def test_max_per_second(self):
+        """at most max_per_second calls are sampled each second"""
+        sampler = LogSampler(self.logger, max_per_second=3, clock=lambda: self.now)
+        self.assertEqual(sum(1 for i in range(10) if sampler.sample()), 3)
+        self.now = 1.5
+        self.assertEqual(sum(1 for i in range(10) if sampler.sample()), 3)
+        self.assertEqual(sampler.suppressed, 14)
+
+
+class LogLevelTests(unittest.TestCase):
+
+    def tearDown(self):
+        os.environ.pop('log_levels', None)
+
+    def test_levels_from_environment(self):
+        os.environ['log_levels'] = 'app.gpg_cassandra=info, cassandra=WARNING,'
+        self.assertEqual(return_levels_from_environment(),
+                         {'app.gpg_cassandra': logging.INFO, 'cassandra': logging.WARNING})
+
+    def test_bad_level(self):
+        self.assertRaises(ValueError, return_level, 'LOUD')
+
+
+class FileHandlerTests(unittest.TestCase):
+
+    def test_rotate(self):
+        """a file several processes write to is rotated outside of them, the handler reopens it once it is moved"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'gpg_views.log')
+        for rotate, handler_type in ((True, logging.handlers.RotatingFileHandler),
+                                     (False, logging.handlers.WatchedFileHandler)):
+            handler = return_file_handler(filename, rotate)
+            self.addCleanup(handler.close)
+            self.assertIsInstance(handler, handler_type)
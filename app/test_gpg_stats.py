@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_stats.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_stats.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import unittest
+
+from gpg_stats import return_percentile
+
+
+class PercentileTests(unittest.TestCase):
+
+    def test_percentiles(self):
+        values = range(1, 101)
+        self.assertEqual([return_percentile(values, fraction) for fraction in (0.5, 0.99, 1.0)], [50, 99, 100])
+
+    def test_no_values(self):
+        self.assertIsNone(return_percentile([], 0.5))
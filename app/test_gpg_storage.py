@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for the memory and file storage backends in gpg_storage.py, and the views running on the memory backend
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_storage.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+os.environ.setdefault('contact_points', '127.0.0.1')
+
+from app import app
+import gpg_bulk
+from gpg_cassandra import CreateUserError, PageTokenError, UpdateUserError, UserExistsError, UserIdError
+import gpg_storage
+from gpg_storage import FileUserRepository, InMemoryUserRepository
+import gpg_user
+
+USER = {'name': 'testUser1', 'description': 'a test account', 'owner': 'Tester 1', 'owner_email': 'test1@my.com',
+        'notes': 'no notes1', 'is_domain': True, 'domain': 'wp.fsi'}
+
+
+class RepositoryTests(object):
+    """the repository contract, mixed into a TestCase per backend that sets self.repository"""
+
+    def test_create_and_get(self):
+        record = self.repository.create(USER)
+        user_id = uuid.UUID(record['user_id'])
+        self.assertEqual(self.repository.get(user_id), record)
+        self.assertEqual(self.repository.get_id_by_name('testUser1'), user_id)
+        self.assertEqual(self.repository.get_by_name('testUser1')['domain'], 'wp.fsi')
+        self.assertIsNone(self.repository.get(uuid.uuid4()))
+        self.assertIsNone(self.repository.get_by_name('noUser'))
+
+    def test_defaults(self):
+        record = self.repository.create({'name': 'bare'})
+        self.assertEqual((record['owner'], record['is_domain'], record['domain']), ('', False, ''))
+
+    def test_create_existing(self):
+        record = self.repository.create(USER)
+        self.assertRaises(UserExistsError, self.repository.create, USER)
+        self.assertRaises(UserExistsError, self.repository.create, {'name': 'other', 'user_id': record['user_id']})
+
+    def test_create_invalid(self):
+        self.assertRaises(CreateUserError, self.repository.create, {'owner': 'no name'})
+        self.assertRaises(CreateUserError, self.repository.create, {'name': 'u', 'colour': 'blue'})
+        self.assertRaises(UserIdError, self.repository.create, {'name': 'u', 'user_id': 'not a uuid'})
+
+    def test_wrong_types(self):
+        """values the Cassandra driver cannot bind are rejected by every backend"""
+        self.assertRaises(CreateUserError, self.repository.create, {'name': 'u', 'is_domain': 'yes'})
+        self.assertRaises(CreateUserError, self.repository.create, {'name': 'u', 'description': 5})
+        self.assertIsNone(self.repository.get_id_by_name('u'))
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        self.assertRaises(UpdateUserError, self.repository.update, user_id, {'is_domain': 'yes'})
+        self.assertRaises(UpdateUserError, self.repository.update, user_id, {'owner': ['o']})
+        self.assertEqual(self.repository.get(user_id)['owner'], USER['owner'])
+
+    def test_update(self):
+        """only the updatable fields that are set change"""
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        record = self.repository.update(user_id, {'domain': 'new.domain', 'name': 'ignored', 'notes': ''})
+        self.assertEqual((record['name'], record['domain'], record['notes']), ('testUser1', 'new.domain', 'no notes1'))
+        self.assertEqual(self.repository.get(user_id), record)
+        self.assertRaises(UpdateUserError, self.repository.update, user_id, {'name': 'ignored'})
+        self.assertRaises(UserIdError, self.repository.update, uuid.uuid4(), {'domain': 'd'})
+
+    def test_update_account_type(self):
+        user_id = uuid.UUID(self.repository.create({'name': 'local', 'domain': 'laptop'})['user_id'])
+        self.repository.update(user_id, {'is_domain': True, 'domain': 'wp.fsi'})
+        self.repository.update(user_id, {'description': 'changed'})
+        record = self.repository.get(user_id)
+        self.assertEqual((record['is_domain'], record['domain'], record['description']), (True, 'wp.fsi', 'changed'))
+
+    def test_delete(self):
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        self.repository.delete(user_id, 'testUser1')
+        self.assertIsNone(self.repository.get(user_id))
+        self.assertIsNone(self.repository.get_id_by_name('testUser1'))
+        # the name can be used again
+        self.repository.create(USER)
+
+    def test_list_and_export(self):
+        ids = dict((name, self.repository.create({'name': name})['user_id']) for name in ('a', 'b', 'c'))
+        self.assertEqual(self.repository.list_users(), ids)
+        self.assertEqual(dict(self.repository.iter_users()), ids)
+        self.assertEqual(sorted(record['name'] for record in self.repository.export_users()), ['a', 'b', 'c'])
+
+    def test_pages(self):
+        for name in ('d', 'b', 'a', 'c', 'e'):
+            self.repository.create({'name': name})
+        pages = []
+        users, token = self.repository.get_users_page(2)
+        pages.append(sorted(users))
+        while token:
+            users, token = self.repository.get_users_page(2, token)
+            pages.append(sorted(users))
+        self.assertEqual(pages, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertRaises(PageTokenError, self.repository.get_users_page, 2, 'a')
+
+    def test_lookup(self):
+        record = self.repository.create(USER)
+        user_id = uuid.UUID(record['user_id'])
+        name_records, id_records = self.repository.lookup(['noUser', 'testUser1'], [user_id, None, uuid.uuid4()])
+        self.assertEqual(name_records, [None, record])
+        self.assertEqual(id_records, [record, None, None])
+
+    def test_create_many(self):
+        self.repository.create({'name': 'taken'})
+        records = [{'name': 'new1'}, {'name': 'taken'}, {'name': 'has space'}, ValueError('bad line'),
+                   {'name': 'new2', 'user_id': 'nope'}, {'name': 5}, {'name': ['new3']}]
+        results = list(self.repository.create_many(records))
+        self.assertEqual([result['status'] for result in results],
+                         [gpg_bulk.CREATED, gpg_bulk.EXISTS] + [gpg_bulk.INVALID] * 5)
+        self.assertEqual(self.repository.get_id_by_name('new1'), uuid.UUID(results[0]['user_id']))
+
+
+class InMemoryRepositoryTests(RepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.repository = InMemoryUserRepository()
+
+    def test_records_are_copies(self):
+        record = self.repository.create(USER)
+        record['owner'] = 'changed'
+        self.assertEqual(self.repository.get_by_name('testUser1')['owner'], 'Tester 1')
+
+
+class FileRepositoryTests(RepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf_file = os.path.join(self.directory, 'users.json')
+        self.repository = FileUserRepository(self.conf_file)
+
+    def test_reload(self):
+        """the document is written on every change and loaded by a new repository"""
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        self.repository.create({'name': 'local', 'domain': 'laptop'})
+        self.repository.update(user_id, {'owner': 'Tester 2'})
+        self.repository.delete(self.repository.get_id_by_name('local'))
+        reloaded = FileUserRepository(self.conf_file)
+        self.assertEqual(reloaded.get(user_id), self.repository.get(user_id))
+        self.assertEqual(reloaded.list_users(), {'testUser1': str(user_id)})
+
+    def test_document(self):
+        """users are kept as gpg_user accounts, domain users with the domain name, local users with the hostname"""
+        self.repository.create(USER)
+        self.repository.create({'name': 'local', 'domain': 'laptop'})
+        with open(self.conf_file) as conf_file:
+            document = json.load(conf_file)
+        self.assertEqual(sorted(document), ['date_created', 'date_modified', 'users'])
+        accounts = dict((account['name'], account) for account in document['users'])
+        self.assertEqual((accounts['testUser1']['user_type'], accounts['testUser1']['domain_name']),
+                         (gpg_user.DomainUser.TYPE, 'wp.fsi'))
+        self.assertEqual((accounts['local']['user_type'], accounts['local']['hostname']),
+                         (gpg_user.LocalUser.TYPE, 'laptop'))
+
+
+    def test_write_delay(self):
+        """with a write delay the document is written later, or when the repository is closed"""
+        repository = FileUserRepository(self.conf_file, write_delay=60)
+        repository.create(USER)
+        repository.create({'name': 'local', 'domain': 'laptop'})
+        self.assertFalse(os.path.isfile(self.conf_file))
+        repository.close()
+        self.assertEqual(sorted(FileUserRepository(self.conf_file).list_users()), ['local', 'testUser1'])
+
+
+class LazyFileRepositoryTests(RepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf_file = os.path.join(self.directory, 'users.json')
+        FileUserRepository(self.conf_file).create(USER)
+        self.repository = FileUserRepository(self.conf_file, lazy=True)
+        self.repository.delete(self.repository.get_id_by_name('testUser1'))
+
+    def test_lazy_reload(self):
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        reloaded = FileUserRepository(self.conf_file, lazy=True)
+        self.assertEqual(reloaded.list_users(), {'testUser1': str(user_id)})
+        self.assertEqual(reloaded.get(user_id), self.repository.get(user_id))
+
+    def test_export_outside_lock(self):
+        """the accounts are built as the export reaches them, the users deleted meanwhile are skipped"""
+        for name in ('a', 'b'):
+            self.repository.create({'name': name})
+        reloaded = FileUserRepository(self.conf_file, lazy=True)
+        records = reloaded.export_users()
+        self.assertTrue(all(isinstance(user, gpg_user.LazyUser) for user in reloaded.users._users_by_uuid.values()))
+        self.assertEqual(next(records)['name'], 'a')
+        reloaded.delete(reloaded.get_id_by_name('b'))
+        self.assertEqual(list(records), [])
+
+
+class JournalFileRepositoryTests(RepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf_file = os.path.join(self.directory, 'users.json')
+        self.repository = self._return_repository()
+
+    def _return_repository(self):
+        repository = FileUserRepository(self.conf_file, journal=True, fsync='never', compact_every=4)
+        self.addCleanup(repository.close)
+        return repository
+
+    def test_reload(self):
+        """the changes are recovered from the snapshot and the journal after it"""
+        user_id = uuid.UUID(self.repository.create(USER)['user_id'])
+        for name in ('a', 'b', 'c'):
+            self.repository.create({'name': name})
+        # the fourth record compacted the journal into the snapshot
+        self.assertEqual(os.path.getsize(self.conf_file + '.journal'), 0)
+        self.repository.update(user_id, {'owner': 'Tester 2', 'is_domain': False})
+        self.repository.delete(self.repository.get_id_by_name('a'))
+        self.assertEqual(self.repository.users.journal.records, 2)
+        reloaded = self._return_repository()
+        self.assertEqual(reloaded.get(user_id), self.repository.get(user_id))
+        self.assertEqual(reloaded.list_users(), self.repository.list_users())
+
+    def test_no_snapshot(self):
+        self.repository.create(USER)
+        self.assertFalse(os.path.isfile(self.conf_file))
+        self.assertEqual(self._return_repository().get_by_name('testUser1')['domain'], 'wp.fsi')
+
+
+class MemoryViewsTests(unittest.TestCase):
+    """the views on the memory backend, no Cassandra session is used"""
+
+    def setUp(self):
+        self.addCleanup(gpg_storage.set_repository, gpg_storage.set_repository(InMemoryUserRepository()))
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_crud(self):
+        response = self.client.post('/user', data=json.dumps(USER), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(self.client.get('/user/testUser1').data)['domain'], 'wp.fsi')
+        response = self.client.put('/user/testUser1', data=json.dumps({'owner': 'Tester 2'}),
+                                   content_type='application/json')
+        self.assertEqual(json.loads(response.data)['owner'], 'Tester 2')
+        self.assertEqual(list(json.loads(self.client.get('/users').data)['users']), ['testUser1'])
+        self.assertEqual(self.client.delete('/user/testUser1').status_code, 200)
+        self.assertEqual(self.client.get('/user/testUser1').status_code, 400)
+
+    def test_bulk_and_lookup(self):
+        data = '\n'.join(json.dumps({'name': 'bulk{0}'.format(i)}) for i in range(3))
+        response = json.loads(self.client.post('/users/bulk', data=data, content_type='application/x-ndjson').data)
+        self.assertEqual(response['created'], 3)
+        response = self.client.post('/users/lookup', data=json.dumps({'names': ['bulk1', 'noUser']}),
+                                    content_type='application/json')
+        names = json.loads(response.data)['names']
+        self.assertEqual((names['bulk1']['name'], names['noUser']), ('bulk1', None))
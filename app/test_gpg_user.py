@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for the Users document in gpg_user.py
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_user.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gpg_user
+from gpg_user import DomainUser, LazyUser, LocalUser, RemoveUserError, UserExistsError, UserNameError, Users
+
+
+def return_domain_user(name='bob', domain_name='wp'):
+    return DomainUser(name, domain_name, 'an account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+
+
+def return_local_user(name='bob', hostname='laptop'):
+    return LocalUser(name, hostname, 'a local account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+
+
+class UsersIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.domain_user = return_domain_user()
+        self.local_user = return_local_user()
+        self.users = Users([self.domain_user, self.local_user])
+
+    def test_lookups(self):
+        """the same name is found as a domain user and as a local user"""
+        self.assertIs(self.users.return_user_by_uuid(self.domain_user.user_uuid), self.domain_user)
+        self.assertIs(self.users.return_domain_user_by_name('bob', 'wp'), self.domain_user)
+        self.assertIs(self.users.return_local_user_by_name('bob', 'laptop'), self.local_user)
+        self.assertRaises(UserNameError, self.users.return_domain_user_by_name, 'bob', 'laptop')
+        self.assertRaises(UserNameError, self.users.return_local_user_by_name, 'bob', 'wp')
+        self.assertIsNone(self.users.find_user_by_uuid('no-uuid'))
+
+    def test_add_existing(self):
+        """a user with the same uuid, or name in the same domain, is not added"""
+        self.assertRaises(UserExistsError, self.users.add_user, self.domain_user)
+        self.assertRaises(UserExistsError, self.users.add_user, return_domain_user())
+        self.users.add_user(return_domain_user(domain_name='other'))
+        self.assertEqual(len(self.users), 3)
+        self.assertEqual(self.users.users[:2], (self.domain_user, self.local_user))
+
+    def test_replace_existing_name(self):
+        """a user is not moved to the domain of another user with the same name"""
+        other = return_domain_user(domain_name='other')
+        self.users.add_user(other)
+        self.assertRaises(UserExistsError, self.users.replace_user, other.replace(domain_name='wp'))
+        self.assertIs(self.users.find_user_by_uuid(other.user_uuid), other)
+
+    def test_users_read_only(self):
+        """the users property is a copy, changing it must fail rather than change nothing"""
+        users = self.users.users
+        self.assertFalse(hasattr(users, 'append'))
+        with self.assertRaises(TypeError):
+            users[0] = return_domain_user()
+
+    def test_remove(self):
+        self.users.remove_user_by_uuid(self.domain_user.user_uuid)
+        self.users.remove_local_user_by_name('bob', 'laptop')
+        self.assertEqual((self.users.users, self.users.return_user_names()), ((), []))
+        self.assertRaises(UserNameError, self.users.return_domain_user_by_name, 'bob', 'wp')
+        self.assertRaises(RemoveUserError, self.users._remove_user, self.domain_user)
+        # the names can be used again
+        self.users.add_user(return_domain_user())
+        self.assertEqual(self.users.return_user_names(), ['bob'])
+
+    def test_write_and_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.users.conf_file = os.path.join(directory, 'users.json')
+        self.users.write_users()
+        loaded = Users(conf_file=self.users.conf_file)
+        loaded.load_users()
+        self.assertEqual([user.user_uuid for user in loaded.users],
+                         [self.domain_user.user_uuid, self.local_user.user_uuid])
+        self.assertEqual(loaded.return_local_user_by_name('bob', 'laptop').user_uuid, self.local_user.user_uuid)
+
+
+class UsersWriteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf_file = os.path.join(self.directory, 'users.json')
+        self.writes = []
+        write_json_document = gpg_user._write_json_document
+
+        def count_writes(json_file, document):
+            self.writes.append(len(document['users']))
+            write_json_document(json_file, document)
+        gpg_user._write_json_document = count_writes
+        self.addCleanup(setattr, gpg_user, '_write_json_document', write_json_document)
+
+    def test_failed_write(self):
+        """a write that fails leaves the previous document and no temporary file"""
+        users = Users([return_domain_user()], conf_file=self.conf_file)
+        users.write_users()
+        users.add_user(LocalUser('bob', 'laptop', 'a local account', 'Bob Hope', 'bob@bobby.com', set()))
+        self.assertRaises(AttributeError, users.write_users)
+        self.assertEqual(os.listdir(self.directory), ['users.json'])
+        loaded = Users(conf_file=self.conf_file)
+        loaded.load_users()
+        self.assertEqual(len(loaded), 1)
+
+    def test_coalesced_writes(self):
+        """the changes made within the write delay are written together"""
+        users = Users(conf_file=self.conf_file, write_delay=0.2)
+        for name in ('a', 'b', 'c'):
+            users.add_user(return_domain_user(name))
+            users.write_users_later()
+        self.assertFalse(os.path.isfile(self.conf_file))
+        users._write_timer.join()
+        self.assertEqual(self.writes, [3])
+
+    def test_flush(self):
+        users = Users(conf_file=self.conf_file, write_delay=60)
+        users.add_user(return_domain_user())
+        users.write_users_later()
+        users.flush()
+        self.assertEqual(self.writes, [1])
+        # nothing changed since the last write
+        users.flush()
+        self.assertEqual(self.writes, [1])
+
+    def test_context_manager(self):
+        with Users(conf_file=self.conf_file, write_delay=60) as users:
+            users.add_user(return_domain_user())
+            users.write_users_later()
+        self.assertEqual(self.writes, [1])
+        self.assertIsNone(users._write_timer)
+
+
+class LazyUsersTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.domain_user = return_domain_user()
+        self.local_user = return_local_user()
+        Users([self.domain_user, self.local_user], conf_file=os.path.join(directory, 'users.json')).write_users()
+        self.users = Users(conf_file=os.path.join(directory, 'users.json'), lazy=True)
+        self.users.load_users()
+
+    def test_built_on_first_access(self):
+        self.assertEqual(self.users.return_user_names(), ['bob', 'bob'])
+        self.assertTrue(all(isinstance(user, LazyUser) for user in self.users._users_by_uuid.values()))
+        user = self.users.return_local_user_by_name('bob', 'laptop')
+        self.assertIsInstance(user, LocalUser)
+        self.assertIs(self.users.find_user_by_uuid(self.local_user.user_uuid), user)
+        self.assertIsInstance(self.users._users_by_uuid[self.domain_user.user_uuid], LazyUser)
+        self.assertEqual([type(user) for user in self.users.users], [DomainUser, LocalUser])
+
+    def test_changes(self):
+        """the users not built yet are written as they were loaded"""
+        self.users.replace_user(LocalUser('bob', 'desktop', 'moved', 'Bob Hope', 'bob@bobby.com', 'no notes',
+                                          user_uuid=self.local_user.user_uuid))
+        self.users.write_users()
+        self.assertIsInstance(self.users._users_by_uuid[self.domain_user.user_uuid], LazyUser)
+        loaded = Users(conf_file=self.users.conf_file)
+        loaded.load_users()
+        self.assertEqual(loaded.return_local_user_by_name('bob', 'desktop').description, 'moved')
+        self.assertEqual(loaded.return_domain_user_by_name('bob', 'wp').user_uuid, self.domain_user.user_uuid)
+        self.users.remove_user_by_uuid(self.domain_user.user_uuid)
+        self.assertEqual(len(self.users), 1)
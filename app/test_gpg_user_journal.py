@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_user_journal.py and the journal of the gpg_user.Users document
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_user_journal.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from gpg_user import DomainUser, LocalUser, UserJsonDocError, Users
+from gpg_user_journal import FSYNC_INTERVAL, UsersJournal
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.journal_file = os.path.join(self.directory, 'users.json.journal')
+        self.journal = UsersJournal(self.journal_file, FSYNC_INTERVAL, 60)
+        self.addCleanup(self.journal.close)
+
+    def test_append_and_replay(self):
+        """one compact line per record, with the sequence"""
+        self.journal.append({'op': 'remove', 'user_uuid': 'u1'})
+        self.journal.append({'op': 'remove', 'user_uuid': 'u2'})
+        with open(self.journal_file) as journal_file:
+            lines = journal_file.readlines()
+        self.assertEqual([json.loads(line) for line in lines], [{'seq': 1, 'op': 'remove', 'user_uuid': 'u1'},
+                                                                {'seq': 2, 'op': 'remove', 'user_uuid': 'u2'}])
+        self.assertNotIn(' ', lines[0])
+        records = UsersJournal(self.journal_file).replay(1)
+        self.assertEqual(records, [{'seq': 2, 'op': 'remove', 'user_uuid': 'u2'}])
+
+    def test_torn_record(self):
+        """a record torn by a crash is dropped and the next record starts on a new line"""
+        self.journal.append({'op': 'remove', 'user_uuid': 'u1'})
+        self.journal.close()
+        with open(self.journal_file, 'ab') as journal_file:
+            journal_file.write('{"seq":2,"op":"rem')
+        journal = UsersJournal(self.journal_file)
+        self.assertEqual([record['seq'] for record in journal.replay()], [1])
+        journal.append({'op': 'remove', 'user_uuid': 'u3'})
+        journal.close()
+        self.assertEqual([record['seq'] for record in UsersJournal(self.journal_file).replay()], [1, 2])
+
+    def test_corrupt_record(self):
+        with open(self.journal_file, 'wb') as journal_file:
+            journal_file.write('not json\n{"seq":1,"op":"remove","user_uuid":"u1"}\n')
+        self.assertRaises(ValueError, self.journal.replay)
+
+    def test_reset(self):
+        self.journal.append({'op': 'remove', 'user_uuid': 'u1'})
+        self.journal.reset()
+        self.assertEqual((os.path.getsize(self.journal_file), self.journal.records, self.journal.sequence), (0, 0, 1))
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, UsersJournal, self.journal_file, 'sometimes')
+
+
+class UsersJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf_file = os.path.join(self.directory, 'users.json')
+        self.users = self._return_users()
+
+    def _return_users(self):
+        users = Users(conf_file=self.conf_file, journal=UsersJournal(self.conf_file + '.journal', 'never'),
+                      compact_every=3)
+        self.addCleanup(users.close)
+        users.load_users()
+        return users
+
+    def test_recovery(self):
+        domain_user = DomainUser('bob', 'wp', 'an account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+        local_user = LocalUser('bob', 'laptop', 'a local account', 'Bob Hope', 'bob@bobby.com', 'no notes')
+        self.users.add_user(domain_user)
+        self.users.add_user(local_user)
+        self.users.replace_user(LocalUser('bob', 'desktop', 'moved', 'Bob Hope', 'bob@bobby.com', 'no notes',
+                                          user_uuid=local_user.user_uuid))
+        # compacted after three records
+        with open(self.conf_file) as conf_file:
+            self.assertEqual(json.load(conf_file)['journal_sequence'], 3)
+        self.users.remove_user_by_uuid(domain_user.user_uuid)
+        recovered = self._return_users()
+        self.assertEqual([user.user_uuid for user in recovered.users], [local_user.user_uuid])
+        self.assertEqual(recovered.return_local_user_by_name('bob', 'desktop').description, 'moved')
+        self.assertEqual(recovered.date_modified, self.users.date_modified)
+
+    def test_snapshot_before_reset(self):
+        """records already in the snapshot are not applied again when the journal was not emptied"""
+        self.users.compact_every = 10
+        self.users.add_user(DomainUser('bob', 'wp', 'an account', 'Bob Hope', 'bob@bobby.com', 'no notes'))
+        self.users.write_users()
+        self.users.remove_domain_user_by_name('bob', 'wp')
+        self.users.add_user(DomainUser('bob', 'wp', 'a new account', 'Bob Hope', 'bob@bobby.com', 'no notes'))
+        self.assertEqual(self._return_users().return_domain_user_by_name('bob', 'wp').description, 'a new account')
+
+    def test_unknown_operation(self):
+        self.users.journal.append({'op': 'rename', 'date_modified': 'now'})
+        self.users.journal.close()
+        self.assertRaises(UserJsonDocError, self._return_users)
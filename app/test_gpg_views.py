@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+Testing for gpg_views.py
+These are unit tests, they run the Flask routes against a fake Cassandra session (no live cluster needed) and count
+the CQL statements each endpoint executes
+run from the top level directory: python -m unittest discover -s app -p 'test_gpg_views.py' -t .
+"""
+
+__author__ = "GGibson"
+
+import base64
+import json
+import logging
+import os
+import unittest
+import uuid
+
+from cassandra import OperationTimedOut
+
+os.environ.setdefault('contact_points', '127.0.0.1')
+
+from app import app
+import gpg_cache
+import gpg_cassandra
+import gpg_cassandra_async
+import gpg_metrics
+import gpg_tracing
+from gpg_cassandra import User
+from gpg_fake_cassandra import FakeSession, install, uninstall, UserRow
+
+
+class ViewsTestCase(unittest.TestCase):
+    user_id = uuid.UUID('f5c54eea-a9e8-4f81-898e-b965675f46b4')
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.session.add_user(UserRow(self.user_id, 'testUser1', 'a test account', 'Tester 1', 'test1@my.com',
+                                      'no notes1', True, 'wp.fsi'))
+        install(self.session)
+        gpg_cache.user_cache.set_backend(gpg_cache.LRUCache())
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        uninstall()
+
+
+class StatementsPerEndpoint(ViewsTestCase):
+    """number of CQL statements executed per endpoint"""
+
+    def test_get_users(self):
+        """GET /users - one select"""
+        response = self.client.get('/users')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'users': {'testUser1': str(self.user_id)}})
+        self.assertEqual(len(self.session.executed), 1)
+
+    def test_get_user(self):
+        """GET /user/<name> - name lookup and one detail read"""
+        response = self.client.get('/user/testUser1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['domain'], 'wp.fsi')
+        self.assertEqual(self.session.executed, [User.USER_ID_BY_NAME_COMMAND, User.USER_DETAILS_COMMAND])
+
+    def test_create_user(self):
+        """POST /user - name claim and insert, no read back"""
+        response = self.client.post('/user', data=json.dumps({'name': 'smithers', 'owner': 'bob hope'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['owner'], 'bob hope')
+        self.assertEqual(self.session.executed, [User.CLAIM_USER_NAME_COMMAND, User.CREATE_USER_COMMAND])
+
+    def test_create_user_existing_name(self):
+        """POST /user - existing name is rejected with 409 after the name claim"""
+        response = self.client.post('/user', data=json.dumps({'name': 'testUser1'}), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.session.executed, [User.CLAIM_USER_NAME_COMMAND])
+
+    def test_create_user_existing_id(self):
+        """POST /user - existing id is rejected with 409 and the name claimed for it is released"""
+        response = self.client.post('/user', data=json.dumps({'name': 'smithers', 'user_id': str(self.user_id)}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.session.executed, [User.CLAIM_USER_NAME_COMMAND, User.CREATE_USER_COMMAND,
+                                                 User.RELEASE_USER_NAME_COMMAND])
+        self.assertNotIn('smithers', self.session.users_by_name)
+
+    def test_create_user_insert_error(self):
+        """the name is released when the insert fails, but not when it timed out and may have been applied"""
+        run = self.session._run
+
+        def fail_insert(error):
+            def _run(command, parameters):
+                if command == User.CREATE_USER_COMMAND:
+                    raise error
+                return run(command, parameters)
+            self.session._run = _run
+
+        fail_insert(TypeError("'int' object has no attribute 'encode'"))
+        self.assertRaises(TypeError, User(name='smithers').create_user)
+        self.assertNotIn('smithers', self.session.users_by_name)
+        fail_insert(OperationTimedOut())
+        self.assertRaises(OperationTimedOut, User(name='smithers').create_user)
+        self.assertIn('smithers', self.session.users_by_name)
+
+    def test_create_user_bad_request(self):
+        """POST /user - unknown fields, a name that is not a string or a body that is not a user are rejected"""
+        for body in ({'name': 'smithers', 'colour': 'blue'}, {'name': 5}, {'owner': 'bob hope'},
+                     {'name': 'smithers', 'user_id': 'not-a-uuid'}, ['smithers'],
+                     {'name': 'smithers', 'is_domain': 'yes'}, {'name': 'smithers', 'description': 5}):
+            response = self.client.post('/user', data=json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        response = self.client.post('/user', data='{', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.session.executed, [])
+
+    def test_update_user_partial(self):
+        """PUT /user/<name> - partial update reads the merged record back once"""
+        response = self.client.put('/user/testUser1', data=json.dumps({'domain': 'new.domain'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['domain'], 'new.domain')
+        self.assertEqual(json.loads(response.data)['owner'], 'Tester 1')
+        self.assertEqual(len(self.session.executed), 3)
+
+    def test_update_user_complete(self):
+        """PUT /user/<name> - update setting every column returns the record without reading it back"""
+        values = {'description': 'd', 'owner': 'o', 'owner_email': 'o@my.com', 'notes': 'n', 'is_domain': True,
+                  'domain': 'new.domain'}
+        response = self.client.put('/user/testUser1', data=json.dumps(values), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['owner'], 'o')
+        self.assertEqual(len(self.session.executed), 2)
+        self.assertNotIn(User.USER_DETAILS_COMMAND, self.session.executed)
+
+    def test_update_user_bad_request(self):
+        """PUT /user/<name> - no updatable field, a value of the wrong type or a body that is not a user is rejected"""
+        for body in ({}, {'colour': 'x'}, ['x'], {'description': 5}, {'is_domain': 'yes'}):
+            response = self.client.put('/user/testUser1', data=json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        response = self.client.put('/user/testUser1', data='{', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(User.USER_DETAILS_COMMAND, self.session.executed)
+        self.assertEqual(self.session.users[self.user_id].description, 'a test account')
+
+    def test_delete_user(self):
+        """DELETE /user/<name> - name lookup, the row delete and the conditional release of the name"""
+        response = self.client.delete('/user/testUser1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.executed, [User.USER_ID_BY_NAME_COMMAND, User.DELETE_USER_COMMAND,
+                                                 User.RELEASE_USER_NAME_COMMAND])
+        self.assertEqual(self.session.users, {})
+        self.assertEqual(self.session.users_by_name, {})
+
+    def test_delete_user_keeps_reclaimed_name(self):
+        """the name is only released while it still maps to the deleted id"""
+        other_id = uuid.uuid4()
+        self.session.users_by_name['testUser1'] = other_id
+        User(user_id=self.user_id, name='testUser1').delete_user()
+        self.assertEqual((self.session.users, self.session.users_by_name), ({}, {'testUser1': other_id}))
+
+
+class GetUsersPaging(ViewsTestCase):
+    """GET /users paging, streaming and export"""
+
+    def setUp(self):
+        super(GetUsersPaging, self).setUp()
+        for name in ('testUser2', 'testUser3'):
+            user_id = uuid.uuid4()
+            self.session.users[user_id] = UserRow(user_id, name, '', '', '', '', False, '')
+            self.session.users_by_name[name] = user_id
+
+    def test_pages(self):
+        """GET /users?limit= - pages follow the next page token until it is null"""
+        names = []
+        response = json.loads(self.client.get('/users?limit=2').data)
+        self.assertEqual(len(response['users']), 2)
+        names.extend(response['users'])
+        response = json.loads(self.client.get('/users?limit=2&page_token={0}'.format(
+            response['next_page_token'])).data)
+        names.extend(response['users'])
+        self.assertIsNone(response['next_page_token'])
+        self.assertEqual(sorted(names), ['testUser1', 'testUser2', 'testUser3'])
+
+    def test_bad_limit_and_token(self):
+        """GET /users - out of range or non integer limits and undecodable tokens are rejected"""
+        for limit in ('0', '-1', 'abc', '2.5', '1001', ''):
+            self.assertEqual(self.client.get('/users?limit=' + limit).status_code, 400, limit)
+        self.assertEqual(self.client.get('/users?limit=2&page_token=abc').status_code, 400)
+
+    def test_garbage_paging_state(self):
+        """GET /users - a token that decodes but holds a paging state Cassandra rejects is a bad request"""
+        page_token = base64.urlsafe_b64encode('garbage')
+        self.assertEqual(self.client.get('/users?limit=2&page_token=' + page_token).status_code, 400)
+
+    def test_stream(self):
+        """GET /users?stream=true - streamed document matches the unpaged one"""
+        streamed = json.loads(self.client.get('/users?stream=true').data)
+        self.assertEqual(streamed, json.loads(self.client.get('/users').data))
+        self.assertEqual(len(streamed['users']), 3)
+
+    def test_export(self):
+        """GET /users/export - every full record once, as newline delimited json"""
+        response = self.client.get('/users/export')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(sorted(record['name'] for record in records), ['testUser1', 'testUser2', 'testUser3'])
+        self.assertEqual(records[[record['name'] for record in records].index('testUser1')]['domain'], 'wp.fsi')
+        self.assertEqual(self.session.executed.count(User.USERS_TOKEN_RANGE_COMMAND), 64)
+
+
+class BulkCreateUsers(ViewsTestCase):
+    """POST /users/bulk"""
+
+    def test_bulk_ndjson(self):
+        """POST /users/bulk - per item results for created, existing and invalid records"""
+        lines = [json.dumps({'name': 'bulk1', 'owner': 'bob hope'}), json.dumps({'name': 'testUser1'}), 'not json',
+                 json.dumps({'name': 'bulk 2'}), json.dumps({'name': 'bulk3', 'colour': 'red'}),
+                 json.dumps({'name': 'bulk4', 'user_id': str(self.user_id)})]
+        response = self.client.post('/users/bulk', data='\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertEqual([result['status'] for result in response['results']],
+                         ['created', 'exists', 'invalid', 'invalid', 'invalid', 'exists'])
+        self.assertEqual((response['created'], response['failed']), (1, 5))
+        self.assertNotIn('bulk4', self.session.users_by_name)
+        self.assertEqual(self.session.users[uuid.UUID(response['results'][0]['user_id'])].owner, 'bob hope')
+
+    def test_bulk_wrong_types(self):
+        """POST /users/bulk - names and ids that are not strings are invalid records, the others are created"""
+        users = [{'name': 5}, {'name': ['bulk1']}, {'name': {'first': 'bulk1'}}, {'name': 'bulk2', 'user_id': 5},
+                 {'name': 'bulk3'}]
+        response = self.client.post('/users/bulk', data=json.dumps(users), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertEqual([result['status'] for result in response['results']], ['invalid'] * 4 + ['created'])
+        self.assertIn('must be a string', response['results'][1]['error'])
+
+    def test_bulk_json_array(self):
+        """POST /users/bulk - json array, one claim and one insert per user"""
+        users = [{'name': 'bulk{0}'.format(i)} for i in range(5)]
+        response = self.client.post('/users/bulk', data=json.dumps(users), content_type='application/json')
+        self.assertEqual(json.loads(response.data)['created'], 5)
+        self.assertEqual(len(self.session.executed), 10)
+        self.assertEqual(self.client.post('/users/bulk', data='{}', content_type='application/json').status_code,
+                         400)
+
+
+class LookupUsers(ViewsTestCase):
+    """POST /users/lookup"""
+
+    def test_lookup(self):
+        """POST /users/lookup - found and not found names and ids in one request"""
+        keys = {'names': ['testUser1', 'noUser'], 'ids': [str(self.user_id), str(uuid.uuid4()), 'not-a-uuid']}
+        response = self.client.post('/users/lookup', data=json.dumps(keys), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertEqual(response['names']['testUser1']['domain'], 'wp.fsi')
+        self.assertIsNone(response['names']['noUser'])
+        self.assertEqual(response['ids'][str(self.user_id)]['name'], 'testUser1')
+        self.assertEqual(sum(1 for record in response['ids'].values() if record is None), 2)
+        # two name lookups, and the two valid ids are read once each
+        self.assertEqual(len(self.session.executed), 4)
+
+    def test_lookup_bad_request(self):
+        """POST /users/lookup - keys must be lists of strings"""
+        for keys in ([], {'names': 'testUser1'}, {'ids': [['a']]}, {'names': [1]}, {'names': ['testUser1', None]},
+                     {'ids': [5]}, {'names': [{'name': 'testUser1'}]}):
+            response = self.client.post('/users/lookup', data=json.dumps(keys), content_type='application/json')
+            self.assertEqual(response.status_code, 400, keys)
+        self.assertEqual(self.session.executed, [])
+
+
+class UserCache(ViewsTestCase):
+    """user cache in front of the name lookup and the detail read"""
+
+    def test_get_user_cached(self):
+        """GET /user/<name> - the second read is served from the cache"""
+        self.client.get('/user/testUser1')
+        response = self.client.get('/user/testUser1')
+        self.assertEqual(json.loads(response.data)['domain'], 'wp.fsi')
+        self.assertEqual(len(self.session.executed), 2)
+        self.assertEqual(gpg_cache.user_cache.stats()['hits'], 2)
+
+    def test_update_invalidates(self):
+        """PUT /user/<name> - the next read sees the update"""
+        self.client.get('/user/testUser1')
+        self.client.put('/user/testUser1', data=json.dumps({'domain': 'new.domain'}), content_type='application/json')
+        self.assertEqual(json.loads(self.client.get('/user/testUser1').data)['domain'], 'new.domain')
+
+    def test_delete_invalidates(self):
+        """DELETE /user/<name> - the name no longer resolves"""
+        self.client.get('/user/testUser1')
+        self.client.delete('/user/testUser1')
+        self.assertEqual(self.client.get('/user/testUser1').status_code, 400)
+
+    def test_write_ignores_stale_id(self):
+        """PUT and DELETE /user/<name> - the id is read from users_by_name, not the cache another worker left"""
+        self.client.get('/user/testUser1')
+        # another worker deleted the user and the name was taken again
+        other_id = uuid.uuid4()
+        del self.session.users[self.user_id]
+        self.session.add_user(UserRow(other_id, 'testUser1', 'a new account', 'Tester 2', 'test2@my.com', None,
+                                      False, None))
+        response = self.client.put('/user/testUser1', data=json.dumps({'domain': 'new.domain'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['user_id'], str(other_id))
+        self.assertEqual(self.session.users.keys(), [other_id])
+        self.assertEqual(self.client.delete('/user/testUser1').status_code, 200)
+        self.assertEqual((self.session.users, self.session.users_by_name), ({}, {}))
+
+    def test_update_deleted_user(self):
+        """PUT /user/<name> - a user deleted after its id was read is not written back as a ghost row"""
+        del self.session.users[self.user_id]
+        response = self.client.put('/user/testUser1', data=json.dumps({'domain': 'new.domain'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.session.users, {})
+
+    def test_lookup_cached(self):
+        """POST /users/lookup - cached names and records are not read again"""
+        self.client.get('/user/testUser1')
+        keys = {'names': ['testUser1'], 'ids': [str(self.user_id)]}
+        response = self.client.post('/users/lookup', data=json.dumps(keys), content_type='application/json')
+        self.assertEqual(json.loads(response.data)['names']['testUser1']['name'], 'testUser1')
+        self.assertEqual(len(self.session.executed), 2)
+
+    def test_stats(self):
+        """GET /cache/stats - counters"""
+        self.client.get('/user/testUser1')
+        stats = json.loads(self.client.get('/cache/stats').data)
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (0, 2, 2))
+
+
+class Metrics(ViewsTestCase):
+    """GET /metrics"""
+
+    def test_request_and_statement_metrics(self):
+        """requests are counted by route pattern and status, statements by type"""
+        requests = gpg_metrics.http_request_duration.count(('/user/<user_name>', 'GET', '200'))
+        statements = gpg_metrics.cassandra_statement_duration.count(('select users_by_name',))
+        self.client.get('/user/testUser1')
+        self.client.get('/user/noUser')
+        self.assertEqual(gpg_metrics.http_request_duration.count(('/user/<user_name>', 'GET', '200')), requests + 1)
+        self.assertEqual(gpg_metrics.cassandra_statement_duration.count(('select users_by_name',)), statements + 2)
+
+    def test_statement_errors(self):
+        """failed statements are counted by type and error"""
+        errors = gpg_metrics.cassandra_statement_errors.value(('select users_by_name', 'AttributeError'))
+        self.session.users_by_name = None
+        self.assertRaises(AttributeError, self.client.get, '/user/testUser1')
+        self.assertEqual(gpg_metrics.cassandra_statement_errors.value(('select users_by_name', 'AttributeError')),
+                         errors + 1)
+        self.assertGreaterEqual(gpg_metrics.http_request_duration.count(('/user/<user_name>', 'GET', '500')), 1)
+
+    def test_render(self):
+        self.client.get('/user/testUser1')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{route="/user/<user_name>",method="GET",status="200"}',
+                      response.data)
+        self.assertIn('cassandra_sessions 1', response.data)
+        self.assertIn('user_cache_misses_total', response.data)
+
+
+class RequestTracing(ViewsTestCase):
+    """Server-Timing header and slow request log"""
+
+    def setUp(self):
+        super(RequestTracing, self).setUp()
+        self.settings = (gpg_tracing.request_tracing, gpg_tracing.slow_request_seconds,
+                         gpg_tracing.cassandra_tracing)
+        gpg_tracing.request_tracing = 'header'
+        self.slow_requests = []
+        handler = logging.Handler()
+        handler.emit = lambda record: self.slow_requests.append(json.loads(record.args[0]))
+        gpg_tracing.slow_logger.addHandler(handler)
+        self.addCleanup(gpg_tracing.slow_logger.removeHandler, handler)
+
+    def tearDown(self):
+        (gpg_tracing.request_tracing, gpg_tracing.slow_request_seconds,
+         gpg_tracing.cassandra_tracing) = self.settings
+        super(RequestTracing, self).tearDown()
+
+    def test_server_timing(self):
+        """GET /user/<name> - a span for each phase when the trace header is sent"""
+        self.assertNotIn('Server-Timing', self.client.get('/user/testUser1').headers)
+        gpg_cache.user_cache.clear()
+        response = self.client.get('/user/testUser1', headers={gpg_tracing.TRACE_HEADER: '1'})
+        names = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['routing', 'cql', 'name_lookup', 'json', 'total'])
+        self.assertIn('cql;dur=', response.headers['Server-Timing'])
+        self.assertIn('desc="2 spans"', response.headers['Server-Timing'])
+
+    def test_slow_request_log(self):
+        """requests over the threshold are logged with their spans and the Cassandra trace ids"""
+        gpg_tracing.slow_request_seconds = 60
+        self.client.get('/user/testUser1', headers={gpg_tracing.TRACE_HEADER: '1'})
+        self.assertEqual(self.slow_requests, [])
+        gpg_tracing.slow_request_seconds = 1e-9
+        gpg_tracing.cassandra_tracing = True
+        gpg_cache.user_cache.clear()
+        self.client.get('/user/testUser1', headers={gpg_tracing.TRACE_HEADER: '1'})
+        self.client.get('/users')
+        traced, untraced = self.slow_requests
+        self.assertEqual((traced['path'], traced['status']), ('/user/testUser1', 200))
+        self.assertEqual(len(traced['cassandra_trace_ids']), 2)
+        self.assertEqual([span['desc'] for span in traced['spans'] if span['name'] == 'cql'],
+                         ['select users_by_name', 'select users_tbl'])
+        self.assertNotIn('spans', untraced)
+
+
+class AsyncUserReads(ViewsTestCase):
+    """gpg_cassandra_async.AsyncUser"""
+
+    def test_record_by_name(self):
+        """get_user_record_by_name - the detail read is chained on the name resolution"""
+        async_user = gpg_cassandra_async.AsyncUser()
+        self.assertEqual(async_user.get_user_record_by_name('testUser1').result()['user_id'], str(self.user_id))
+        self.assertIsNone(async_user.get_user_record_by_name('noUser').result())
+        self.assertEqual(len(self.session.executed), 3)
+
+    def test_error(self):
+        """a failed read fails the chained future"""
+        self.session.users_by_name = None
+        future = gpg_cassandra_async.AsyncUser().get_user_record_by_name('testUser1')
+        self.assertRaises(AttributeError, future.result)
+
+    def test_lookup_order(self):
+        """lookup - records are returned in the order of the keys, invalid ids are None"""
+        name_records, id_records = gpg_cassandra_async.AsyncUser().lookup(
+            ['noUser', 'testUser1'], [None, self.user_id], concurrency=1).result()
+        self.assertEqual([record and record['name'] for record in name_records], [None, 'testUser1'])
+        self.assertEqual([record and record['name'] for record in id_records], [None, 'testUser1'])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+gunicorn settings for the Flask Application, read from environment variables so they can be set per Marathon app:
+    gunicorn_bind - address to listen on, default 0.0.0.0:5000
+    gunicorn_workers - worker processes, default 2 * cpu cores + 1 up to 8.  The container sees every core of the
+                       host, not its Marathon cpus, so set it to match them
+    gunicorn_threads - request threads per worker process, default 4
+    gunicorn_keepalive - seconds an idle keep-alive connection is held open, default 5
+    gunicorn_timeout - seconds a worker can be silent before it is killed and restarted, default 60
+    gunicorn_graceful_timeout - seconds in flight requests get to finish on a reload or stop, default 30
+    gunicorn_max_requests - requests after which a worker is replaced (0 never), default 0
+A graceful reload (new workers started, old workers finish their requests) is a HUP sent to the master process.
+Every worker appends to /var/log/gpg/gpg_views.log (see gpg_views).  The workers do not rotate it, each would rotate
+it under the others, rotate it with logrotate (without copytruncate, the workers reopen the file once it is moved)
+"""
+
+__author__ = "GGibson"
+
+import logging
+import multiprocessing
+import os
+
+MAX_DEFAULT_WORKERS = 8
+
+bind = os.environ.get('gunicorn_bind', '0.0.0.0:5000')
+workers = int(os.environ.get('gunicorn_workers', min(multiprocessing.cpu_count() * 2 + 1, MAX_DEFAULT_WORKERS)))
+# more than one thread selects the gthread worker, each worker process serves requests on a thread pool
+threads = int(os.environ.get('gunicorn_threads', 4))
+keepalive = int(os.environ.get('gunicorn_keepalive', 5))
+timeout = int(os.environ.get('gunicorn_timeout', 60))
+graceful_timeout = int(os.environ.get('gunicorn_graceful_timeout', 30))
+max_requests = int(os.environ.get('gunicorn_max_requests', 0))
+max_requests_jitter = max_requests // 10
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    """
+    runs in each worker process after the fork: Cassandra sessions and their connection threads must not be shared
+    with the master, so any that were inherited (with preload_app) are dropped
+    """
+    from app.gpg_cassandra_utility import session_manager
+    session_manager.reset()
+
+
+def post_worker_init(worker):
+    """
+    runs in each worker process once the app is loaded: opens the worker's Cassandra session and starts the cache
+    invalidation receiver, so the first request does not pay for them
+    """
+    from app import gpg_cassandra
+    from app.gpg_cache import user_cache
+    logger = logging.getLogger('gunicorn.error')
+    if user_cache.bus:
+        user_cache.bus.start()
+    try:
+        cassandra = gpg_cassandra.Cassandra.return_default()
+        gpg_cassandra.get_session(contact_points=cassandra.contact_points, keyspace=cassandra.keyspace,
+                                  port=cassandra.port)
+    except Exception as e:
+        logger.warning('cannot open the Cassandra session in worker: %s, it is opened on the first request instead, '
+                       'error: %s', worker.pid, e)
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # Copyright line goes here
 """
-Run script for the Flask Application
+Run script for the Flask Application, starts the Flask development server (single process, debugger on) for local
+use.  The container runs the app with gunicorn instead, see wsgi.py and gunicorn_config.py
 """
 
 __author__ = "GGibson"
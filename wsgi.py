@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# Copyright line goes here
+"""
+WSGI entry point for the Flask Application, used by gunicorn in the container:
+    gunicorn -c gunicorn_config.py wsgi:application
+run.py starts the Flask development server instead (single process, reloader and debugger on), for local use only
+"""
+
+__author__ = "GGibson"
+
+from app import app
+
+application = app